@@ -1,4 +1,6 @@
 import fundus_prep as prep
+import fundus_source
+from EyeQ_process_multiprocess import merge_crop_info, output_name, pending_images
 import os
 import pandas as pd
 from PIL import ImageFile
@@ -19,19 +21,20 @@ def process(image_list, save_path):
     
     resolution_list = pd.read_csv(f'{AUTOMORPH_DATA}/resolution_information.csv')
     
-    for image_path in tqdm(image_list, total=len(image_list)):
+    image_list = pending_images(image_list, save_path)
+    source = fundus_source.open_source()
+    for image_path, image in tqdm(source.read(image_list), total=len(image_list)):
         
-        dst_image = f'{AUTOMORPH_DATA}/images/' + image_path
-        if os.path.exists(f'{AUTOMORPH_DATA}/Results/M0/images/' + image_path):
-            print('continue...')
-            continue
         try:
             resolution_ = resolution_list['res'][resolution_list['fundus']==image_path].values[0]
+            img = prep.imread(image)
+            r_img, (bbox, center, radius) = prep.crop_fov(img)
             list_resolution.append(resolution_)
-            img = prep.imread(dst_image)
-            r_img, borders, mask, r_img, radius_list,centre_list_w, centre_list_h = prep.process_without_gb(img,img,radius_list,centre_list_w, centre_list_h)
-            prep.imwrite(save_path + image_path.split('.')[0] + '.png', r_img)
-            name_list.append(image_path.split('.')[0] + '.png')
+            radius_list.append(radius)
+            centre_list_w.append(int(center[0]))
+            centre_list_h.append(int(center[1]))
+            prep.imwrite(save_path + output_name(image_path), r_img)
+            name_list.append(output_name(image_path))
         
         except:
             pass
@@ -39,13 +42,13 @@ def process(image_list, save_path):
     scale_list = [a*2/912 for a in radius_list]
     scale_resolution = [a*b*1000 for a,b in zip(list_resolution,scale_list)]
     Data4stage2 = pd.DataFrame({'Name':name_list, 'centre_w':centre_list_w, 'centre_h':centre_list_h, 'radius':radius_list, 'Scale':scale_list, 'Scale_resolution':scale_resolution})
-    Data4stage2.to_csv(f'{AUTOMORPH_DATA}/Results/M0/crop_info.csv', index = None, encoding='utf8')
+    merge_crop_info(Data4stage2.to_dict('records'))
 
 
 if __name__ == "__main__":
     if os.path.exists(f'{AUTOMORPH_DATA}/images/.ipynb_checkpoints'):
         shutil.rmtree(f'{AUTOMORPH_DATA}/images/.ipynb_checkpoints')
-    image_list = sorted(os.listdir(f'{AUTOMORPH_DATA}/images'))
+    image_list = sorted(pd.read_csv(f'{AUTOMORPH_DATA}/resolution_information.csv')['fundus'])
     save_path = f'{AUTOMORPH_DATA}/Results/M0/images/'
     if not os.path.exists(save_path):
         os.makedirs(save_path)
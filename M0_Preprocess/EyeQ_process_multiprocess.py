@@ -1,7 +1,13 @@
 import fundus_prep as prep
+import fundus_cache
+import fundus_source
+import cv2
+import itertools
 import os
 import pandas as pd
 import shutil
+import threading
+import time
 
 from tqdm import tqdm
 from multiprocessing import Pool, cpu_count, Manager
@@ -14,66 +20,287 @@ ImageFile.LOAD_TRUNCATED_IMAGES = True
 warnings.filterwarnings("ignore")
 
 AUTOMORPH_DATA = os.getenv("AUTOMORPH_DATA", "..")
+# crop_info rows written to crop_info.csv at once while M0 runs
+FLUSH_EVERY = 1000
+# decode large JPEGs downscaled, see prep.imread_reduced. crop_info is then
+# approximate to about decode_factor pixels, see crop_fundus, and the images
+# where that is above prep.REDUCED_TOLERANCE are decoded again in full
+REDUCED_DECODE = os.getenv("AUTOMORPH_REDUCED_DECODE", "0") == "1"
+# also write the crops resized for M1/M2 to Results/M0/cache, for every stage
+# ("1") or the stages listed, e.g. "M1,vessel", see fundus_cache.cache_keys
+M0_CACHE = fundus_cache.cache_keys(os.getenv("AUTOMORPH_M0_CACHE", "0"))
+CACHE_DIR = f"{AUTOMORPH_DATA}/Results/M0/cache"
+# number of M0 workers, sized from the cores and memory when unset
+M0_WORKERS = int(os.getenv("AUTOMORPH_M0_WORKERS") or 0) or None
+# peak memory of a worker cropping a large (~24 MP) fundus photograph
+WORKER_MEMORY = 512 << 20
+# a pool task holds about CHUNK_SECONDS of work, so that sending it to a worker
+# costs little, and at most MAX_CHUNK images, so that the workers stay balanced
+CHUNK_SECONDS = 0.2
+MAX_CHUNK = 8
+
+
+def read_fundus(image_path, reduced=REDUCED_DECODE):
+    """RGB image of a path or encoded bytes and the downscaling it was decoded with"""
+    if reduced:
+        return prep.imread_reduced(image_path)
+    return prep.imread(image_path), 1
+
+
+def read_and_crop(image_path, resolution_, reduced=REDUCED_DECODE):
+    """
+    read_fundus and crop_fundus. A reduced decode whose crop_info would be off
+    by more than prep.REDUCED_TOLERANCE is refused, the image is decoded again
+    in full
+    """
+    img, factor = read_fundus(image_path, reduced)
+    r_img, crop_info = crop_fundus(img, resolution_, factor)
+    if not prep.reduced_within_tolerance(factor, crop_info["radius"]):
+        img, factor = read_fundus(image_path, False)
+        r_img, crop_info = crop_fundus(img, resolution_, factor)
+    return r_img, crop_info
+
+
+def crop_fundus(img, resolution_, factor=1):
+    """
+    Crop the fundus of an RGB image and return it with its crop_info fields.
+    ``factor`` is the downscaling the image was decoded with (prep.imread_reduced):
+    the crop keeps that scale, crop_info is in full resolution pixels. The FOV
+    is only found on the reduced image, so the centre is within one ``factor``
+    step and the radius half a step of those of a full decode, and Scale and
+    Scale_resolution are approximate to the same relative amount (see
+    prep.REDUCED_TOLERANCE and read_and_crop). crop_info records the factor in
+    decode_factor
+    """
+    r_img, (bbox, center, radius) = prep.crop_fov(img)
+    center = [(c + 0.5) * factor - 0.5 for c in center]
+    radius = radius * factor
+
+    # Calculate scale
+    scale = radius * 2 / 912
+    scale_resolution = resolution_ * scale * 1000
+
+    return r_img, {
+        "centre_w": int(center[0]),
+        "centre_h": int(center[1]),
+        "radius": radius,
+        "Scale": scale,
+        "Scale_resolution": scale_resolution,
+        "decode_factor": factor,
+    }
+
+
+def output_name(image_path):
+    """Name of the crop of an image in Results/M0/images and crop_info.csv"""
+    return image_path.split(".")[0] + ".png"
+
+
+def pending_images(image_list, save_path):
+    """
+    Images without a crop: no <stem>.png in save_path, or no crop_info row for
+    it (the run stopped between writing the crop and its row). One directory
+    scan and one read of crop_info.csv
+    """
+    with os.scandir(save_path) as entries:
+        cropped = {entry.name for entry in entries}
+    crop_info_path = f"{AUTOMORPH_DATA}/Results/M0/crop_info.csv"
+    if os.path.exists(crop_info_path):
+        cropped &= set(pd.read_csv(crop_info_path, usecols=["Name"])["Name"])
+    else:
+        cropped = set()
+    return [image for image in image_list if output_name(image) not in cropped]
 
 
-def process_single_image(args):
-    """Process a single image"""
-    image_path, save_path, resolution_dict = args
+def merge_crop_info(rows):
+    """
+    Add crop_info rows to crop_info.csv, replacing the earlier rows of the same
+    images. The file is rewritten to a temporary file and swapped in, so that an
+    interrupted run never leaves it truncated
+    """
+    if not rows:
+        return
+    crop_info_path = f"{AUTOMORPH_DATA}/Results/M0/crop_info.csv"
+    df = pd.DataFrame(rows)
+    if os.path.exists(crop_info_path):
+        kept = pd.read_csv(crop_info_path)
+        df = pd.concat([kept[~kept["Name"].isin(df["Name"])], df], ignore_index=True)
+    df.to_csv(crop_info_path + ".tmp", index=None, encoding="utf8")
+    os.replace(crop_info_path + ".tmp", crop_info_path)
+
+
+def cache_slots(images):
+    """(chunk, row) of the M0 cache for every image, None without M0_CACHE"""
+    if not M0_CACHE:
+        return itertools.repeat(None, len(images))
+    # a chunk is only allocated once an image needs a row of it
+    return fundus_cache.chunk_slots(CACHE_DIR, M0_CACHE)
+
+
+def merge_results(rows):
+    """Merge processed rows into crop_info.csv and the cache index"""
+    merge_crop_info([{k: v for k, v in row.items() if k != "cache"} for row in rows])
+    fundus_cache.merge_index(
+        CACHE_DIR,
+        [row["cache"] for row in rows if "cache" in row],
+        names=[row["Name"] for row in rows],
+    )
+
+
+def available_cores():
+    """Cores this process may run on: its CPU affinity and cgroup CPU quota"""
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = cpu_count()
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cores = min(cores, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return cores
 
-    # Skip if already processed
-    if os.path.exists(f"{AUTOMORPH_DATA}/Results/M0/images/" + image_path):
-        return None
 
+def available_memory():
+    """MemAvailable of /proc/meminfo in bytes, None where it is not known"""
     try:
-        dst_image = f"{AUTOMORPH_DATA}/images/" + image_path
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def worker_count():
+    """One worker per available core, as many as the available memory holds"""
+    workers = available_cores()
+    memory = available_memory()
+    if memory is not None:
+        workers = min(workers, max(1, memory // WORKER_MEMORY))
+    return workers
+
+
+class ChunkSizer:
+    """
+    Number of images of the next pool task, from the seconds per image the
+    workers measured. The first tasks hold one image; the last ones are split
+    over all the workers
+    """
+
+    def __init__(self, num_workers, total):
+        self.num_workers = num_workers
+        self.remaining = total
+        self.seconds = None
+
+    def update(self, seconds):
+        """Add the seconds per image of a finished task to the moving average"""
+        if self.seconds is None:
+            self.seconds = seconds
+        else:
+            self.seconds = 0.8 * self.seconds + 0.2 * seconds
+
+    def size(self):
+        if self.seconds is None:
+            return 1
+        size = min(
+            round(CHUNK_SECONDS / max(self.seconds, 1e-6)),
+            MAX_CHUNK,
+            -(-self.remaining // (2 * self.num_workers)),
+        )
+        return max(1, size)
+
+    def chunks(self, args):
+        chunk = []
+        for arg in args:
+            chunk.append(arg)
+            if len(chunk) >= self.size():
+                self.remaining -= len(chunk)
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def report_rate(count, seconds, num_workers=1):
+    print(
+        f"{count} images in {seconds:.1f}s, {count / max(seconds, 1e-9):.2f} images/s"
+        f" with {num_workers} worker{'s' if num_workers > 1 else ''}"
+    )
+
+
+def source_images(images, save_path, read_ahead=4):
+    """
+    (image_path, path or bytes, save_path, cache slot) of the images found in
+    the input source, for process_single_image. The images are read as they are
+    taken, at most ``read_ahead`` ahead of the results: call ``release`` for
+    every result, and ``stop`` before a pool reading them is terminated, which
+    would otherwise wait for its reading thread forever
+    """
+    slots = threading.Semaphore(read_ahead)
+    stopped = threading.Event()
+    source = fundus_source.open_source()
+
+    def generate():
+        for (image_path, image), slot in zip(source.read(images), cache_slots(images)):
+            slots.acquire()
+            if stopped.is_set():
+                return
+            yield image_path, image, save_path, slot
+
+    def stop():
+        stopped.set()
+        slots.release()
+
+    return generate(), slots.release, stop
+
 
+def process_single_image(args):
+    """Process a single image, ``image`` is its path or its encoded bytes"""
+    image_path, image, save_path, resolution_dict, cache_slot = args
+
+    try:
         # Get resolution
         resolution_ = resolution_dict.get(image_path, None)
         if resolution_ is None:
             return None
 
         # Process image
-        img = prep.imread(dst_image)
-        radius_list = []
-        centre_list_w = []
-        centre_list_h = []
-
-        r_img, borders, mask, r_img, radius_list, centre_list_w, centre_list_h = (
-            prep.process_without_gb(img, img, radius_list, centre_list_w, centre_list_h)
-        )
+        r_img, crop_info = read_and_crop(image, resolution_)
 
         # Save processed image
-        output_name = image_path.split(".")[0] + ".png"
-        prep.imwrite(save_path + output_name, r_img)
-
-        # Calculate scale
-        radius = radius_list[0] if radius_list else 0
-        scale = radius * 2 / 912
-        scale_resolution = resolution_ * scale * 1000
-
-        return {
-            "Name": output_name,
-            "centre_w": centre_list_w[0] if centre_list_w else 0,
-            "centre_h": centre_list_h[0] if centre_list_h else 0,
-            "radius": radius,
-            "Scale": scale,
-            "Scale_resolution": scale_resolution,
-        }
+        prep.imwrite(save_path + output_name(image_path), r_img)
+
+        result = {"Name": output_name(image_path), **crop_info}
+        if cache_slot is not None:
+            result["cache"] = fundus_cache.write_row(
+                CACHE_DIR, *cache_slot, save_path + output_name(image_path), r_img
+            )
+        return result
     except Exception as e:
         print(f"\nError processing {image_path}: {str(e)}")
         return None
 
 
-def init_worker(resolution_dict_):
-    """Initialize worker process with shared data"""
-    global resolution_dict
-    resolution_dict = resolution_dict_
+def init_worker(num_workers):
+    """Share the cores between the OpenCV threads of the workers"""
+    cv2.setNumThreads(max(1, available_cores() // num_workers))
+
 
+def process_chunk(chunk):
+    """Results of a chunk of process_single_image args and the seconds per image"""
+    start = time.perf_counter()
+    results = [process_single_image(args) for args in chunk]
+    return results, (time.perf_counter() - start) / len(chunk)
 
-def process_single_image_worker(image_path_and_save_path):
-    """Worker function that uses global resolution_dict"""
-    image_path, save_path = image_path_and_save_path
-    return process_single_image((image_path, save_path, resolution_dict))
+
+def with_resolution(sources, resolution_dict):
+    """process_single_image args with only the resolution of their image"""
+    for image_path, image, save_path, slot in sources:
+        resolution = {image_path: resolution_dict[image_path]}
+        yield image_path, image, save_path, resolution, slot
 
 
 def process_multiprocessing(image_list, save_path, num_workers=None):
@@ -84,44 +311,56 @@ def process_multiprocessing(image_list, save_path, num_workers=None):
     resolution_dict = dict(zip(resolution_df["fundus"], resolution_df["res"]))
 
     # Filter out already processed images
-    images_to_process = [
-        img
-        for img in image_list
-        if not os.path.exists(f"{AUTOMORPH_DATA}/Results/M0/images/" + img)
-    ]
+    images_to_process = pending_images(image_list, save_path)
 
     if not images_to_process:
         print("All images already processed!")
         return
 
-    # Set number of workers
+    # Set number of workers, one per core the memory allows
     if num_workers is None:
-        num_workers = min(cpu_count(), 8)  # Use max 8 cores to avoid memory issues
+        num_workers = worker_count()
 
     print(f"Processing {len(images_to_process)} images using {num_workers} workers...")
 
-    # Prepare arguments
-    args_list = [(img, save_path) for img in images_to_process]
+    # Prepare arguments, read while the workers run. A worker takes a chunk of
+    # images at a time, sized from the time the workers take per image
+    sources, release, stop = source_images(
+        images_to_process, save_path, 2 * MAX_CHUNK * num_workers
+    )
+    sizer = ChunkSizer(num_workers, len(images_to_process))
+    chunks = sizer.chunks(with_resolution(sources, resolution_dict))
 
     # Process with multiprocessing and progress bar
     results = []
+    start = time.perf_counter()
 
     # Method 1: Using imap with individual progress updates
     with Pool(
-        processes=num_workers, initializer=init_worker, initargs=(resolution_dict,)
+        processes=num_workers, initializer=init_worker, initargs=(num_workers,)
     ) as pool:
-        with tqdm(total=len(args_list), desc="Processing images", unit="img") as pbar:
-            for result in pool.imap_unordered(process_single_image_worker, args_list):
-                if result is not None:
-                    results.append(result)
-                pbar.update(1)
-
-    # Save results to CSV
+        try:
+            with tqdm(
+                total=len(images_to_process), desc="Processing images", unit="img"
+            ) as pbar:
+                for chunk_results, seconds in pool.imap_unordered(
+                    process_chunk, chunks
+                ):
+                    sizer.update(seconds)
+                    for result in chunk_results:
+                        release()
+                        if result is not None:
+                            results.append(result)
+                            if len(results) % FLUSH_EVERY == 0:
+                                merge_results(results[-FLUSH_EVERY:])
+                    pbar.update(len(chunk_results))
+        finally:
+            stop()
+    report_rate(len(images_to_process), time.perf_counter() - start, num_workers)
+
+    # Save the results not flushed yet to CSV
     if results:
-        df = pd.DataFrame(results)
-        df.to_csv(
-            f"{AUTOMORPH_DATA}/Results/M0/crop_info.csv", index=None, encoding="utf8"
-        )
+        merge_results(results[len(results) // FLUSH_EVERY * FLUSH_EVERY :])
         print(f"\nSuccessfully processed {len(results)} images")
     else:
         print("\nNo images were successfully processed")
@@ -135,11 +374,7 @@ def process_multiprocessing_alternative(image_list, save_path, num_workers=None)
     resolution_dict = dict(zip(resolution_df["fundus"], resolution_df["res"]))
 
     # Filter out already processed images
-    images_to_process = [
-        img
-        for img in image_list
-        if not os.path.exists(f"{AUTOMORPH_DATA}/Results/M0/images/" + img)
-    ]
+    images_to_process = pending_images(image_list, save_path)
 
     if not images_to_process:
         print("All images already processed!")
@@ -147,34 +382,46 @@ def process_multiprocessing_alternative(image_list, save_path, num_workers=None)
 
     # Set number of workers
     if num_workers is None:
-        num_workers = min(cpu_count(), 8)
+        num_workers = worker_count()
 
     print(f"Processing {len(images_to_process)} images using {num_workers} workers...")
 
-    # Prepare arguments
-    args_list = [(img, save_path, resolution_dict) for img in images_to_process]
+    # Prepare arguments, read while the workers run
+    sources, release, stop = source_images(
+        images_to_process, save_path, 4 * num_workers
+    )
+    args_list = with_resolution(sources, resolution_dict)
 
-    # Calculate optimal chunksize
-    chunksize = max(1, len(args_list) // (num_workers * 4))
+    # Calculate optimal chunksize, the images read ahead must fill the chunks
+    chunksize = min(4, max(1, len(images_to_process) // (num_workers * 4)))
+    start = time.perf_counter()
 
     # Process with multiprocessing
-    with Pool(processes=num_workers) as pool:
+    with Pool(
+        processes=num_workers, initializer=init_worker, initargs=(num_workers,)
+    ) as pool:
         results_iter = pool.imap(process_single_image, args_list, chunksize=chunksize)
         results = []
 
         # Manual progress bar update
-        with tqdm(total=len(args_list), desc="Processing images", unit="img") as pbar:
-            for result in results_iter:
-                if result is not None:
-                    results.append(result)
-                pbar.update(1)
-
-    # Save results to CSV
+        try:
+            with tqdm(
+                total=len(images_to_process), desc="Processing images", unit="img"
+            ) as pbar:
+                for result in results_iter:
+                    release()
+                    if result is not None:
+                        results.append(result)
+                        if len(results) % FLUSH_EVERY == 0:
+                            merge_results(results[-FLUSH_EVERY:])
+                    pbar.update(1)
+        finally:
+            stop()
+    report_rate(len(images_to_process), time.perf_counter() - start, num_workers)
+
+    # Save the results not flushed yet to CSV
     if results:
-        df = pd.DataFrame(results)
-        df.to_csv(
-            f"{AUTOMORPH_DATA}/Results/M0/crop_info.csv", index=None, encoding="utf8"
-        )
+        merge_results(results[len(results) // FLUSH_EVERY * FLUSH_EVERY :])
         print(f"\nSuccessfully processed {len(results)} images")
     else:
         print("\nNo images were successfully processed")
@@ -183,53 +430,38 @@ def process_multiprocessing_alternative(image_list, save_path, num_workers=None)
 def process_sequential(image_list, save_path):
     """Sequential processing with progress bar (fallback option)"""
 
-    radius_list = []
-    centre_list_w = []
-    centre_list_h = []
-    name_list = []
-    list_resolution = []
-    scale_resolution = []
-
-    resolution_list = pd.read_csv(f"{AUTOMORPH_DATA}/resolution_information.csv")
+    resolution_df = pd.read_csv(f"{AUTOMORPH_DATA}/resolution_information.csv")
+    resolution_dict = dict(zip(resolution_df["fundus"], resolution_df["res"]))
 
-    for image_path in tqdm(image_list, desc="Processing images", unit="img"):
-        dst_image = f"{AUTOMORPH_DATA}/images/" + image_path
-        if os.path.exists(f"{AUTOMORPH_DATA}/Results/M0/images/" + image_path):
-            continue
+    images_to_process = pending_images(image_list, save_path)
+    if not images_to_process:
+        print("All images already processed!")
+        return
 
-        try:
-            resolution_ = resolution_list["res"][
-                resolution_list["fundus"] == image_path
-            ].values[0]
-            list_resolution.append(resolution_)
-            img = prep.imread(dst_image)
-            r_img, borders, mask, r_img, radius_list, centre_list_w, centre_list_h = (
-                prep.process_without_gb(
-                    img, img, radius_list, centre_list_w, centre_list_h
-                )
-            )
-            prep.imwrite(save_path + image_path.split(".")[0] + ".png", r_img)
-            name_list.append(image_path.split(".")[0] + ".png")
-        except Exception as e:
-            print(f"\nError processing {image_path}: {str(e)}")
-
-    if name_list:
-        scale_list = [a * 2 / 912 for a in radius_list]
-        scale_resolution = [a * b * 1000 for a, b in zip(list_resolution, scale_list)]
-        Data4stage2 = pd.DataFrame(
-            {
-                "Name": name_list,
-                "centre_w": centre_list_w,
-                "centre_h": centre_list_h,
-                "radius": radius_list,
-                "Scale": scale_list,
-                "Scale_resolution": scale_resolution,
-            }
-        )
-        Data4stage2.to_csv(
-            f"{AUTOMORPH_DATA}/Results/M0/crop_info.csv", index=None, encoding="utf8"
+    results = []
+    start = time.perf_counter()
+    # read in this thread, nothing can wait on a slot after an error
+    sources, release, _ = source_images(images_to_process, save_path)
+    for image_path, image, _, slot in tqdm(
+        sources,
+        total=len(images_to_process),
+        desc="Processing images",
+        unit="img",
+    ):
+        release()
+        result = process_single_image(
+            (image_path, image, save_path, resolution_dict, slot)
         )
-        print(f"\nSuccessfully processed {len(name_list)} images")
+        if result is not None:
+            results.append(result)
+            if len(results) % FLUSH_EVERY == 0:
+                merge_results(results[-FLUSH_EVERY:])
+
+    report_rate(len(images_to_process), time.perf_counter() - start)
+
+    if results:
+        merge_results(results[len(results) // FLUSH_EVERY * FLUSH_EVERY :])
+        print(f"\nSuccessfully processed {len(results)} images")
 
 
 if __name__ == "__main__":
@@ -237,8 +469,9 @@ if __name__ == "__main__":
     if os.path.exists(f"{AUTOMORPH_DATA}/images/.ipynb_checkpoints"):
         shutil.rmtree(f"{AUTOMORPH_DATA}/images/.ipynb_checkpoints")
 
-    # Get image list
-    image_list = sorted(os.listdir(f"{AUTOMORPH_DATA}/images"))
+    # Get image list, as generate_resolution.py listed the input source
+    resolution_df = pd.read_csv(f"{AUTOMORPH_DATA}/resolution_information.csv")
+    image_list = sorted(resolution_df["fundus"])
     save_path = f"{AUTOMORPH_DATA}/Results/M0/images/"
 
     # Create output directory
@@ -247,7 +480,8 @@ if __name__ == "__main__":
 
     # Choose processing method
     use_multiprocessing = True  # Set to False to use sequential processing
-    num_workers = 32  # Set to None for auto-detection, or specify a number
+    # None sizes the pool from the cores and memory, AUTOMORPH_M0_WORKERS sets it
+    num_workers = M0_WORKERS
 
     if use_multiprocessing:
         # Use the main method (with imap_unordered for better performance)
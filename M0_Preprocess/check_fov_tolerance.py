@@ -0,0 +1,134 @@
+"""
+Check that the FOV detection of fundus_prep.get_mask (a circle fitted to the
+mask outline, coarse-to-fine on large images) gives the crop boxes of the full
+resolution search.
+
+The images of $AUTOMORPH_DATA/images are compared with the centre and radius
+of their row in Results/M0/crop_info.csv, written by an earlier M0 run, or with
+fundus_prep.get_mask_native when they have none (or with --native). Without
+images, synthetic ones of --sizes are used. Exits with 1 when a crop box is off
+by more than the tolerance: --centre pixels for the centre and, for the radius,
+half the gradient kernel get_mask_native measures the radius on, within which
+its estimate moves with the image size.
+
+With --reduced, large JPEGs are decoded downscaled as M0 does with
+--reduced-decode, and decoded again in full where M0 would refuse the reduced
+decode (fundus_prep.REDUCED_TOLERANCE). The centre tolerance then grows by the
+downscaling factor and the radius tolerance by half of it.
+"""
+import argparse
+import importlib.util
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+import fundus_prep as prep
+
+AUTOMORPH_DATA = os.getenv('AUTOMORPH_DATA', '..')
+
+
+def radius_tolerance(shape):
+    return max(shape[1] // 400 * 2 + 1, 3) // 2 + 1
+
+
+def native_fov(img):
+    _, _, center, radius = prep.get_mask_native(img)
+    return int(center[0]), int(center[1]), int(radius)
+
+
+def fov(img, factor=1):
+    """crop_info centre and radius of M0, from an image decoded downscaled by factor"""
+    _, center, radius = prep.get_fov(img)
+    center = [(c + 0.5) * factor - 0.5 for c in center]
+    return int(center[0]), int(center[1]), int(radius * factor)
+
+
+def synthetic_images(sizes):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    spec = importlib.util.spec_from_file_location(
+        'synthetic', os.path.join(root, 'automorph', 'synthetic.py'))
+    synthetic = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(synthetic)
+
+    for index, size in enumerate(sizes):
+        img, _ = synthetic.synthetic_fundus(size, seed=index)
+        # camera frames are wider than the FOV
+        yield f'synthetic_{size}', np.pad(img, ((0, 0), (size // 8, size // 8), (0, 0)))
+
+
+def data_images(image_dir):
+    for image_path in sorted(os.listdir(image_dir)):
+        yield image_path.split('.')[0], f'{image_dir}/{image_path}'
+
+
+def check(images, reference, centre_tolerance, reduced=False):
+    """images are (name, RGB array or path) pairs, paths are decoded as M0 does"""
+    rows = []
+    for name, image in tqdm(images):
+        try:
+            if not isinstance(image, str):
+                img, factor = image, 1
+            elif reduced:
+                img, factor = prep.imread_reduced(image)
+            else:
+                img, factor = prep.imread(image), 1
+            row = reference.get(name + '.png')
+            if row is None:
+                row = native_fov(img if factor == 1 else prep.imread(image))
+        except Exception as e:
+            print(f'cannot read {name}: {e}, skipped')
+            continue
+        centre_w, centre_h, radius = fov(img, factor)
+        if not prep.reduced_within_tolerance(factor, radius):
+            img, factor = prep.imread(image), 1
+            centre_w, centre_h, radius = fov(img, factor)
+        height, width = img.shape[0] * factor, img.shape[1] * factor
+        rows.append({
+            'Name': name,
+            'height': height,
+            'width': width,
+            'factor': factor,
+            'd_centre_w': centre_w - row[0],
+            'd_centre_h': centre_h - row[1],
+            'd_radius': radius - row[2],
+            'ok': max(abs(centre_w - row[0]), abs(centre_h - row[1]))
+            <= centre_tolerance + factor
+            and abs(radius - row[2]) <= radius_tolerance((height, width)) + factor // 2,
+        })
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--native', action='store_true',
+                        help='compare with get_mask_native even when crop_info.csv has the image')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 2000, 3000, 4000],
+                        help='sizes of the synthetic images used when there are no images')
+    parser.add_argument('--centre', type=int, default=3, help='centre tolerance in pixels')
+    parser.add_argument('--reduced', action='store_true',
+                        help='decode the images as M0 does with --reduced-decode')
+    args = parser.parse_args()
+
+    image_dir = f'{AUTOMORPH_DATA}/images'
+    if os.path.isdir(image_dir) and os.listdir(image_dir):
+        images = data_images(image_dir)
+    else:
+        images = synthetic_images(args.sizes)
+
+    reference = {}
+    crop_info = f'{AUTOMORPH_DATA}/Results/M0/crop_info.csv'
+    if os.path.exists(crop_info) and not args.native:
+        crop_info = pd.read_csv(crop_info)
+        reference = dict(zip(
+            crop_info['Name'],
+            zip(crop_info['centre_w'], crop_info['centre_h'], crop_info['radius']),
+        ))
+
+    result = check(images, reference, args.centre, args.reduced)
+    print(result.to_string(index=False))
+    failed = result[~result['ok']]
+    print(f'{len(result) - len(failed)}/{len(result)} crop boxes within tolerance')
+    sys.exit(1 if len(failed) else 0)
@@ -0,0 +1,171 @@
+"""
+Memory-mappable cache of the M0 crops, resized once for every M1 and M2 model.
+
+The test datasets of M1, M2_Vessel_seg, M2_Artery_vein and M2_lwnet_disc_cup
+each decode the M0 png and resize it to their own input size. When M0 writes
+this cache they slice their input out of a memory-mapped array instead, read
+with load_m0_cache.
+
+Results/M0/cache/
+    index.csv           Name, chunk, row, width and height of the crop and
+                        the mtime of its png
+    <key>/<chunk>.npy   uint8 (CHUNK_ROWS, size, size, 3) crops of an M0 run,
+                        resized as the dataset of <key> resizes the png
+
+Only the keys of the stages that will read them are written (cache_keys). An
+M0 run writes its crops to new chunks of CHUNK_ROWS rows, and index.csv points
+an image at its latest row. A row is only used while its png keeps the mtime
+it had when the row was written. Once index.csv no longer points at any row of
+a chunk, the chunk is deleted. A key takes size x size x 3 bytes per image,
+2.5 GB per 1000 images for 912x912_bicubic.
+"""
+import functools
+import glob
+import itertools
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+CACHE_SIZES = {
+    # <width>x<height>_<filter>: (size, PIL filter) of the dataset reading it
+    "512x512_bicubic": (512, Image.BICUBIC),  # M1 BasicDataset_OUT
+    "912x912_bicubic": (912, Image.BICUBIC),  # M2_Vessel_seg SEDataset_out
+    "720x720_bicubic": (720, Image.BICUBIC),  # M2_Artery_vein LearningAVSegData_OOD
+    "512x512_bilinear": (512, Image.BILINEAR),  # M2_lwnet_disc_cup TestDataset
+}
+# the key each stage reads, as named by the runner
+STAGE_KEYS = {
+    'M1': '512x512_bicubic',
+    'vessel': '912x912_bicubic',
+    'artery_vein': '720x720_bicubic',
+    'disc_cup': '512x512_bilinear',
+}
+# crops per chunk, 640 MB for 912x912_bicubic (sparse until written)
+CHUNK_ROWS = 256
+# chunks created by this process, its M0 run may not have indexed them yet
+_created_chunks = set()
+_chunk_numbers = itertools.count()
+
+
+def cache_keys(stages):
+    """
+    Keys of the cache for the AUTOMORPH_M0_CACHE setting: "0" for none, "1" for
+    every stage, or the stages that will read it separated by commas, e.g.
+    "M1,vessel"
+    """
+    if stages.strip() in ('', '0'):
+        return ()
+    if stages.strip() == '1':
+        return tuple(CACHE_SIZES)
+    keys = []
+    for stage in stages.split(','):
+        if stage.strip() not in STAGE_KEYS:
+            raise ValueError(f'unknown stage {stage!r} in AUTOMORPH_M0_CACHE, '
+                             f'expected 0, 1 or some of {", ".join(STAGE_KEYS)}')
+        keys.append(STAGE_KEYS[stage.strip()])
+    return tuple(dict.fromkeys(keys))
+
+
+def create_chunk(cache_dir, keys, count=CHUNK_ROWS):
+    """Allocate the arrays of keys for a chunk of count crops and return its name"""
+    chunk = time.strftime('%Y%m%d%H%M%S') + f'_{os.getpid()}_{next(_chunk_numbers)}'
+    for key in keys:
+        size, _ = CACHE_SIZES[key]
+        os.makedirs(f'{cache_dir}/{key}', exist_ok=True)
+        # sparse until the rows are written
+        np.lib.format.open_memmap(f'{cache_dir}/{key}/{chunk}.npy', mode='w+',
+                                  dtype=np.uint8, shape=(count, size, size, 3))
+    _created_chunks.add(chunk)
+    return chunk
+
+
+def chunk_slots(cache_dir, keys):
+    """(chunk, row) slots for one image after the other, in new chunks of CHUNK_ROWS"""
+    while True:
+        chunk = create_chunk(cache_dir, keys)
+        for row in range(CHUNK_ROWS):
+            yield chunk, row
+
+
+@functools.lru_cache(maxsize=4)
+def _chunk_arrays(cache_dir, chunk):
+    # opened once per process, workers included
+    paths = {key: f'{cache_dir}/{key}/{chunk}.npy' for key in CACHE_SIZES}
+    return {key: np.load(path, mmap_mode='r+')
+            for key, path in paths.items() if os.path.exists(path)}
+
+
+def write_row(cache_dir, chunk, row, png_path, r_img):
+    """
+    Write the resized crops of r_img (RGB), saved to png_path, to row of chunk
+    and return its index row
+    """
+    pil_img = Image.fromarray(r_img)
+    for key, array in _chunk_arrays(cache_dir, chunk).items():
+        size, resample = CACHE_SIZES[key]
+        array[row] = np.asarray(pil_img.resize((size, size), resample))
+    return {'Name': os.path.basename(png_path), 'chunk': chunk, 'row': row,
+            'width': r_img.shape[1], 'height': r_img.shape[0],
+            'mtime': os.stat(png_path).st_mtime_ns}
+
+
+def merge_index(cache_dir, rows, names=()):
+    """
+    Point the images of rows at their new rows and drop the rows of the other
+    images in names (cropped again without the cache), atomically as
+    crop_info.csv
+    """
+    index_path = f'{cache_dir}/index.csv'
+    if not os.path.exists(index_path) and not rows:
+        return
+    df = pd.DataFrame(rows)
+    if os.path.exists(index_path):
+        kept = pd.read_csv(index_path, dtype={'chunk': str})
+        replaced = set(names) | set(row['Name'] for row in rows)
+        df = pd.concat([kept[~kept['Name'].isin(replaced)], df], ignore_index=True)
+    df.to_csv(index_path + '.tmp', index=None, encoding='utf8')
+    os.replace(index_path + '.tmp', index_path)
+    prune_chunks(cache_dir, set(df['chunk'].astype(str)) if len(df) else set())
+
+
+def prune_chunks(cache_dir, indexed):
+    """Delete the chunks of every key that are not in indexed nor being written"""
+    for key in CACHE_SIZES:
+        for path in glob.glob(f'{cache_dir}/{key}/*.npy'):
+            chunk = os.path.basename(path)[:-len('.npy')]
+            if chunk not in indexed and chunk not in _created_chunks:
+                os.remove(path)
+
+
+def load_m0_cache(imgs_dir, key):
+    """
+    Crops of imgs_dir that M0 also wrote to its cache, resized for key, as
+    {id: (memory-mapped uint8 array, width, height)}. Empty without a cache,
+    crops whose png changed since are left out. Read by the test datasets of
+    M1 and M2
+    """
+    cache_dir = os.path.join(imgs_dir, '..', 'cache')
+    index_path = os.path.join(cache_dir, 'index.csv')
+    if not os.path.exists(index_path) or not os.path.isdir(os.path.join(cache_dir, key)):
+        return {}
+    index = pd.read_csv(index_path, dtype={'chunk': str})
+    # None for the chunks of runs that did not cache key
+    arrays = {}
+    cache = {}
+    for name, chunk, row, width, height, mtime in index[
+        ['Name', 'chunk', 'row', 'width', 'height', 'mtime']
+    ].itertuples(index=False):
+        png_path = os.path.join(imgs_dir, name)
+        if not os.path.exists(png_path) or os.stat(png_path).st_mtime_ns != mtime:
+            continue
+        if chunk not in arrays:
+            chunk_path = os.path.join(cache_dir, key, chunk + '.npy')
+            arrays[chunk] = (np.load(chunk_path, mmap_mode='r')
+                             if os.path.exists(chunk_path) else None)
+        if arrays[chunk] is None:
+            continue
+        cache[os.path.splitext(name)[0]] = (arrays[chunk][row], width, height)
+    return cache
@@ -1,22 +1,86 @@
+import io
 import numpy as np
 import os
 import cv2
+from PIL import Image
+
+# largest size a later stage resizes the M0 crop to (vessel and artery/vein)
+DECODE_SIZE = 912
+# shorter image side per FOV diameter allowed for when reducing a JPEG decode
+FOV_MARGIN = 1.25
+# error of the FOV found on a reduced decode, relative to its radius, above
+# which M0 decodes the image in full. check_fov_tolerance.py --reduced measures
+# the error at up to one decode_factor step on the centre and half a step on
+# the radius, 0.1% of the radius on 2300 to 6000 pixel images
+REDUCED_TOLERANCE = 0.0025
+REDUCED_FLAGS = {
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+}
+
+
+def _imread(file_path, flags=cv2.IMREAD_COLOR):
+    # file_path can also be the bytes of an encoded image (see fundus_source)
+    if isinstance(file_path, bytes):
+        return cv2.imdecode(np.frombuffer(file_path, np.uint8), flags)
+    return cv2.imread(file_path, flags)
 
 
 def imread(file_path, c=None):
     if c is None:
-        im = cv2.imread(file_path)
+        im = _imread(file_path)
     else:
-        im = cv2.imread(file_path, c)
+        im = _imread(file_path, c)
 
     if im is None:
-        raise 'Can not read image'
+        raise IOError('Can not read image')
 
     if im.ndim == 3 and im.shape[2] == 3:
         im = cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
     return im
 
 
+def decode_factor(file_path, size=DECODE_SIZE):
+    """
+    Largest JPEG DCT downscaling (8, 4 or 2) that leaves room for a FOV of at
+    least size pixels across, 1 when there is none or the file is not a JPEG
+    """
+    if isinstance(file_path, bytes):
+        file_path = io.BytesIO(file_path)
+    with Image.open(file_path) as im:  # only reads the header
+        if im.format != 'JPEG':
+            return 1
+        short = min(im.size)
+    for factor in REDUCED_FLAGS:
+        if short/factor >= size*FOV_MARGIN:
+            return factor
+    return 1
+
+
+def imread_reduced(file_path, size=DECODE_SIZE):
+    """
+    imread of an RGB image, with large JPEGs downscaled by decode_factor while
+    they are decoded. Returns the image and the factor: pixel positions and
+    lengths of the full resolution image are factor times larger
+    """
+    factor = decode_factor(file_path, size)
+    if factor == 1:
+        return imread(file_path), 1
+    im = _imread(file_path, REDUCED_FLAGS[factor])
+    if im is None:
+        raise IOError('Can not read image')
+    return cv2.cvtColor(im, cv2.COLOR_BGR2RGB), factor
+
+
+def reduced_within_tolerance(factor, radius):
+    """
+    Whether a FOV of radius (full resolution pixels) found on an image decoded
+    downscaled by factor is within REDUCED_TOLERANCE of the full decode
+    """
+    return factor == 1 or factor/radius <= REDUCED_TOLERANCE
+
+
 def imwrite(file_path, image):
     if image.ndim == 3 and image.shape[2] == 3:
         image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
@@ -29,7 +93,7 @@ def fold_dir(folder):
     return folder
 
 
-def get_mask_BZ(img):
+def get_mask_BZ(img, ksize=20):
     if img.ndim==3:
         gray_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     else:
@@ -49,7 +113,7 @@ def get_mask_BZ(img):
     _,new_mask,_,_ = cv2.floodFill(new_mask, nn_mask, (0,0), (0), cv2.FLOODFILL_MASK_ONLY)
     _,new_mask,_,_ = cv2.floodFill(new_mask, nn_mask, (new_mask.shape[1]-1,new_mask.shape[0]-1), (0), cv2.FLOODFILL_MASK_ONLY)
     mask = mask + new_mask
-    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (20,  20))
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (ksize,  ksize))
     mask = cv2.erode(mask, kernel)
     mask = cv2.dilate(mask, kernel)
     return mask
@@ -87,7 +151,12 @@ def _get_circle_by_center_bbox(shape,center,bbox,radius):
     return center_mask
 
 
-def get_mask(img):
+def get_mask_native(img):
+    """
+    FOV mask, bbox, center and radius found on the full resolution image with
+    the row/column sum centre and the gradient histogram radius, the reference
+    check_fov_tolerance.py compares get_fov with
+    """
     if img.ndim ==3:
         #raise 'image dim is not 3'
         g_img=cv2.cvtColor(img,cv2.COLOR_RGB2GRAY)
@@ -121,6 +190,143 @@ def get_mask(img):
     return tmp_mask,bbox,center,radius
 
 
+# larger images are searched downscaled to this size and the circle is refined
+# at full resolution
+COARSE_SIZE = 1000
+# images up to COARSE_MAX_SCALE * COARSE_SIZE (1500 px) are searched at full
+# resolution: their downscaled copy would still hold over 44% of the pixels,
+# too few saved to pay for the resize and the refinement band
+COARSE_MAX_SCALE = 1.5
+# half width of the band around the coarse circle, in coarse pixels
+REFINE_BAND = 3
+
+
+def _fit_circle(y, x):
+    # algebraic least squares fit of x^2+y^2 = a*x + b*y + c
+    A = np.stack([x, y, np.ones_like(x)], axis=1)
+    a, b, c = np.linalg.lstsq(A, x**2 + y**2, rcond=None)[0]
+    cx, cy = a/2, b/2
+    return [cy, cx], np.sqrt(c + cx**2 + cy**2)
+
+
+def _fit_circle_robust(y, x):
+    # refit without the points far off the circle, 3 times the median residual
+    for _ in range(2):
+        center, radius = _fit_circle(y, x)
+        residual = np.abs(np.hypot(y-center[0], x-center[1]) - radius)
+        inlier = residual < max(2.0, 3*np.median(residual))
+        if inlier.all() or inlier.sum() < 32:
+            break
+        y, x = y[inlier], x[inlier]
+    return center, radius
+
+
+def _get_circle_by_contour(mask):
+    """
+    center and radius of the edge of a FOV mask, fitted to the outline of its
+    largest region. The outline points on the image border, where the frame
+    clips the FOV, are left out, so the work grows with the outline length
+    """
+    h, w = mask.shape
+    contours = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)[-2]
+    if not contours:
+        raise ValueError('no FOV found')
+    contour = max(contours, key=cv2.contourArea)
+    x, y = contour[:, 0, 0].astype(np.float64), contour[:, 0, 1].astype(np.float64)
+    # findContours takes the pixels of the image border for background
+    keep = (x > 1) & (x < w-2) & (y > 1) & (y < h-2)
+    if keep.sum() < 32:
+        # the FOV fills the frame, the circle inscribed in it
+        l, t, bw, bh = cv2.boundingRect(contour)
+        return [t+(bh-1)/2, l+(bw-1)/2], min(bw, bh)/2
+    center, radius = _fit_circle_robust(y[keep], x[keep])
+    # the outline runs through the centres of the edge pixels
+    return center, radius + 0.5
+
+
+def _refine_circle_in_band(g_img, center, radius, threshold, band):
+    """
+    Refine a circle estimate on the full resolution gray image, looking only at
+    a band of +-band pixels around it: the FOV edge is the outermost point above
+    threshold along each ray, rays leaving the image before the edge are dropped
+    """
+    h, w = g_img.shape
+    n = max(int(2*np.pi*(radius+band)), 360)
+    theta = np.linspace(0, 2*np.pi, n, endpoint=False)
+    radii = np.arange(radius-band, radius+band+1, dtype=np.float64)
+    sin, cos = np.sin(theta)[:, None], np.cos(theta)[:, None]
+    map_y = (center[0] + sin*radii).astype(np.float32)
+    map_x = (center[1] + cos*radii).astype(np.float32)
+    profile = cv2.remap(g_img, map_x, map_y, cv2.INTER_NEAREST,
+                        borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    inside = profile > threshold
+    last = inside.shape[1]-1-np.argmax(inside[:, ::-1], axis=1)
+    edge = radii[last]+0.5
+    y = center[0] + sin[:, 0]*edge
+    x = center[1] + cos[:, 0]*edge
+    keep = inside.any(axis=1) & ~inside[:, -1] & (x > 1) & (x < w-2) & (y > 1) & (y < h-2)
+    if keep.sum() < 32:
+        return center, radius
+    return _fit_circle_robust(y[keep], x[keep])
+
+
+def get_fov(img):
+    """
+    bbox, center and radius of the FOV, as get_mask returns them, without
+    drawing the full resolution mask. The circle is fitted to the outline of
+    the get_mask_BZ mask. Images larger than COARSE_MAX_SCALE * COARSE_SIZE are
+    searched on a copy downscaled to COARSE_SIZE, then the circle is refined
+    at full resolution in a thin band around it. Both find the circle of a
+    synthetic FOV within a pixel and get_mask_native's centre within two, its
+    radius within 0.5%, as tests/test_fov.py checks
+    """
+    if img.ndim ==3:
+        g_img=cv2.cvtColor(img,cv2.COLOR_RGB2GRAY)
+    elif img.ndim == 2:
+        g_img =img
+    else:
+        raise ValueError('image dim is not 1 or 3')
+    h,w = g_img.shape
+    scale = max(h, w)/COARSE_SIZE
+    if scale <= COARSE_MAX_SCALE:
+        tg_img = cv2.normalize(g_img, None, 0, 255, cv2.NORM_MINMAX)
+        center, radius = _get_circle_by_contour(get_mask_BZ(tg_img))
+        return _fov_bbox(h, w, center, radius)
+
+    c_img = cv2.resize(g_img, (round(w/scale), round(h/scale)), interpolation=cv2.INTER_AREA)
+    lo, hi = float(g_img.min()), float(g_img.max())
+    tc_img = cv2.normalize(c_img, None, 0, 255, cv2.NORM_MINMAX)
+    c_mask = get_mask_BZ(tc_img, ksize=max(int(round(20/scale)), 3))
+    center, radius = _get_circle_by_contour(c_mask)
+    center = [(center[0]+0.5)*scale-0.5, (center[1]+0.5)*scale-0.5]
+    radius = radius*scale
+
+    # threshold of get_mask_BZ on the min-max normalised image, in gray levels
+    span = max(hi-lo, 1)/255
+    threshold = lo + max(5, (cv2.mean(g_img)[0]-lo)/span/3-5)*span
+    center, radius = _refine_circle_in_band(g_img, center, radius, threshold,
+                                            int(np.ceil(REFINE_BAND*scale))+2)
+    return _fov_bbox(h, w, center, radius)
+
+
+def _fov_bbox(h, w, center, radius):
+    # bbox, center and radius as get_mask_native rounds them, without the
+    # rounding errors of the fits that int() would truncate to the pixel below
+    center = [round(float(center[0]), 6), round(float(center[1]), 6)]
+    radius = int(round(radius))
+    s_h = max(0,int(center[0] - radius))
+    s_w = max(0, int(center[1] - radius))
+    bbox = (s_h, s_w, min(h-s_h,2 * radius), min(w-s_w,2 * radius))
+    return bbox,center,radius
+
+
+def get_mask(img):
+    """FOV mask, bbox, center and radius, see get_fov"""
+    bbox,center,radius = get_fov(img)
+    tmp_mask=_get_circle_by_center_bbox(img.shape[:2],center,bbox,radius)
+    return tmp_mask,bbox,center,radius
+
+
 def mask_image(img,mask):
     img[mask<=0,...]=0
     return img
@@ -182,3 +388,28 @@ def process_without_gb(img, label,radius_list,centre_list_w, centre_list_h):
     centre_list_h.append(int(center[1]))
     return r_img,borders,(mask*255).astype(np.uint8),label, radius_list,centre_list_w, centre_list_h
 
+
+def crop_fov(img, fov=None, out=None):
+    """
+    Inference only process_without_gb: the FOV of img, blacked out around the
+    circle and centred on a black square, as process_without_gb returns it.
+    img is left untouched and the result is written into a single buffer: out
+    when it has the right shape and dtype, so that a caller can reuse it across
+    images, a new array otherwise. fov skips the search when the (bbox, center,
+    radius) of get_fov are already known. Returns the square image and them
+    """
+    bbox,center,radius = get_fov(img) if fov is None else fov
+    s_h,s_w,h,v = bbox
+    max_l = max(h,v)
+    shape = (max_l,max_l)+img.shape[2:]
+    if out is None or out.shape != shape or out.dtype != img.dtype:
+        out = np.zeros(shape,dtype=img.dtype)
+    else:
+        out[...] = 0
+    # same offsets as supplemental_black_area
+    t,l = int(max_l/2-h/2),int(max_l/2-v/2)
+    # the circle of get_mask drawn on the bbox only
+    mask = np.zeros((h,v),np.uint8)
+    cv2.circle(mask,(int(center[1])-s_w,int(center[0])-s_h),int(radius),1,-1)
+    cv2.copyTo(img[s_h:s_h+h,s_w:s_w+v],mask,out[t:t+h,l:l+v])
+    return out,(bbox,center,radius)
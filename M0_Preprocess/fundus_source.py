@@ -0,0 +1,118 @@
+"""
+Input images of M0: the files of a directory, or the members of a tar or zip
+archive read without extracting it.
+
+AUTOMORPH_IMAGES names the input, $AUTOMORPH_DATA/images by default. It can be
+a directory, a .zip, or a .tar (also .tar.gz, .tgz, .tar.bz2 or .tar.xz)
+archive. A member is named by its base name, the name it would have in the
+images directory once extracted flat. So resolution_information.csv and
+crop_info.csv name the images as before. Directories, hidden files and
+__MACOSX entries of archives are left out.
+
+Archives are read front to back, once per pass: generate_resolution.py lists
+the members, then M0 streams the bytes of the members it still has to crop to
+its workers, which decode them in memory.
+
+Archives are read by the M0 scripts only. The `python -m automorph` runner
+hashes, deduplicates and crops image files by path, and refuses an
+AUTOMORPH_IMAGES other than the $AUTOMORPH_DATA/images directory.
+"""
+import os
+import tarfile
+import zipfile
+from collections import Counter
+
+AUTOMORPH_DATA = os.getenv('AUTOMORPH_DATA', '..')
+IMAGES = os.getenv('AUTOMORPH_IMAGES', f'{AUTOMORPH_DATA}/images')
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+
+def member_name(path):
+    """Image name of an archive member, None for the entries that are not images"""
+    parts = [part for part in path.replace('\\', '/').split('/') if part not in ('', '.')]
+    if not parts or any(part.startswith('.') or part == '__MACOSX' for part in parts):
+        return None
+    return parts[-1]
+
+
+class DirectorySource:
+    def __init__(self, path):
+        self.path = path
+
+    def names(self):
+        return sorted(os.listdir(self.path))
+
+    def read(self, names):
+        """(name, path) of the images in names, workers read the files themselves"""
+        with os.scandir(self.path) as entries:
+            found = {entry.name for entry in entries}
+        for name in names:
+            if name in found:
+                yield name, f'{self.path}/{name}'
+
+
+class ArchiveSource:
+    def __init__(self, path):
+        self.path = path
+
+    def members(self):
+        """(name, member) of the image files in archive order"""
+        raise NotImplementedError
+
+    def names(self):
+        names = [name for name, _ in self.members()]
+        repeated = sorted(name for name, count in Counter(names).items() if count > 1)
+        if repeated:
+            raise ValueError(f'{self.path} has several images named {repeated[:5]}')
+        return sorted(names)
+
+    def read(self, names):
+        """(name, bytes) of the images in names, in archive order"""
+        wanted = set(names)
+        for name, data in self.stream(wanted):
+            wanted.discard(name)
+            yield name, data
+
+
+class TarSource(ArchiveSource):
+    def members(self):
+        with tarfile.open(self.path, 'r|*') as tar:  # one pass, no seeks
+            for member in tar:
+                name = member_name(member.name)
+                if member.isfile() and name:
+                    yield name, member
+
+    def stream(self, wanted):
+        with tarfile.open(self.path, 'r|*') as tar:
+            for member in tar:
+                name = member_name(member.name)
+                if member.isfile() and name in wanted:
+                    yield name, tar.extractfile(member).read()
+
+
+class ZipSource(ArchiveSource):
+    def members(self):
+        with zipfile.ZipFile(self.path) as archive:
+            infos = sorted(archive.infolist(), key=lambda info: info.header_offset)
+        for info in infos:
+            name = member_name(info.filename)
+            if not info.is_dir() and name:
+                yield name, info
+
+    def stream(self, wanted):
+        with zipfile.ZipFile(self.path) as archive:
+            # in file order, so that the reads go front to back
+            for info in sorted(archive.infolist(), key=lambda info: info.header_offset):
+                name = member_name(info.filename)
+                if not info.is_dir() and name in wanted:
+                    yield name, archive.read(info)
+
+
+def open_source(path=IMAGES):
+    if os.path.isdir(path):
+        return DirectorySource(path)
+    if path.lower().endswith(TAR_SUFFIXES):
+        return TarSource(path)
+    if path.lower().endswith('.zip'):
+        return ZipSource(path)
+    raise ValueError(f'{path} is not a directory, a tar or a zip archive')
@@ -0,0 +1,79 @@
+"""
+Adaptive evaluation of the M1 ensemble: the members run one after the other and
+an image stops once its good/bad quality_label is settled.
+
+Only torch is needed, not the member architectures.
+"""
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+def settled(softmax, total, z=3.0):
+    """
+    Whether the quality_label of every image is settled by the softmax of the
+    members run so far (member x image x class): the running mean softmax lies
+    more than ``z`` standard errors from each threshold of quality_label. The
+    standard errors are corrected for drawing the members from ``total``, they
+    vanish once every member ran
+    """
+    count = softmax.shape[0]
+    if count >= total:
+        return torch.ones(softmax.shape[1], dtype=torch.bool, device=softmax.device)
+    correction = ((total - count) / (total - 1)) ** 0.5
+
+    def above(values, threshold=0.0):
+        error = values.std(dim=0, correction=1) / count**0.5 * correction
+        return values.mean(dim=0) - threshold > z * error
+
+    def below(values, threshold=0.0):
+        return above(-values, -threshold)
+
+    good, usable, bad = softmax.unbind(dim=2)
+    # good: Prediction 0, or Prediction 1 with softmax_bad < 0.25, which a
+    # softmax_bad below 0.25 already implies
+    is_good = below(bad, 0.25) | (above(good - usable) & above(good - bad))
+    is_bad = above(bad, 0.25) & (above(usable - good) | above(bad - good))
+    return is_good | is_bad
+
+
+def adaptive_predict(models, imgs, z=3.0, min_members=3):
+    """
+    ensemble_predict running the members one after the other, each on the
+    images whose quality_label is not yet settled after ``min_members``. The
+    statistics of an image are those of the members it ran through, whose
+    number is also returned
+    """
+    if not hasattr(models, "__iter__"):
+        raise ValueError("the ONNX graph runs every member, adaptive needs torch")
+    members = list(models)
+    total = len(members)
+    prediction_softmax = torch.zeros(total, imgs.shape[0], 3, device=imgs.device)
+    used = torch.zeros(imgs.shape[0], dtype=torch.long, device=imgs.device)
+    active = torch.arange(imgs.shape[0], device=imgs.device)
+    for index, model_fl in enumerate(members):
+        prediction_softmax[index, active] = nn.Softmax(dim=1)(
+            model_fl(imgs[active]).float()
+        )
+        used[active] += 1
+        if index + 1 >= min_members:
+            active = active[
+                ~settled(prediction_softmax[: index + 1, active], total, z)
+            ]
+            if not len(active):
+                break
+    ran = (torch.arange(total, device=imgs.device)[:, None] < used)[..., None]
+    mean = (prediction_softmax * ran).sum(dim=0) / used[:, None]
+    std = (((prediction_softmax - mean) ** 2 * ran).sum(dim=0) / used[:, None]).sqrt()
+    prediction_decode = mean.argmax(dim=1, keepdim=True)
+    summary = (
+        torch.cat([mean, std, prediction_decode.float(), used[:, None].float()], dim=1)
+        .cpu()
+        .numpy()
+    )
+    return (
+        summary[:, :3],
+        summary[:, 3:6],
+        summary[:, 6].astype(np.int64),
+        summary[:, 7].astype(np.int64),
+    )
@@ -10,6 +10,16 @@ from PIL import Image, ImageEnhance
 import pandas as pd
 from os.path import splitext
 from os import listdir
+import os
+import importlib.util
+
+# the reader of the M0 cache is shared by every stage, loaded from its file as
+# M0_Preprocess is not a package
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_spec = importlib.util.spec_from_file_location(
+    'fundus_cache', os.path.join(_root, 'M0_Preprocess', 'fundus_cache.py'))
+fundus_cache = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(fundus_cache)
 
 
 class BasicDataset(Dataset):
@@ -85,8 +95,6 @@ class BasicDataset(Dataset):
         }
 
 
-
-
 class BasicDataset_OUT(Dataset):
     'Characterizes a dataset for PyTorch'
     def __init__(self, image_dir, image_size, n_classes, train_or):
@@ -98,6 +106,7 @@ class BasicDataset_OUT(Dataset):
         
         self.ids = [splitext(file)[0] for file in sorted(listdir(image_dir))
                     if not file.startswith('.')]
+        self.cache = fundus_cache.load_m0_cache(image_dir, f'{image_size[0]}x{image_size[1]}_bicubic')
         logging.info(f'Creating dataset with {len(self.ids)} examples')
 
         
@@ -128,8 +137,13 @@ class BasicDataset_OUT(Dataset):
     def __getitem__(self, index):
         
         idx = self.ids[index]
-        img_file = glob(self.image_dir + idx + '.*')
-        image = Image.open(img_file[0])
+        if idx in self.cache:
+            # already resized, the resize of preprocess keeps it as it is
+            img_file = [self.image_dir + idx + '.png']
+            image = Image.fromarray(self.cache[idx][0])
+        else:
+            img_file = glob(self.image_dir + idx + '.*')
+            image = Image.open(img_file[0])
         image_processed = self.preprocess(image, self.image_size, self.train_or, index)
  
         return {
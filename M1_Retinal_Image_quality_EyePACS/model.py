@@ -37,7 +37,11 @@ def InceptionV3_fl(pretrained):
 
 
 def Efficientnet_fl(pretrained):
-    model = EfficientNet.from_pretrained('efficientnet-b4')
+    # without pretrained nothing is downloaded, for weights loaded from a checkpoint
+    if pretrained:
+        model = EfficientNet.from_pretrained('efficientnet-b4')
+    else:
+        model = EfficientNet.from_name('efficientnet-b4')
     model._fc = nn.Identity()
     net_fl = nn.Sequential(
             nn.Linear(1792, 256),
@@ -89,7 +93,7 @@ def Resnet101_fl(pretrained):
 
 
 def Resnext101_32x8d_fl(pretrained):
-    resnext101_32x8d = models.resnext101_32x8d(pretrained = True)
+    resnext101_32x8d = models.resnext101_32x8d(pretrained = pretrained)
     resnext101_32x8d.fc = nn.Identity()
     net_fl = nn.Sequential(
         nn.Linear(2048, 256),
@@ -0,0 +1,74 @@
+"""
+INT8 post-training quantization of the ONNX ensemble written by export_onnx.
+
+Only numpy and ONNX Runtime are needed, the calibration batches are arrays
+(or CPU tensors) of preprocessed images.
+"""
+import os
+import tempfile
+
+import numpy as np
+
+
+def quantize_onnx(path, quantized_path, calibration):
+    """
+    Write an INT8 copy of the ONNX ensemble at ``path``. The convolutions are
+    quantized statically, with the activation ranges calibrated on
+    ``calibration`` (batches of preprocessed images), then the Linear heads
+    (MatMul/Gemm) dynamically, their activations scaled batch by batch.
+    Weights are quantized per channel
+    """
+    from onnxruntime import quantization  # only this backend needs it
+
+    class CalibrationReader(quantization.CalibrationDataReader):
+        def __init__(self):
+            self.batches = iter(calibration)
+
+        def get_next(self):
+            imgs = next(self.batches, None)
+            if imgs is None:
+                return None
+            return {"imgs": np.asarray(imgs, dtype=np.float32)}
+
+    with tempfile.TemporaryDirectory(
+        dir=os.path.dirname(os.path.abspath(quantized_path))
+    ) as workdir:
+        # shape inference and graph optimization, as ONNX Runtime recommends
+        preprocessed = f"{workdir}/preprocessed.onnx"
+        quantization.quant_pre_process(path, preprocessed)
+        convolutions = f"{workdir}/convolutions.onnx"
+        quantization.quantize_static(
+            preprocessed,
+            convolutions,
+            CalibrationReader(),
+            quant_format=quantization.QuantFormat.QDQ,
+            op_types_to_quantize=["Conv"],
+            per_channel=True,
+            activation_type=quantization.QuantType.QUInt8,
+            weight_type=quantization.QuantType.QInt8,
+            # the calibrater keeps the activations of every batch until the
+            # end (CalibMaxIntermediateOutputs drops them without folding
+            # their ranges in), hence the small calibration set
+            calibrate_method=quantization.CalibrationMethod.MinMax,
+        )
+        quantization.quantize_dynamic(
+            convolutions,
+            quantized_path + ".tmp",
+            op_types_to_quantize=["MatMul", "Gemm"],
+            per_channel=True,
+            weight_type=quantization.QuantType.QInt8,
+        )
+    os.replace(quantized_path + ".tmp", quantized_path)
+    return quantized_path
+
+
+def calibration_split(n_images, calibration, evaluation):
+    """
+    Indices of ``calibration`` images spread evenly over ``n_images``, and of
+    up to ``evaluation`` of the others to measure the quantization drift on
+    """
+    calibration_indices = np.unique(
+        np.linspace(0, n_images - 1, min(calibration, n_images)).round().astype(int)
+    )
+    others = np.setdiff1d(np.arange(n_images), calibration_indices)
+    return calibration_indices.tolist(), others[:evaluation].tolist()
@@ -1,4 +1,6 @@
 import argparse
+import copy
+import inspect
 import logging
 import os
 import sys
@@ -9,16 +11,12 @@ import pandas as pd
 import torch.nn as nn
 from tqdm import tqdm
 from dataset import BasicDataset_OUT
+from merge_quality_assessment import quality_label
+from quantize import calibration_split, quantize_onnx
+from adaptive import adaptive_predict
+from torch.func import functional_call, stack_module_state
 from torch.utils.data import DataLoader
-from model import (
-    Resnet101_fl,
-    InceptionV3_fl,
-    Densenet161_fl,
-    Resnext101_32x8d_fl,
-    MobilenetV2_fl,
-    Vgg16_bn_fl,
-    Efficientnet_fl,
-)
+from model import Resnext101_32x8d_fl, Efficientnet_fl
 from PIL import ImageFile
 
 
@@ -26,6 +24,349 @@ ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 AUTOMORPH_DATA = os.getenv("AUTOMORPH_DATA", "..")
 
+ENSEMBLE_CHECKPOINTS = (
+    "7_seed_28",
+    "6_seed_30",
+    "5_seed_32",
+    "4_seed_34",
+    "3_seed_36",
+    "2_seed_38",
+    "1_seed_40",
+    "0_seed_42",
+)
+# images (members x batch) a StackedEnsemble runs through at once, bounds memory
+STACKED_IMAGES = 32
+BACKENDS = ("torch", "onnxruntime", "onnxruntime-int8")
+
+
+def ensemble_checkpoints(model, task, load, root="."):
+    return [
+        "{}/M1_Retinal_Image_quality_EyePACS/{}/{}/{}/{}/best_loss_checkpoint.pth".format(
+            root, task, load, model, seed_dir
+        )
+        for seed_dir in ENSEMBLE_CHECKPOINTS
+    ]
+
+
+def consolidated_checkpoint(model, task, load, root="."):
+    """Single file with the state dicts of every ensemble member, by seed directory"""
+    return "{}/M1_Retinal_Image_quality_EyePACS/{}/{}/{}/ensemble_checkpoint.pth".format(
+        root, task, load, model
+    )
+
+
+def checkpoint_files(model, task, load, root="."):
+    """The checkpoint files load_ensemble reads"""
+    consolidated = consolidated_checkpoint(model, task, load, root)
+    if os.path.exists(consolidated):
+        return [consolidated]
+    return ensemble_checkpoints(model, task, load, root)
+
+
+def onnx_path(model, task, load, root="."):
+    """ONNX graph of the ensemble, written by export_onnx"""
+    return "{}/M1_Retinal_Image_quality_EyePACS/{}/{}/{}/ensemble.onnx".format(
+        root, task, load, model
+    )
+
+
+def quantized_onnx_path(model, task, load, root="."):
+    """INT8 ONNX graph of the ensemble, written by quantize_onnx"""
+    return "{}/M1_Retinal_Image_quality_EyePACS/{}/{}/{}/ensemble_int8.onnx".format(
+        root, task, load, model
+    )
+
+
+def consolidate_ensemble(model, task, load, root="."):
+    """Write the best-loss checkpoints of the members to consolidated_checkpoint"""
+    state_dicts = {
+        seed_dir: torch.load(checkpoint_path, map_location="cpu", weights_only=True)
+        for seed_dir, checkpoint_path in zip(
+            ENSEMBLE_CHECKPOINTS, ensemble_checkpoints(model, task, load, root)
+        )
+    }
+    path = consolidated_checkpoint(model, task, load, root)
+    torch.save(state_dicts, path + ".tmp")
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def member_state_dicts(model, task, load, device, root="."):
+    """
+    State dict of every ensemble member, read from consolidated_checkpoint in
+    one go when it exists and from the member checkpoints one at a time otherwise
+    """
+    consolidated = consolidated_checkpoint(model, task, load, root)
+    if os.path.exists(consolidated):
+        state_dicts = torch.load(consolidated, map_location=device, weights_only=True)
+        for seed_dir in ENSEMBLE_CHECKPOINTS:
+            yield state_dicts.pop(seed_dir)
+        return
+    for checkpoint_path in ensemble_checkpoints(model, task, load, root):
+        # map_location = {'cuda:%d' % 0: 'cuda:%d' % args.local_rank}
+        yield torch.load(checkpoint_path, map_location=device, weights_only=True)
+
+
+def load_ensemble(model, task, load, device, root="."):
+    """
+    Build the ensemble members of ``model`` and load their best-loss checkpoints.
+    With checkpoints the ImageNet weights are not needed, nor downloaded
+    """
+    if model == "resnext101":
+        build = Resnext101_32x8d_fl
+    elif model == "efficientnet":
+        build = Efficientnet_fl
+    else:
+        raise ValueError(f"no ensemble checkpoints for model {model}")
+
+    if load:
+        state_dicts = member_state_dicts(model, task, load, device, root)
+    else:
+        state_dicts = [None] * len(ENSEMBLE_CHECKPOINTS)
+    models = []
+    for state_dict in state_dicts:
+        if state_dict is None:
+            model_fl = build(pretrained=True)
+        else:
+            # built without initialising the weights, they are the checkpoint tensors
+            with torch.device("meta"):
+                model_fl = build(pretrained=False)
+            model_fl.load_state_dict(state_dict, assign=True)
+        model_fl.to(device=device)
+        model_fl.eval()
+        models.append(model_fl)
+    return models
+
+
+class StackedEnsemble(nn.Module):
+    """
+    Ensemble members of one architecture run as a single model: their weights
+    are stacked on a member dimension and the forward pass is vmapped over it,
+    STACKED_IMAGES images at a time. The members keep working on their own,
+    their weights become views of the stacked ones. Forward hooks see the
+    stacked forward pass, functional_call does not go through the members
+    """
+
+    def __init__(self, models):
+        super().__init__()
+        self.members = list(models)
+        self.params, self.buffers = stack_module_state(self.members)
+        self.params = {name: param.detach() for name, param in self.params.items()}
+        for index, model_fl in enumerate(self.members):
+            model_fl.load_state_dict(
+                {
+                    name: tensor[index]
+                    for name, tensor in {**self.params, **self.buffers}.items()
+                },
+                assign=True,
+            )
+        self.base = copy.deepcopy(self.members[0]).to("meta")
+        if hasattr(self.base, "set_swish"):
+            # the memory efficient swish of EfficientNet is an autograd Function
+            # vmap does not batch
+            self.base.set_swish(memory_efficient=False)
+
+    def __len__(self):
+        return len(self.members)
+
+    def __iter__(self):
+        return iter(self.members)
+
+    def member_forward(self, params, buffers, imgs):
+        return functional_call(self.base, (params, buffers), (imgs,))
+
+    def forward(self, imgs):
+        """Outputs of every member, stacked on a leading member dimension"""
+        chunk_size = max(1, STACKED_IMAGES // imgs.shape[0])
+        return torch.vmap(
+            self.member_forward,
+            in_dims=(0, 0, None),
+            chunk_size=chunk_size if chunk_size < len(self) else None,
+        )(self.params, self.buffers, imgs)
+
+
+class MemberLogits(nn.Module):
+    """Ensemble members as one module, their logits stacked on a member dimension"""
+
+    def __init__(self, models):
+        super().__init__()
+        self.members = nn.ModuleList(models)
+
+    def forward(self, imgs):
+        return torch.stack([model_fl(imgs) for model_fl in self.members])
+
+
+def export_onnx(models, path, image_size=(512, 512), opset=17):
+    """
+    Write the ensemble members to one ONNX graph, from a batch of images
+    ("imgs") to the logits of every member ("logits", member x batch x class).
+    The batch size is dynamic
+    """
+    members = [copy.deepcopy(model_fl).cpu().eval() for model_fl in models]
+    for model_fl in members:
+        if hasattr(model_fl, "set_swish"):
+            # the memory efficient swish of EfficientNet does not export
+            model_fl.set_swish(memory_efficient=False)
+    # the TorchScript exporter, newer torch versions default to the dynamo one
+    options = (
+        {"dynamo": False}
+        if "dynamo" in inspect.signature(torch.onnx.export).parameters
+        else {}
+    )
+    with torch.no_grad():
+        torch.onnx.export(
+            MemberLogits(members),
+            torch.zeros(1, 3, *image_size),
+            path + ".tmp",
+            input_names=["imgs"],
+            output_names=["logits"],
+            dynamic_axes={"imgs": {0: "batch"}, "logits": {1: "batch"}},
+            opset_version=opset,
+            **options,
+        )
+    os.replace(path + ".tmp", path)
+    return path
+
+
+class OnnxEnsemble:
+    """
+    An ensemble exported by export_onnx, run by ONNX Runtime on CPU with every
+    graph optimization. ``intra_op_threads`` threads run each operator; above
+    1, ``inter_op_threads`` operators (of different members) run at once. 0
+    leaves the choice to ONNX Runtime
+    """
+
+    def __init__(self, path, intra_op_threads=0, inter_op_threads=0):
+        import onnxruntime  # only this backend needs it
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        if inter_op_threads > 1:
+            options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+        self.session = onnxruntime.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+
+    def __len__(self):
+        return self.session.get_outputs()[0].shape[0]
+
+    def __call__(self, imgs):
+        """Logits of every member, stacked on a leading member dimension"""
+        (logits,) = self.session.run(
+            ["logits"], {"imgs": imgs.detach().cpu().numpy().astype(np.float32)}
+        )
+        return torch.from_numpy(logits)
+
+
+def crop_batches(dataset, indices, batch_size=1):
+    """(names, images) batches of the ``dataset`` images at ``indices``"""
+    for start in range(0, len(indices), batch_size):
+        items = [dataset[index] for index in indices[start : start + batch_size]]
+        yield (
+            [os.path.basename(item["img_file"][0]) for item in items],
+            torch.stack([item["image"] for item in items]),
+        )
+
+
+def compare_decisions(reference, candidate, batches):
+    """
+    Run two ensembles on ``batches`` of (names, images) and return, per image,
+    the good/usable/bad Prediction and the merge_quality_assessment quality of
+    both, with the largest difference of their mean softmax
+    """
+    rows = []
+    for names, imgs in batches:
+        with torch.no_grad():
+            reference_mean, _, reference_decode = ensemble_predict(reference, imgs)
+            candidate_mean, _, candidate_decode = ensemble_predict(candidate, imgs)
+        for i, name in enumerate(names):
+            rows.append(
+                {
+                    "Name": name,
+                    "Prediction": reference_decode[i],
+                    "Prediction_candidate": candidate_decode[i],
+                    "quality": quality_label(
+                        reference_decode[i], reference_mean[i, 2]
+                    ),
+                    "quality_candidate": quality_label(
+                        candidate_decode[i], candidate_mean[i, 2]
+                    ),
+                    "softmax_drift": np.abs(
+                        reference_mean[i] - candidate_mean[i]
+                    ).max(),
+                }
+            )
+    return pd.DataFrame(rows)
+
+
+def backend_files(model, task, load, root=".", backend="torch"):
+    """The files the ensemble is loaded from with ``backend``"""
+    if backend == "onnxruntime":
+        return [onnx_path(model, task, load, root)]
+    if backend == "onnxruntime-int8":
+        return [quantized_onnx_path(model, task, load, root)]
+    return checkpoint_files(model, task, load, root)
+
+
+def load_backend(
+    model,
+    task,
+    load,
+    device,
+    root=".",
+    backend="torch",
+    intra_op_threads=0,
+    inter_op_threads=0,
+    stacked=False,
+):
+    """The ensemble as ensemble_predict runs it with ``backend``"""
+    if backend in ("onnxruntime", "onnxruntime-int8"):
+        path = backend_files(model, task, load, root, backend)[0]
+        if not os.path.exists(path):
+            command = "export-onnx" if backend == "onnxruntime" else "quantize"
+            raise FileNotFoundError(
+                f"No ONNX ensemble at {path}, "
+                f"write it with python -m automorph {command}"
+            )
+        return OnnxEnsemble(path, intra_op_threads, inter_op_threads)
+    if backend != "torch":
+        raise ValueError(f"unknown backend {backend!r}, expected one of {BACKENDS}")
+    return ensemble_executor(load_ensemble(model, task, load, device, root), stacked)
+
+
+def ensemble_executor(models, stacked=False):
+    """
+    ``models`` as ensemble_predict runs them: the list of members, or with
+    ``stacked`` a StackedEnsemble. Stacking saves a kernel launch per member
+    and layer on CUDA; it gives the outputs of the list (to 1e-8) but on CPU
+    the stacked convolutions are grouped ones, slower than the list. Check it
+    pays off with python -m automorph benchmark before turning it on
+    """
+    return StackedEnsemble(models) if stacked else models
+
+
+def ensemble_predict(models, imgs):
+    """
+    Run every ensemble member on a batch and return the per-image softmax mean,
+    the softmax standard deviation across members and the decoded class.
+    ``models`` is a list of members, a StackedEnsemble or an OnnxEnsemble. The
+    statistics are computed on the device, the host only receives them
+    """
+    if isinstance(models, (StackedEnsemble, OnnxEnsemble)):
+        prediction = models(imgs)
+    else:
+        prediction = torch.stack([model_fl(imgs) for model_fl in models])
+    prediction_softmax = nn.Softmax(dim=2)(prediction.float())
+    mean = prediction_softmax.mean(dim=0)
+    std = prediction_softmax.std(dim=0, correction=0)
+    prediction_decode = mean.argmax(dim=1, keepdim=True)
+    summary = torch.cat([mean, std, prediction_decode.float()], dim=1).cpu().numpy()
+    return summary[:, :3], summary[:, 3:6], summary[:, 6].astype(np.int64)
+
 
 def test_net(
     model_fl_1,
@@ -41,6 +382,9 @@ def test_net(
     epochs=5,
     batch_size=20,
     image_size=(512, 512),
+    ensemble=None,
+    adaptive_z=None,
+    min_members=3,
 ):
     n_classes = args.n_class
 
@@ -60,143 +404,41 @@ def test_net(
     filename_list = []
     prediction_list_mean = []
     prediction_list_std = []
-    mask_pred_tensor_small_all = 0
+    members_list = []
+    if ensemble is None:
+        # load_ensemble left the members in eval mode
+        ensemble = ensemble_executor(
+            [
+                model_fl_1,
+                model_fl_2,
+                model_fl_3,
+                model_fl_4,
+                model_fl_5,
+                model_fl_6,
+                model_fl_7,
+                model_fl_8,
+            ]
+        )
     for epoch in range(epochs):
-        model_fl_1.eval()
-        model_fl_2.eval()
-        model_fl_3.eval()
-        model_fl_4.eval()
-        model_fl_5.eval()
-        model_fl_6.eval()
-        model_fl_7.eval()
-        model_fl_8.eval()
-
         with tqdm(total=n_test, desc=f"Epoch {epoch + 1}/{epochs}", unit="img") as pbar:
             for batch in val_loader:
                 imgs = batch["image"]
                 filename = batch["img_file"][0]
-                mask_pred_tensor_small_all = 0
                 imgs = imgs.to(device=device, dtype=torch.float32)
                 ##################sigmoid or softmax
 
-                prediction_list = []
                 with torch.no_grad():
-                    # print(real_patch.size())
-                    prediction = model_fl_1(imgs)
-                    prediction_softmax = nn.Softmax(dim=1)(prediction)
-                    mask_pred_tensor_small = prediction_softmax.clone().detach()
-                    mask_pred_tensor_small_all += mask_pred_tensor_small.type(
-                        torch.FloatTensor
-                    )
-                    prediction_list.append(
-                        mask_pred_tensor_small.type(torch.FloatTensor)
-                        .cpu()
-                        .detach()
-                        .numpy()
-                    )
-
-                    prediction = model_fl_2(imgs)
-                    prediction_softmax = nn.Softmax(dim=1)(prediction)
-                    mask_pred_tensor_small = prediction_softmax.clone().detach()
-                    mask_pred_tensor_small_all += mask_pred_tensor_small.type(
-                        torch.FloatTensor
-                    )
-                    prediction_list.append(
-                        mask_pred_tensor_small.type(torch.FloatTensor)
-                        .cpu()
-                        .detach()
-                        .numpy()
-                    )
-
-                    prediction = model_fl_3(imgs)
-                    prediction_softmax = nn.Softmax(dim=1)(prediction)
-                    mask_pred_tensor_small = prediction_softmax.clone().detach()
-                    mask_pred_tensor_small_all += mask_pred_tensor_small.type(
-                        torch.FloatTensor
-                    )
-                    prediction_list.append(
-                        mask_pred_tensor_small.type(torch.FloatTensor)
-                        .cpu()
-                        .detach()
-                        .numpy()
-                    )
-
-                    prediction = model_fl_4(imgs)
-                    prediction_softmax = nn.Softmax(dim=1)(prediction)
-                    mask_pred_tensor_small = prediction_softmax.clone().detach()
-                    mask_pred_tensor_small_all += mask_pred_tensor_small.type(
-                        torch.FloatTensor
-                    )
-                    prediction_list.append(
-                        mask_pred_tensor_small.type(torch.FloatTensor)
-                        .cpu()
-                        .detach()
-                        .numpy()
-                    )
-
-                    prediction = model_fl_5(imgs)
-                    prediction_softmax = nn.Softmax(dim=1)(prediction)
-                    mask_pred_tensor_small = prediction_softmax.clone().detach()
-                    mask_pred_tensor_small_all += mask_pred_tensor_small.type(
-                        torch.FloatTensor
-                    )
-                    prediction_list.append(
-                        mask_pred_tensor_small.type(torch.FloatTensor)
-                        .cpu()
-                        .detach()
-                        .numpy()
-                    )
-
-                    prediction = model_fl_6(imgs)
-                    prediction_softmax = nn.Softmax(dim=1)(prediction)
-                    mask_pred_tensor_small = prediction_softmax.clone().detach()
-                    mask_pred_tensor_small_all += mask_pred_tensor_small.type(
-                        torch.FloatTensor
-                    )
-                    prediction_list.append(
-                        mask_pred_tensor_small.type(torch.FloatTensor)
-                        .cpu()
-                        .detach()
-                        .numpy()
-                    )
-
-                    prediction = model_fl_7(imgs)
-                    prediction_softmax = nn.Softmax(dim=1)(prediction)
-                    mask_pred_tensor_small = prediction_softmax.clone().detach()
-                    mask_pred_tensor_small_all += mask_pred_tensor_small.type(
-                        torch.FloatTensor
-                    )
-                    prediction_list.append(
-                        mask_pred_tensor_small.type(torch.FloatTensor)
-                        .cpu()
-                        .detach()
-                        .numpy()
-                    )
-
-                    prediction = model_fl_8(imgs)
-                    prediction_softmax = nn.Softmax(dim=1)(prediction)
-                    mask_pred_tensor_small = prediction_softmax.clone().detach()
-                    mask_pred_tensor_small_all += mask_pred_tensor_small.type(
-                        torch.FloatTensor
-                    )
-                    prediction_list.append(
-                        mask_pred_tensor_small.type(torch.FloatTensor)
-                        .cpu()
-                        .detach()
-                        .numpy()
-                    )
-
-                    mask_pred_tensor_small_all = mask_pred_tensor_small_all / 8
-
-                    _, prediction_decode = torch.max(mask_pred_tensor_small_all, 1)
-
-                    prediction_list = np.array(prediction_list)
-                    prediction_list_mean.extend(np.mean(prediction_list, axis=0))
-                    prediction_list_std.extend(np.std(prediction_list, axis=0))
-
-                    prediction_decode_list.extend(
-                        prediction_decode.cpu().detach().numpy()
-                    )
+                    if adaptive_z is None:
+                        mean, std, prediction_decode = ensemble_predict(ensemble, imgs)
+                    else:
+                        mean, std, prediction_decode, members = adaptive_predict(
+                            ensemble, imgs, adaptive_z, min_members
+                        )
+                        members_list.extend(members)
+                    prediction_list_mean.extend(mean)
+                    prediction_list_std.extend(std)
+
+                    prediction_decode_list.extend(prediction_decode)
                     filename_list.extend(filename)
                     pbar.update(imgs.shape[0])
 
@@ -212,6 +454,9 @@ def test_net(
             "Prediction": prediction_decode_list,
         }
     )
+    if adaptive_z is not None:
+        # members each image ran through
+        Data4stage2["members"] = members_list
 
     if not os.path.exists(f"{AUTOMORPH_DATA}/Results/M1"):
         os.makedirs(f"{AUTOMORPH_DATA}/Results/M1")
@@ -234,9 +479,11 @@ def get_args():
         help="Number of epochs",
         dest="epochs",
     )
+    # --b as test_outside.sh spells it, the prefix also matches --backend
     parser.add_argument(
         "-b",
         "--batch-size",
+        "--b",
         metavar="B",
         type=int,
         nargs="?",
@@ -283,6 +530,57 @@ def get_args():
         "--seed_num", type=int, default=42, help="Validation split seed", dest="seed"
     )
     parser.add_argument("--local_rank", default=0, type=int)
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default="torch",
+        help="run the ensemble with PyTorch or with ONNX Runtime on CPU, in "
+        "float (export it first with python -m automorph export-onnx) or INT8 "
+        "(python -m automorph quantize)",
+        dest="backend",
+    )
+    parser.add_argument(
+        "--intra-op-threads",
+        type=int,
+        default=0,
+        help="ONNX Runtime threads per operator, 0 for its default",
+        dest="intra_op_threads",
+    )
+    parser.add_argument(
+        "--inter-op-threads",
+        type=int,
+        default=0,
+        help="ONNX Runtime operators run at once, 0 for its default",
+        dest="inter_op_threads",
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="run the members in order and stop on an image once its good/bad "
+        "quality is settled, the members used go to the members column",
+        dest="adaptive",
+    )
+    parser.add_argument(
+        "--adaptive-z",
+        type=float,
+        default=3.0,
+        help="standard errors the mean softmax must lie from the quality "
+        "thresholds for --adaptive to stop",
+        dest="adaptive_z",
+    )
+    parser.add_argument(
+        "--min-members",
+        type=int,
+        default=3,
+        help="members every image runs through with --adaptive",
+        dest="min_members",
+    )
+    parser.add_argument(
+        "--stacked",
+        action="store_true",
+        help="run the torch members as one vmapped model, faster on some GPUs",
+        dest="stacked",
+    )
 
     return parser.parse_args()
 
@@ -308,95 +606,32 @@ if __name__ == "__main__":
     dataset = args.dataset
     img_size = (512, 512)
 
-    if args.model == "inceptionv3":
-        model_fl = InceptionV3_fl(pretrained=True)
-    if args.model == "densenet161":
-        model_fl = Densenet161_fl(pretrained=True)
-    if args.model == "resnet101":
-        model_fl = Resnet101_fl(pretrained=True)
-    if args.model == "resnext101":
-        model_fl_1 = Resnext101_32x8d_fl(pretrained=True)
-        model_fl_2 = Resnext101_32x8d_fl(pretrained=True)
-        model_fl_3 = Resnext101_32x8d_fl(pretrained=True)
-        model_fl_4 = Resnext101_32x8d_fl(pretrained=True)
-        model_fl_5 = Resnext101_32x8d_fl(pretrained=True)
-        model_fl_6 = Resnext101_32x8d_fl(pretrained=True)
-        model_fl_7 = Resnext101_32x8d_fl(pretrained=True)
-        model_fl_8 = Resnext101_32x8d_fl(pretrained=True)
-    if args.model == "efficientnet":
-        model_fl_1 = Efficientnet_fl(pretrained=True)
-        model_fl_2 = Efficientnet_fl(pretrained=True)
-        model_fl_3 = Efficientnet_fl(pretrained=True)
-        model_fl_4 = Efficientnet_fl(pretrained=True)
-        model_fl_5 = Efficientnet_fl(pretrained=True)
-        model_fl_6 = Efficientnet_fl(pretrained=True)
-        model_fl_7 = Efficientnet_fl(pretrained=True)
-        model_fl_8 = Efficientnet_fl(pretrained=True)
-    if args.model == "mobilenetv2":
-        model_fl = MobilenetV2_fl(pretrained=True)
-    if args.model == "vgg16bn":
-        model_fl = Vgg16_bn_fl(pretrained=True)
-
-    checkpoint_path_1 = "./M1_Retinal_Image_quality_EyePACS/{}/{}/{}/7_seed_28/best_loss_checkpoint.pth".format(
-        args.task, args.load, args.model
-    )
-    checkpoint_path_2 = "./M1_Retinal_Image_quality_EyePACS/{}/{}/{}/6_seed_30/best_loss_checkpoint.pth".format(
-        args.task, args.load, args.model
-    )
-    checkpoint_path_3 = "./M1_Retinal_Image_quality_EyePACS/{}/{}/{}/5_seed_32/best_loss_checkpoint.pth".format(
-        args.task, args.load, args.model
-    )
-    checkpoint_path_4 = "./M1_Retinal_Image_quality_EyePACS/{}/{}/{}/4_seed_34/best_loss_checkpoint.pth".format(
-        args.task, args.load, args.model
+    if args.adaptive and (args.stacked or args.backend != "torch"):
+        raise ValueError("--adaptive runs the torch members one by one")
+    ensemble = load_backend(
+        args.model,
+        args.task,
+        args.load,
+        device,
+        backend=args.backend,
+        intra_op_threads=args.intra_op_threads,
+        inter_op_threads=args.inter_op_threads,
+        stacked=args.stacked,
     )
-    checkpoint_path_5 = "./M1_Retinal_Image_quality_EyePACS/{}/{}/{}/3_seed_36/best_loss_checkpoint.pth".format(
-        args.task, args.load, args.model
-    )
-    checkpoint_path_6 = "./M1_Retinal_Image_quality_EyePACS/{}/{}/{}/2_seed_38/best_loss_checkpoint.pth".format(
-        args.task, args.load, args.model
-    )
-    checkpoint_path_7 = "./M1_Retinal_Image_quality_EyePACS/{}/{}/{}/1_seed_40/best_loss_checkpoint.pth".format(
-        args.task, args.load, args.model
-    )
-    checkpoint_path_8 = "./M1_Retinal_Image_quality_EyePACS/{}/{}/{}/0_seed_42/best_loss_checkpoint.pth".format(
-        args.task, args.load, args.model
-    )
-
-    model_fl_1.to(device=device)
-    model_fl_2.to(device=device)
-    model_fl_3.to(device=device)
-    model_fl_4.to(device=device)
-    model_fl_5.to(device=device)
-    model_fl_6.to(device=device)
-    model_fl_7.to(device=device)
-    model_fl_8.to(device=device)
-
-    # map_location = {'cuda:%d' % 0: 'cuda:%d' % args.local_rank}
-    if args.load:
-        model_fl_1.load_state_dict(
-            torch.load(checkpoint_path_1, map_location=device, weights_only=True)
-        )
-        model_fl_2.load_state_dict(
-            torch.load(checkpoint_path_2, map_location=device, weights_only=True)
-        )
-        model_fl_3.load_state_dict(
-            torch.load(checkpoint_path_3, map_location=device, weights_only=True)
-        )
-        model_fl_4.load_state_dict(
-            torch.load(checkpoint_path_4, map_location=device, weights_only=True)
-        )
-        model_fl_5.load_state_dict(
-            torch.load(checkpoint_path_5, map_location=device, weights_only=True)
-        )
-        model_fl_6.load_state_dict(
-            torch.load(checkpoint_path_6, map_location=device, weights_only=True)
-        )
-        model_fl_7.load_state_dict(
-            torch.load(checkpoint_path_7, map_location=device, weights_only=True)
-        )
-        model_fl_8.load_state_dict(
-            torch.load(checkpoint_path_8, map_location=device, weights_only=True)
-        )
+    if args.backend != "torch":
+        models = [None] * len(ensemble)
+    else:
+        models = list(ensemble)
+    (
+        model_fl_1,
+        model_fl_2,
+        model_fl_3,
+        model_fl_4,
+        model_fl_5,
+        model_fl_6,
+        model_fl_7,
+        model_fl_8,
+    ) = models
 
     try:
         test_net(
@@ -413,6 +648,9 @@ if __name__ == "__main__":
             epochs=args.epochs,
             batch_size=args.batchsize,
             image_size=img_size,
+            ensemble=ensemble,
+            adaptive_z=args.adaptive_z if args.adaptive else None,
+            min_members=args.min_members,
         )
     except KeyboardInterrupt:
         torch.save(model_fl.state_dict(), "INTERRUPTED.pth")
@@ -12,6 +12,16 @@ from torchvision.utils import save_image
 from scipy.ndimage import rotate
 from PIL import Image, ImageEnhance
 from torchvision.transforms import functional as F
+import os
+import importlib.util
+
+# the reader of the M0 cache is shared by every stage, loaded from its file as
+# M0_Preprocess is not a package
+_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+_spec = importlib.util.spec_from_file_location(
+    'fundus_cache', os.path.join(_root, 'M0_Preprocess', 'fundus_cache.py'))
+fundus_cache = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(fundus_cache)
 
 
 class LearningAVSegData(Dataset):
@@ -154,6 +164,8 @@ class LearningAVSegData(Dataset):
     
     
     
+
+
 class LearningAVSegData_OOD(Dataset):
     def __init__(self, imgs_dir, label_dir,  mask_dir, img_size, dataset_name, train_or=True, mask_suffix=''):
         self.imgs_dir = imgs_dir
@@ -167,6 +179,7 @@ class LearningAVSegData_OOD(Dataset):
         i = 0
         self.ids = [splitext(file)[0] for file in listdir(imgs_dir)
                     if not file.startswith('.')]
+        self.cache = fundus_cache.load_m0_cache(imgs_dir, f'{img_size[0]}x{img_size[1]}_bicubic')
         #logging.info(f'Creating dataset with {(self.ids)} ')
         logging.info(f'Creating dataset with {len(self.ids)} examples')
 
@@ -220,17 +233,13 @@ class LearningAVSegData_OOD(Dataset):
 
         idx = self.ids[i]
         
-        if self.dataset_name=='HRF-AV':
-            img_file = glob(self.imgs_dir + idx + '.*')
-            
+        if idx in self.cache:
+            img, ori_width, ori_height = self.cache[idx]
         else:
             img_file = glob(self.imgs_dir + idx + '.*')
-        
-
-
-        img = Image.open(img_file[0])
-        ori_width, ori_height = img.size
-        img = img.resize(self.img_size)
+            img = Image.open(img_file[0])
+            ori_width, ori_height = img.size
+            img = img.resize(self.img_size)
 
         img= self.preprocess(img, self.dataset_name, self.img_size, self.train_or)
         i += 1
@@ -4,14 +4,12 @@ import logging
 import shutil
 import os
 import cv2
-import torchvision
 import torch
 import numpy as np
 from tqdm import tqdm
 from scripts.model import Generator_main, Generator_branch
 from scripts.dataset import LearningAVSegData_OOD
 from torch.utils.data import DataLoader
-from torchvision.utils import save_image
 from PIL import Image
 import pandas as pd
 from skimage import io
@@ -25,11 +23,12 @@ ImageFile.LOAD_TRUNCATED_IMAGES = True
 AUTOMORPH_DATA = os.getenv("AUTOMORPH_DATA", "..")
 
 
-def filter_frag(data_path):
+def filter_frag(data_path, image_list=None):
     if os.path.isdir(data_path + "raw/.ipynb_checkpoints"):
         shutil.rmtree(data_path + "raw/.ipynb_checkpoints")
 
-    image_list = os.listdir(data_path + "raw")
+    if image_list is None:
+        image_list = os.listdir(data_path + "raw")
     FD_cal_r = []
     name_list = []
     VD_cal_r = []
@@ -98,305 +97,213 @@ def filter_frag(data_path):
     return FD_cal_r, name_list, VD_cal_r, FD_cal_b, VD_cal_b, width_cal_r, width_cal_b
 
 
-def test_net(
-    net_G_1,
-    net_G_A_1,
-    net_G_V_1,
-    net_G_2,
-    net_G_A_2,
-    net_G_V_2,
-    net_G_3,
-    net_G_A_3,
-    net_G_V_3,
-    net_G_4,
-    net_G_A_4,
-    net_G_V_4,
-    net_G_5,
-    net_G_A_5,
-    net_G_V_5,
-    net_G_6,
-    net_G_A_6,
-    net_G_V_6,
-    net_G_7,
-    net_G_A_7,
-    net_G_V_7,
-    net_G_8,
-    net_G_A_8,
-    net_G_V_8,
-    loader,
-    device,
-    mode,
-    dataset,
-):
-    n_val = len(loader)
+ENSEMBLE_SEEDS = (28, 30, 32, 34, 36, 38, 40, 42)
 
-    num = 0
 
-    seg_results_small_path = f"{AUTOMORPH_DATA}/Results/M2/artery_vein/resized/"
-    seg_results_raw_path = f"{AUTOMORPH_DATA}/Results/M2/artery_vein/raw/"
+CHECKPOINT_NAMES = ("CP_best_F1_all.pth", "CP_best_F1_A.pth", "CP_best_F1_V.pth")
 
-    if not os.path.isdir(seg_results_small_path):
-        os.makedirs(seg_results_small_path)
 
-    if not os.path.isdir(seg_results_raw_path):
-        os.makedirs(seg_results_raw_path)
+def ensemble_checkpoints(job_name, root="."):
+    """Checkpoint directory of every ensemble seed"""
+    return [
+        "{}/M2_Artery_vein/ALL-AV/{}_{}/Discriminator_unet/".format(
+            root, job_name, seed
+        )
+        for seed in ENSEMBLE_SEEDS
+    ]
 
-    seg_uncertainty_small_path = (
-        f"{AUTOMORPH_DATA}/Results/M2/artery_vein/resize_uncertainty/"
-    )
-    if not os.path.isdir(seg_uncertainty_small_path):
-        os.makedirs(seg_uncertainty_small_path)
 
-    seg_uncertainty_raw_path = (
-        f"{AUTOMORPH_DATA}/Results/M2/artery_vein/raw_uncertainty/"
-    )
+def load_av_ensemble(job_name, device, root="."):
+    """Build the (main, artery branch, vein branch) generators of every ensemble seed"""
+    nets = []
+    for checkpoint_saved in ensemble_checkpoints(job_name, root):
+        net_G = Generator_main(
+            input_channels=3, n_filters=32, n_classes=4, bilinear=False
+        )
+        net_G_A = Generator_branch(
+            input_channels=3, n_filters=32, n_classes=4, bilinear=False
+        )
+        net_G_V = Generator_branch(
+            input_channels=3, n_filters=32, n_classes=4, bilinear=False
+        )
+        for net, checkpoint_name in zip((net_G, net_G_A, net_G_V), CHECKPOINT_NAMES):
+            net.load_state_dict(
+                torch.load(
+                    checkpoint_saved + checkpoint_name,
+                    map_location=device,
+                    weights_only=True,
+                )
+            )
+            net.eval()
+            net.to(device=device)
+        nets.append((net_G, net_G_A, net_G_V))
+    return nets
+
+
+def ensemble_av(nets, imgs, device):
+    """Return the decoded artery/vein classes and the uncertainty map of a batch"""
+    mask_pred_tensor_small_list = []
+    mask_pred_tensor_small_all = 0
+    with torch.no_grad():
+        for net_G, net_G_A, net_G_V in nets:
+            masks_pred_G_A, masks_pred_G_fusion_A = net_G_A(imgs)
+            masks_pred_G_V, masks_pred_G_fusion_V = net_G_V(imgs)
+            masks_pred_G_sigmoid_A_part = masks_pred_G_fusion_A.detach()
+            masks_pred_G_sigmoid_V_part = masks_pred_G_fusion_V.detach()
+
+            mask_pred, _, _, _ = net_G(
+                imgs, masks_pred_G_sigmoid_A_part, masks_pred_G_sigmoid_V_part
+            )
+            mask_pred_tensor_small = mask_pred.clone().detach()
+            mask_pred_tensor_small_n = F.softmax(mask_pred_tensor_small, dim=1)
+            mask_pred_tensor_small_all += mask_pred_tensor_small_n.type(
+                torch.FloatTensor
+            )
+            mask_pred_tensor_small_list.append(mask_pred_tensor_small_n)
 
-    if not os.path.isdir(seg_uncertainty_raw_path):
-        os.makedirs(seg_uncertainty_raw_path)
+        mask_pred_tensor_small_all = (mask_pred_tensor_small_all / len(nets)).to(
+            device=device
+        )
 
-    with tqdm(total=n_val, desc="Validation round", unit="batch", leave=False) as pbar:
-        for batch in loader:
-            imgs = batch["image"]
-            ori_width = batch["width"]
-            ori_height = batch["height"]
-            img_name = batch["name"]
-            mask_pred_tensor_small_all = 0
-            imgs = imgs.to(device=device, dtype=torch.float32)
+        uncertainty_map = torch.sqrt(
+            sum(
+                torch.square(mask_pred_tensor_small_all - mask_pred_tensor_small_n)
+                for mask_pred_tensor_small_n in mask_pred_tensor_small_list
+            )
+            / len(nets)
+        )
 
-            with torch.no_grad():
-                num += 1
-                masks_pred_G_A, masks_pred_G_fusion_A = net_G_A_1(imgs)
-                masks_pred_G_V, masks_pred_G_fusion_V = net_G_V_1(imgs)
-                masks_pred_G_sigmoid_A_part = masks_pred_G_fusion_A.detach()
-                masks_pred_G_sigmoid_V_part = masks_pred_G_fusion_V.detach()
+        _, prediction_decode = torch.max(mask_pred_tensor_small_all, 1)
+        prediction_decode = prediction_decode.type(torch.FloatTensor)
 
-                mask_pred, _, _, _ = net_G_1(
-                    imgs, masks_pred_G_sigmoid_A_part, masks_pred_G_sigmoid_V_part
-                )
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_1 = F.softmax(mask_pred_tensor_small, dim=1)
-                mask_pred_tensor_small_all += mask_pred_tensor_small_1.type(
-                    torch.FloatTensor
-                )
+    return prediction_decode, uncertainty_map
 
-                masks_pred_G_A, masks_pred_G_fusion_A = net_G_A_2(imgs)
-                masks_pred_G_V, masks_pred_G_fusion_V = net_G_V_2(imgs)
-                masks_pred_G_sigmoid_A_part = masks_pred_G_fusion_A.detach()
-                masks_pred_G_sigmoid_V_part = masks_pred_G_fusion_V.detach()
 
-                mask_pred, _, _, _ = net_G_2(
-                    imgs, masks_pred_G_sigmoid_A_part, masks_pred_G_sigmoid_V_part
-                )
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_2 = F.softmax(mask_pred_tensor_small, dim=1)
-                mask_pred_tensor_small_all += mask_pred_tensor_small_2.type(
-                    torch.FloatTensor
-                )
+def decode_av(prediction_decode):
+    """Turn a decoded class map into the BGR artery/vein image written to disk"""
+    img_r = np.zeros((prediction_decode.shape[0], prediction_decode.shape[1]))
+    img_g = np.zeros((prediction_decode.shape[0], prediction_decode.shape[1]))
+    img_b = np.zeros((prediction_decode.shape[0], prediction_decode.shape[1]))
 
-                masks_pred_G_A, masks_pred_G_fusion_A = net_G_A_3(imgs)
-                masks_pred_G_V, masks_pred_G_fusion_V = net_G_V_3(imgs)
-                masks_pred_G_sigmoid_A_part = masks_pred_G_fusion_A.detach()
-                masks_pred_G_sigmoid_V_part = masks_pred_G_fusion_V.detach()
+    img_r[prediction_decode == 1] = 255
+    img_b[prediction_decode == 2] = 255
+    img_g[prediction_decode == 3] = 255
 
-                mask_pred, _, _, _ = net_G_3(
-                    imgs, masks_pred_G_sigmoid_A_part, masks_pred_G_sigmoid_V_part
-                )
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_3 = F.softmax(mask_pred_tensor_small, dim=1)
-                mask_pred_tensor_small_all += mask_pred_tensor_small_3.type(
-                    torch.FloatTensor
-                )
+    img_b = remove_small_objects(img_b > 0, 30, connectivity=5)
+    img_r = remove_small_objects(img_r > 0, 30, connectivity=5)
 
-                masks_pred_G_A, masks_pred_G_fusion_A = net_G_A_4(imgs)
-                masks_pred_G_V, masks_pred_G_fusion_V = net_G_V_4(imgs)
-                masks_pred_G_sigmoid_A_part = masks_pred_G_fusion_A.detach()
-                masks_pred_G_sigmoid_V_part = masks_pred_G_fusion_V.detach()
+    return np.concatenate(
+        (
+            img_b[..., np.newaxis],
+            img_g[..., np.newaxis],
+            img_r[..., np.newaxis],
+        ),
+        axis=2,
+    )
+
+
+def to_image(tensor):
+    """The uint8 RGB(A) array torchvision's save_image writes for one image tensor"""
+    if tensor.dim() == 2:
+        tensor = tensor.unsqueeze(0)
+    if tensor.size(0) == 1:
+        tensor = torch.cat((tensor, tensor, tensor), 0)
+    return (
+        tensor.mul(255).add_(0.5).clamp_(0, 255).permute(1, 2, 0).to("cpu", torch.uint8)
+    ).numpy()
+
+
+def write_rgb(write, path, image):
+    """Write an RGB(A) array with write, which takes cv2's BGR(A) order"""
+    write(path, image[..., [2, 1, 0, 3][: image.shape[2]]])
+
+
+def save_av(
+    data_path,
+    name,
+    prediction_decode,
+    uncertainty_map,
+    ori_width,
+    ori_height,
+    write=cv2.imwrite,
+):
+    """
+    Write the artery/vein map and its uncertainty, resized and at raw size, with
+    write, cv2.imwrite or the write of an automorph ImageWriter
+    """
+    seg_results_small_path = data_path + "resized/"
+    seg_results_raw_path = data_path + "raw/"
+    seg_uncertainty_small_path = data_path + "resize_uncertainty/"
+    seg_uncertainty_raw_path = data_path + "raw_uncertainty/"
 
-                mask_pred, _, _, _ = net_G_4(
-                    imgs, masks_pred_G_sigmoid_A_part, masks_pred_G_sigmoid_V_part
-                )
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_4 = F.softmax(mask_pred_tensor_small, dim=1)
-                mask_pred_tensor_small_all += mask_pred_tensor_small_4.type(
-                    torch.FloatTensor
-                )
+    uncertainty_small = to_image(uncertainty_map * 255)
+    write_rgb(write, seg_uncertainty_small_path + name + ".png", uncertainty_small)
+    write_rgb(
+        write,
+        seg_uncertainty_small_path + name + "_artery.png",
+        to_image(uncertainty_map[1, ...] * 255),
+    )
+    write_rgb(
+        write,
+        seg_uncertainty_small_path + name + "_vein.png",
+        to_image(uncertainty_map[2, ...] * 255),
+    )
 
-                masks_pred_G_A, masks_pred_G_fusion_A = net_G_A_5(imgs)
-                masks_pred_G_V, masks_pred_G_fusion_V = net_G_V_5(imgs)
-                masks_pred_G_sigmoid_A_part = masks_pred_G_fusion_A.detach()
-                masks_pred_G_sigmoid_V_part = masks_pred_G_fusion_V.detach()
+    uncertainty_raw = np.asarray(
+        Image.fromarray(uncertainty_small).resize((int(ori_width), int(ori_height)))
+    )
+    write_rgb(write, seg_uncertainty_raw_path + name + ".png", uncertainty_raw)
 
-                mask_pred, _, _, _ = net_G_5(
-                    imgs, masks_pred_G_sigmoid_A_part, masks_pred_G_sigmoid_V_part
-                )
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_5 = F.softmax(mask_pred_tensor_small, dim=1)
-                mask_pred_tensor_small_all += mask_pred_tensor_small_5.type(
-                    torch.FloatTensor
-                )
+    img_ = decode_av(prediction_decode)
 
-                masks_pred_G_A, masks_pred_G_fusion_A = net_G_A_6(imgs)
-                masks_pred_G_V, masks_pred_G_fusion_V = net_G_V_6(imgs)
-                masks_pred_G_sigmoid_A_part = masks_pred_G_fusion_A.detach()
-                masks_pred_G_sigmoid_V_part = masks_pred_G_fusion_V.detach()
+    write(
+        seg_results_small_path + name + ".png",
+        np.float32(img_) * 255,
+    )
 
-                mask_pred, _, _, _ = net_G_6(
-                    imgs, masks_pred_G_sigmoid_A_part, masks_pred_G_sigmoid_V_part
-                )
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_6 = F.softmax(mask_pred_tensor_small, dim=1)
-                mask_pred_tensor_small_all += mask_pred_tensor_small_6.type(
-                    torch.FloatTensor
-                )
+    img_ww = cv2.resize(
+        np.float32(img_) * 255,
+        (int(ori_width), int(ori_height)),
+        interpolation=cv2.INTER_NEAREST,
+    )
+    write(seg_results_raw_path + name + ".png", img_ww)
 
-                masks_pred_G_A, masks_pred_G_fusion_A = net_G_A_7(imgs)
-                masks_pred_G_V, masks_pred_G_fusion_V = net_G_V_7(imgs)
-                masks_pred_G_sigmoid_A_part = masks_pred_G_fusion_A.detach()
-                masks_pred_G_sigmoid_V_part = masks_pred_G_fusion_V.detach()
 
-                mask_pred, _, _, _ = net_G_7(
-                    imgs, masks_pred_G_sigmoid_A_part, masks_pred_G_sigmoid_V_part
-                )
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_7 = F.softmax(mask_pred_tensor_small, dim=1)
-                mask_pred_tensor_small_all += mask_pred_tensor_small_7.type(
-                    torch.FloatTensor
-                )
+def make_output_dirs(data_path):
+    for sub_dir in ("resized/", "raw/", "resize_uncertainty/", "raw_uncertainty/"):
+        if not os.path.isdir(data_path + sub_dir):
+            os.makedirs(data_path + sub_dir)
 
-                masks_pred_G_A, masks_pred_G_fusion_A = net_G_A_8(imgs)
-                masks_pred_G_V, masks_pred_G_fusion_V = net_G_V_8(imgs)
-                masks_pred_G_sigmoid_A_part = masks_pred_G_fusion_A.detach()
-                masks_pred_G_sigmoid_V_part = masks_pred_G_fusion_V.detach()
 
-                mask_pred, _, _, _ = net_G_8(
-                    imgs, masks_pred_G_sigmoid_A_part, masks_pred_G_sigmoid_V_part
-                )
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_8 = F.softmax(mask_pred_tensor_small, dim=1)
-                mask_pred_tensor_small_all += mask_pred_tensor_small_8.type(
-                    torch.FloatTensor
-                )
+def test_net(nets, loader, device, mode, dataset):
+    n_val = len(loader)
 
-                mask_pred_tensor_small_all = (mask_pred_tensor_small_all / 8).to(
-                    device=device
-                )
+    data_path = f"{AUTOMORPH_DATA}/Results/M2/artery_vein/"
+    make_output_dirs(data_path)
+
+    with tqdm(total=n_val, desc="Validation round", unit="batch", leave=False) as pbar:
+        for batch in loader:
+            imgs = batch["image"]
+            ori_width = batch["width"]
+            ori_height = batch["height"]
+            img_name = batch["name"]
+            imgs = imgs.to(device=device, dtype=torch.float32)
 
-                uncertainty_map = torch.sqrt(
-                    (
-                        torch.square(
-                            mask_pred_tensor_small_all - mask_pred_tensor_small_1
-                        )
-                        + torch.square(
-                            mask_pred_tensor_small_all - mask_pred_tensor_small_2
-                        )
-                        + torch.square(
-                            mask_pred_tensor_small_all - mask_pred_tensor_small_3
-                        )
-                        + torch.square(
-                            mask_pred_tensor_small_all - mask_pred_tensor_small_4
-                        )
-                        + torch.square(
-                            mask_pred_tensor_small_all - mask_pred_tensor_small_5
-                        )
-                        + torch.square(
-                            mask_pred_tensor_small_all - mask_pred_tensor_small_6
-                        )
-                        + torch.square(
-                            mask_pred_tensor_small_all - mask_pred_tensor_small_7
-                        )
-                        + torch.square(
-                            mask_pred_tensor_small_all - mask_pred_tensor_small_8
-                        )
-                    )
-                    / 8
+            prediction_decode, uncertainty_map = ensemble_av(nets, imgs, device)
+
+            n_img = prediction_decode.shape[0]
+
+            for i in range(n_img):
+                save_av(
+                    data_path,
+                    img_name[i],
+                    prediction_decode[i, ...],
+                    uncertainty_map[i, ...],
+                    ori_width[i],
+                    ori_height[i],
                 )
 
-                _, prediction_decode = torch.max(mask_pred_tensor_small_all, 1)
-                prediction_decode = prediction_decode.type(torch.FloatTensor)
-
-                if len(prediction_decode.size()) == 3:
-                    torch.unsqueeze(prediction_decode, 0)
-                if len(uncertainty_map.size()) == 3:
-                    torch.unsqueeze(uncertainty_map, 0)
-
-                n_img = prediction_decode.shape[0]
-
-                for i in range(n_img):
-                    save_image(
-                        uncertainty_map[i, ...] * 255,
-                        seg_uncertainty_small_path + img_name[i] + ".png",
-                    )
-                    save_image(
-                        uncertainty_map[i, 1, ...] * 255,
-                        seg_uncertainty_small_path + img_name[i] + "_artery.png",
-                    )
-                    save_image(
-                        uncertainty_map[i, 2, ...] * 255,
-                        seg_uncertainty_small_path + img_name[i] + "_vein.png",
-                    )
-
-                    uncertainty_img = Image.open(
-                        seg_uncertainty_small_path + img_name[i] + ".png"
-                    )
-                    uncertainty_img = uncertainty_img.resize(
-                        (int(ori_width[i]), int(ori_height[i]))
-                    )
-                    uncertainty_tensor = torchvision.transforms.ToTensor()(
-                        uncertainty_img
-                    )
-                    save_image(
-                        uncertainty_tensor,
-                        seg_uncertainty_raw_path + img_name[i] + ".png",
-                    )
-
-                    img_r = np.zeros(
-                        (
-                            prediction_decode[i, ...].shape[0],
-                            prediction_decode[i, ...].shape[1],
-                        )
-                    )
-                    img_g = np.zeros(
-                        (
-                            prediction_decode[i, ...].shape[0],
-                            prediction_decode[i, ...].shape[1],
-                        )
-                    )
-                    img_b = np.zeros(
-                        (
-                            prediction_decode[i, ...].shape[0],
-                            prediction_decode[i, ...].shape[1],
-                        )
-                    )
-
-                    img_r[prediction_decode[i, ...] == 1] = 255
-                    img_b[prediction_decode[i, ...] == 2] = 255
-                    img_g[prediction_decode[i, ...] == 3] = 255
-
-                    img_b = remove_small_objects(img_b > 0, 30, connectivity=5)
-                    img_r = remove_small_objects(img_r > 0, 30, connectivity=5)
-
-                    img_ = np.concatenate(
-                        (
-                            img_b[..., np.newaxis],
-                            img_g[..., np.newaxis],
-                            img_r[..., np.newaxis],
-                        ),
-                        axis=2,
-                    )
-
-                    cv2.imwrite(
-                        seg_results_small_path + img_name[i] + ".png",
-                        np.float32(img_) * 255,
-                    )
-
-                    img_ww = cv2.resize(
-                        np.float32(img_) * 255,
-                        (int(ori_width[i]), int(ori_height[i])),
-                        interpolation=cv2.INTER_NEAREST,
-                    )
-                    cv2.imwrite(seg_results_raw_path + img_name[i] + ".png", img_ww)
-
-                pbar.update(1)
+            pbar.update(1)
 
 
 def get_args():
@@ -467,362 +374,12 @@ if __name__ == "__main__":
         drop_last=False,
     )
 
-    net_G_1 = Generator_main(
-        input_channels=3, n_filters=32, n_classes=4, bilinear=False
-    )
-    net_G_A_1 = Generator_branch(
-        input_channels=3, n_filters=32, n_classes=4, bilinear=False
-    )
-    net_G_V_1 = Generator_branch(
-        input_channels=3, n_filters=32, n_classes=4, bilinear=False
-    )
-
-    net_G_2 = Generator_main(
-        input_channels=3, n_filters=32, n_classes=4, bilinear=False
-    )
-    net_G_A_2 = Generator_branch(
-        input_channels=3, n_filters=32, n_classes=4, bilinear=False
-    )
-    net_G_V_2 = Generator_branch(
-        input_channels=3, n_filters=32, n_classes=4, bilinear=False
-    )
-
-    net_G_3 = Generator_main(
-        input_channels=3, n_filters=32, n_classes=4, bilinear=False
-    )
-    net_G_A_3 = Generator_branch(
-        input_channels=3, n_filters=32, n_classes=4, bilinear=False
-    )
-    net_G_V_3 = Generator_branch(
-        input_channels=3, n_filters=32, n_classes=4, bilinear=False
-    )
-
-    net_G_4 = Generator_main(
-        input_channels=3, n_filters=32, n_classes=4, bilinear=False
-    )
-    net_G_A_4 = Generator_branch(
-        input_channels=3, n_filters=32, n_classes=4, bilinear=False
-    )
-    net_G_V_4 = Generator_branch(
-        input_channels=3, n_filters=32, n_classes=4, bilinear=False
-    )
-
-    net_G_5 = Generator_main(
-        input_channels=3, n_filters=32, n_classes=4, bilinear=False
-    )
-    net_G_A_5 = Generator_branch(
-        input_channels=3, n_filters=32, n_classes=4, bilinear=False
-    )
-    net_G_V_5 = Generator_branch(
-        input_channels=3, n_filters=32, n_classes=4, bilinear=False
-    )
-
-    net_G_6 = Generator_main(
-        input_channels=3, n_filters=32, n_classes=4, bilinear=False
-    )
-    net_G_A_6 = Generator_branch(
-        input_channels=3, n_filters=32, n_classes=4, bilinear=False
-    )
-    net_G_V_6 = Generator_branch(
-        input_channels=3, n_filters=32, n_classes=4, bilinear=False
-    )
-
-    net_G_7 = Generator_main(
-        input_channels=3, n_filters=32, n_classes=4, bilinear=False
-    )
-    net_G_A_7 = Generator_branch(
-        input_channels=3, n_filters=32, n_classes=4, bilinear=False
-    )
-    net_G_V_7 = Generator_branch(
-        input_channels=3, n_filters=32, n_classes=4, bilinear=False
-    )
-
-    net_G_8 = Generator_main(
-        input_channels=3, n_filters=32, n_classes=4, bilinear=False
-    )
-    net_G_A_8 = Generator_branch(
-        input_channels=3, n_filters=32, n_classes=4, bilinear=False
-    )
-    net_G_V_8 = Generator_branch(
-        input_channels=3, n_filters=32, n_classes=4, bilinear=False
-    )
-
-    checkpoint_saved_1 = "./M2_Artery_vein/ALL-AV/{}_{}/Discriminator_unet/".format(
-        args.jn, 28
-    )
-    checkpoint_saved_2 = "./M2_Artery_vein/ALL-AV/{}_{}/Discriminator_unet/".format(
-        args.jn, 30
-    )
-    checkpoint_saved_3 = "./M2_Artery_vein/ALL-AV/{}_{}/Discriminator_unet/".format(
-        args.jn, 32
-    )
-    checkpoint_saved_4 = "./M2_Artery_vein/ALL-AV/{}_{}/Discriminator_unet/".format(
-        args.jn, 34
-    )
-    checkpoint_saved_5 = "./M2_Artery_vein/ALL-AV/{}_{}/Discriminator_unet/".format(
-        args.jn, 36
-    )
-    checkpoint_saved_6 = "./M2_Artery_vein/ALL-AV/{}_{}/Discriminator_unet/".format(
-        args.jn, 38
-    )
-    checkpoint_saved_7 = "./M2_Artery_vein/ALL-AV/{}_{}/Discriminator_unet/".format(
-        args.jn, 40
-    )
-    checkpoint_saved_8 = "./M2_Artery_vein/ALL-AV/{}_{}/Discriminator_unet/".format(
-        args.jn, 42
-    )
+    nets = load_av_ensemble(args.jn, device)
 
     for i in range(1):
-        net_G_1.load_state_dict(
-            torch.load(
-                checkpoint_saved_1 + "CP_best_F1_all.pth",
-                map_location=device,
-                weights_only=True,
-            )
-        )
-        net_G_A_1.load_state_dict(
-            torch.load(
-                checkpoint_saved_1 + "CP_best_F1_A.pth",
-                map_location=device,
-                weights_only=True,
-            )
-        )
-        net_G_V_1.load_state_dict(
-            torch.load(
-                checkpoint_saved_1 + "CP_best_F1_V.pth",
-                map_location=device,
-                weights_only=True,
-            )
-        )
-        net_G_1.eval()
-        net_G_A_1.eval()
-        net_G_V_1.eval()
-        net_G_1.to(device=device)
-        net_G_A_1.to(device=device)
-        net_G_V_1.to(device=device)
-
-        net_G_2.load_state_dict(
-            torch.load(
-                checkpoint_saved_2 + "CP_best_F1_all.pth",
-                map_location=device,
-                weights_only=True,
-            )
-        )
-        net_G_A_2.load_state_dict(
-            torch.load(
-                checkpoint_saved_2 + "CP_best_F1_A.pth",
-                map_location=device,
-                weights_only=True,
-            )
-        )
-        net_G_V_2.load_state_dict(
-            torch.load(
-                checkpoint_saved_2 + "CP_best_F1_V.pth",
-                map_location=device,
-                weights_only=True,
-            )
-        )
-        net_G_2.eval()
-        net_G_A_2.eval()
-        net_G_V_2.eval()
-        net_G_2.to(device=device)
-        net_G_A_2.to(device=device)
-        net_G_V_2.to(device=device)
-
-        net_G_3.load_state_dict(
-            torch.load(
-                checkpoint_saved_3 + "CP_best_F1_all.pth",
-                map_location=device,
-                weights_only=True,
-            )
-        )
-        net_G_A_3.load_state_dict(
-            torch.load(
-                checkpoint_saved_3 + "CP_best_F1_A.pth",
-                map_location=device,
-                weights_only=True,
-            )
-        )
-        net_G_V_3.load_state_dict(
-            torch.load(
-                checkpoint_saved_3 + "CP_best_F1_V.pth",
-                map_location=device,
-                weights_only=True,
-            )
-        )
-        net_G_3.eval()
-        net_G_A_3.eval()
-        net_G_V_3.eval()
-        net_G_3.to(device=device)
-        net_G_A_3.to(device=device)
-        net_G_V_3.to(device=device)
-
-        net_G_4.load_state_dict(
-            torch.load(
-                checkpoint_saved_4 + "CP_best_F1_all.pth",
-                map_location=device,
-                weights_only=True,
-            )
-        )
-        net_G_A_4.load_state_dict(
-            torch.load(
-                checkpoint_saved_4 + "CP_best_F1_A.pth",
-                map_location=device,
-                weights_only=True,
-            )
-        )
-        net_G_V_4.load_state_dict(
-            torch.load(
-                checkpoint_saved_4 + "CP_best_F1_V.pth",
-                map_location=device,
-                weights_only=True,
-            )
-        )
-        net_G_4.eval()
-        net_G_A_4.eval()
-        net_G_V_4.eval()
-        net_G_4.to(device=device)
-        net_G_A_4.to(device=device)
-        net_G_V_4.to(device=device)
-
-        net_G_5.load_state_dict(
-            torch.load(
-                checkpoint_saved_5 + "CP_best_F1_all.pth",
-                map_location=device,
-                weights_only=True,
-            )
-        )
-        net_G_A_5.load_state_dict(
-            torch.load(
-                checkpoint_saved_5 + "CP_best_F1_A.pth",
-                map_location=device,
-                weights_only=True,
-            )
-        )
-        net_G_V_5.load_state_dict(
-            torch.load(
-                checkpoint_saved_5 + "CP_best_F1_V.pth",
-                map_location=device,
-                weights_only=True,
-            )
-        )
-        net_G_5.eval()
-        net_G_A_5.eval()
-        net_G_V_5.eval()
-        net_G_5.to(device=device)
-        net_G_A_5.to(device=device)
-        net_G_V_5.to(device=device)
-
-        net_G_6.load_state_dict(
-            torch.load(
-                checkpoint_saved_6 + "CP_best_F1_all.pth",
-                map_location=device,
-                weights_only=True,
-            )
-        )
-        net_G_A_6.load_state_dict(
-            torch.load(
-                checkpoint_saved_6 + "CP_best_F1_A.pth",
-                map_location=device,
-                weights_only=True,
-            )
-        )
-        net_G_V_6.load_state_dict(
-            torch.load(
-                checkpoint_saved_6 + "CP_best_F1_V.pth",
-                map_location=device,
-                weights_only=True,
-            )
-        )
-        net_G_6.eval()
-        net_G_A_6.eval()
-        net_G_V_6.eval()
-        net_G_6.to(device=device)
-        net_G_A_6.to(device=device)
-        net_G_V_6.to(device=device)
-
-        net_G_7.load_state_dict(
-            torch.load(
-                checkpoint_saved_7 + "CP_best_F1_all.pth",
-                map_location=device,
-                weights_only=True,
-            )
-        )
-        net_G_A_7.load_state_dict(
-            torch.load(
-                checkpoint_saved_7 + "CP_best_F1_A.pth",
-                map_location=device,
-                weights_only=True,
-            )
-        )
-        net_G_V_7.load_state_dict(
-            torch.load(
-                checkpoint_saved_7 + "CP_best_F1_V.pth",
-                map_location=device,
-                weights_only=True,
-            )
-        )
-        net_G_7.eval()
-        net_G_A_7.eval()
-        net_G_V_7.eval()
-        net_G_7.to(device=device)
-        net_G_A_7.to(device=device)
-        net_G_V_7.to(device=device)
-
-        net_G_8.load_state_dict(
-            torch.load(
-                checkpoint_saved_8 + "CP_best_F1_all.pth",
-                map_location=device,
-                weights_only=True,
-            )
-        )
-        net_G_A_8.load_state_dict(
-            torch.load(
-                checkpoint_saved_8 + "CP_best_F1_A.pth",
-                map_location=device,
-                weights_only=True,
-            )
-        )
-        net_G_V_8.load_state_dict(
-            torch.load(
-                checkpoint_saved_8 + "CP_best_F1_V.pth",
-                map_location=device,
-                weights_only=True,
-            )
-        )
-        net_G_8.eval()
-        net_G_A_8.eval()
-        net_G_V_8.eval()
-        net_G_8.to(device=device)
-        net_G_A_8.to(device=device)
-        net_G_V_8.to(device=device)
-
         if mode != "vessel":
             test_net(
-                net_G_1,
-                net_G_A_1,
-                net_G_V_1,
-                net_G_2,
-                net_G_A_2,
-                net_G_V_2,
-                net_G_3,
-                net_G_A_3,
-                net_G_V_3,
-                net_G_4,
-                net_G_A_4,
-                net_G_V_4,
-                net_G_5,
-                net_G_A_5,
-                net_G_V_5,
-                net_G_6,
-                net_G_A_6,
-                net_G_V_6,
-                net_G_7,
-                net_G_A_7,
-                net_G_V_7,
-                net_G_8,
-                net_G_A_8,
-                net_G_V_8,
+                nets,
                 loader=test_loader,
                 device=device,
                 mode=mode,
@@ -12,6 +12,16 @@ from torchvision.utils import save_image
 from scipy.ndimage import rotate
 from PIL import Image, ImageEnhance
 import cv2
+import os
+import importlib.util
+
+# the reader of the M0 cache is shared by every stage, loaded from its file as
+# M0_Preprocess is not a package
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_spec = importlib.util.spec_from_file_location(
+    'fundus_cache', os.path.join(_root, 'M0_Preprocess', 'fundus_cache.py'))
+fundus_cache = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(fundus_cache)
 
 
 class SEDataset(Dataset):
@@ -184,6 +194,8 @@ class SEDataset(Dataset):
     
     
     
+
+
 class SEDataset_out(Dataset):
     def __init__(self, imgs_dir, label_dir, mask_dir, img_size, dataset_name, pthrehold, uniform, train_or=True):
         self.imgs_dir = imgs_dir
@@ -199,6 +211,7 @@ class SEDataset_out(Dataset):
         i = 0
         self.ids = [splitext(file)[0] for file in listdir(imgs_dir)
                     if not file.startswith('.')]
+        self.cache = fundus_cache.load_m0_cache(imgs_dir, f'{img_size[0]}x{img_size[1]}_bicubic')
         #logging.info(f'Creating dataset with {(self.ids)} ')
         logging.info(f'Creating dataset with {len(self.ids)} examples')
 
@@ -257,14 +270,17 @@ class SEDataset_out(Dataset):
 
     def __getitem__(self, i):
         idx = self.ids[i]
-        img_file = glob(self.imgs_dir + idx + '.*')
+        if idx in self.cache:
+            img, ori_width, ori_height = self.cache[idx]
+        else:
+            img_file = glob(self.imgs_dir + idx + '.*')
 
-        assert len(img_file) == 1, \
-            f'Either no image or multiple images found for the ID {idx}: {img_file}'
+            assert len(img_file) == 1, \
+                f'Either no image or multiple images found for the ID {idx}: {img_file}'
 
-        img = Image.open(img_file[0])
-        ori_width, ori_height = img.size
-        img = img.resize(self.img_size)
+            img = Image.open(img_file[0])
+            ori_width, ori_height = img.size
+            img = img.resize(self.img_size)
         img = self.preprocess(img, self.dataset_name, self.img_size, self.train_or, self.pthrehold)
 
         i += 1
@@ -1,16 +1,15 @@
 import argparse
 import logging
 import os
+import cv2
 import torch
 import numpy as np
 from tqdm import tqdm
 from model import Segmenter
 from dataset import SEDataset_out
 from torch.utils.data import DataLoader
-from torchvision.utils import save_image
 from PIL import Image
 from utils import Define_image_size
-import torchvision
 from skimage.morphology import skeletonize, remove_small_objects
 from skimage import io
 from FD_cal import fractal_dimension, vessel_density
@@ -21,11 +20,12 @@ ImageFile.LOAD_TRUNCATED_IMAGES = True
 AUTOMORPH_DATA = os.getenv("AUTOMORPH_DATA", "..")
 
 
-def filter_frag(data_path):
+def filter_frag(data_path, image_list=None):
     if os.path.isdir(data_path + "resize_binary/.ipynb_checkpoints"):
         shutil.rmtree(data_path + "resize_binary/.ipynb_checkpoints")
 
-    image_list = os.listdir(data_path + "resize_binary")
+    if image_list is None:
+        image_list = os.listdir(data_path + "resize_binary")
     FD_cal = []
     name_list = []
     VD_cal = []
@@ -65,57 +65,152 @@ def filter_frag(data_path):
     return FD_cal, name_list, VD_cal, width_cal
 
 
-def segment_fundus(
+ENSEMBLE_SEEDS = (24, 26, 28, 30, 32, 34, 36, 38, 40, 42)
+
+
+def ensemble_checkpoints(dataset_train, job_name, root="."):
+    return [
+        "{}/M2_Vessel_seg/Saved_model/train_on_{}/{}_savebest_randomseed_{}/G_best_F1_epoch.pth".format(
+            root, dataset_train, job_name, seed
+        )
+        for seed in ENSEMBLE_SEEDS
+    ]
+
+
+def load_segmenters(dataset_train, job_name, device, root="."):
+    """Build the segmenter ensemble and load the best-F1 checkpoint of every seed"""
+    nets = []
+    for checkpoint_path in ensemble_checkpoints(dataset_train, job_name, root):
+        net = Segmenter(input_channels=3, n_filters=32, n_classes=1, bilinear=False)
+        net.load_state_dict(
+            torch.load(
+                checkpoint_path,
+                map_location=device,
+                weights_only=True,
+            )
+        )
+        net.eval()
+        net.to(device=device)
+        nets.append(net)
+    return nets
+
+
+def ensemble_segment(nets, imgs):
+    """Return the mean vessel probability and its uncertainty over the ensemble"""
+    with torch.no_grad():
+        mask_pred_sigmoids = [torch.sigmoid(net(imgs)) for net in nets]
+
+    mask_pred_sigmoid = sum(mask_pred_sigmoids) / len(nets)
+
+    uncertainty_map = torch.sqrt(
+        sum(
+            torch.square(mask_pred_sigmoid - mask_pred_sigmoid_n)
+            for mask_pred_sigmoid_n in mask_pred_sigmoids
+        )
+        / len(nets)
+    )
+    return mask_pred_sigmoid, uncertainty_map
+
+
+def to_image(tensor):
+    """The uint8 RGB(A) array torchvision's save_image writes for one image tensor"""
+    if tensor.dim() == 2:
+        tensor = tensor.unsqueeze(0)
+    if tensor.size(0) == 1:
+        tensor = torch.cat((tensor, tensor, tensor), 0)
+    return (
+        tensor.mul(255).add_(0.5).clamp_(0, 255).permute(1, 2, 0).to("cpu", torch.uint8)
+    ).numpy()
+
+
+def write_rgb(write, path, image):
+    """Write an RGB(A) array with write, which takes cv2's BGR(A) order"""
+    write(path, image[..., [2, 1, 0, 3][: image.shape[2]]])
+
+
+def save_segmentation(
     data_path,
-    net_1,
-    net_2,
-    net_3,
-    net_4,
-    net_5,
-    net_6,
-    net_7,
-    net_8,
-    net_9,
-    net_10,
-    loader,
-    device,
-    dataset_name,
-    job_name,
-    mask_or,
-    train_or,
+    n_img_name,
+    mask_pred_sigmoid,
+    uncertainty_map,
+    n_ori_width,
+    n_ori_height,
+    write=cv2.imwrite,
 ):
-    n_val = len(loader)
-    tot = 0
-    num = 0
-    i = 0
-
-    seg_results_small_path = "./outside_test/segs/"
-    seg_results_raw_path = "./outside_test/segs/"
+    """
+    Write the resized and raw-size probability, binary and uncertainty maps of one
+    image with write, cv2.imwrite or the write of an automorph ImageWriter
+    """
     seg_results_small_path = data_path + "resize/"
     seg_results_small_binary_path = data_path + "resize_binary/"
     seg_results_raw_path = data_path + "raw/"
     seg_results_raw_binary_path = data_path + "raw_binary/"
+    seg_uncertainty_small_path = data_path + "resize_uncertainty/"
+    seg_uncertainty_raw_path = data_path + "raw_uncertainty/"
 
-    if not os.path.isdir(seg_results_small_path):
-        os.makedirs(seg_results_small_path)
+    uncertainty_small = to_image(uncertainty_map)
+    write_rgb(write, seg_uncertainty_small_path + n_img_name + ".png", uncertainty_small)
+    uncertainty_raw = np.asarray(
+        Image.fromarray(uncertainty_small)
+        .resize((int(n_ori_width), int(n_ori_height)))
+        .convert("L")
+    )
+    write(
+        seg_uncertainty_raw_path + n_img_name + ".png",
+        cv2.cvtColor(uncertainty_raw, cv2.COLOR_GRAY2BGR),
+    )
 
-    if not os.path.isdir(seg_results_raw_path):
-        os.makedirs(seg_results_raw_path)
+    mask_pred_small = to_image(mask_pred_sigmoid)
+    write_rgb(write, seg_results_small_path + n_img_name + ".png", mask_pred_small)
+    write_rgb(
+        write,
+        seg_results_small_binary_path + n_img_name + ".png",
+        to_image((mask_pred_sigmoid >= 0.5).float()),
+    )
 
-    if not os.path.isdir(seg_results_small_binary_path):
-        os.makedirs(seg_results_small_binary_path)
+    mask_pred_raw = np.asarray(
+        Image.fromarray(mask_pred_small)
+        .resize((int(n_ori_width), int(n_ori_height)))
+        .convert("L")
+    )
+    write(
+        seg_results_raw_path + n_img_name + ".png",
+        cv2.cvtColor(mask_pred_raw, cv2.COLOR_GRAY2BGR),
+    )
+    # >= 0.5 of the 8 bit probability
+    mask_pred_raw_bin = np.where(mask_pred_raw >= 128, np.uint8(255), np.uint8(0))
+    write(
+        seg_results_raw_binary_path + n_img_name + ".png",
+        cv2.cvtColor(mask_pred_raw_bin, cv2.COLOR_GRAY2BGR),
+    )
 
-    if not os.path.isdir(seg_results_raw_binary_path):
-        os.makedirs(seg_results_raw_binary_path)
 
-    seg_uncertainty_small_path = data_path + "resize_uncertainty/"
-    if not os.path.isdir(seg_uncertainty_small_path):
-        os.makedirs(seg_uncertainty_small_path)
+def make_output_dirs(data_path):
+    for sub_dir in (
+        "resize/",
+        "resize_binary/",
+        "raw/",
+        "raw_binary/",
+        "resize_uncertainty/",
+        "raw_uncertainty/",
+    ):
+        if not os.path.isdir(data_path + sub_dir):
+            os.makedirs(data_path + sub_dir)
 
-    seg_uncertainty_raw_path = data_path + "raw_uncertainty/"
 
-    if not os.path.isdir(seg_uncertainty_raw_path):
-        os.makedirs(seg_uncertainty_raw_path)
+def segment_fundus(
+    data_path,
+    nets,
+    loader,
+    device,
+    dataset_name,
+    job_name,
+    mask_or,
+    train_or,
+):
+    n_val = len(loader)
+
+    make_output_dirs(data_path)
 
     with tqdm(total=n_val, desc="Validation round", unit="batch", leave=False) as pbar:
         for batch in loader:
@@ -127,108 +222,18 @@ def segment_fundus(
 
             imgs = imgs.to(device=device, dtype=torch.float32)
 
-            with torch.no_grad():
-                mask_pred_1 = net_1(imgs)
-                mask_pred_2 = net_2(imgs)
-                mask_pred_3 = net_3(imgs)
-                mask_pred_4 = net_4(imgs)
-                mask_pred_5 = net_5(imgs)
-                mask_pred_6 = net_6(imgs)
-                mask_pred_7 = net_7(imgs)
-                mask_pred_8 = net_8(imgs)
-                mask_pred_9 = net_9(imgs)
-                mask_pred_10 = net_10(imgs)
-
-            mask_pred_sigmoid_1 = torch.sigmoid(mask_pred_1)
-            mask_pred_sigmoid_2 = torch.sigmoid(mask_pred_2)
-            mask_pred_sigmoid_3 = torch.sigmoid(mask_pred_3)
-            mask_pred_sigmoid_4 = torch.sigmoid(mask_pred_4)
-            mask_pred_sigmoid_5 = torch.sigmoid(mask_pred_5)
-            mask_pred_sigmoid_6 = torch.sigmoid(mask_pred_6)
-            mask_pred_sigmoid_7 = torch.sigmoid(mask_pred_7)
-            mask_pred_sigmoid_8 = torch.sigmoid(mask_pred_8)
-            mask_pred_sigmoid_9 = torch.sigmoid(mask_pred_9)
-            mask_pred_sigmoid_10 = torch.sigmoid(mask_pred_10)
-
-            mask_pred_sigmoid = (
-                mask_pred_sigmoid_1
-                + mask_pred_sigmoid_2
-                + mask_pred_sigmoid_3
-                + mask_pred_sigmoid_4
-                + mask_pred_sigmoid_5
-                + mask_pred_sigmoid_6
-                + mask_pred_sigmoid_7
-                + mask_pred_sigmoid_8
-                + mask_pred_sigmoid_9
-                + mask_pred_sigmoid_10
-            ) / 10
-
-            uncertainty_map = torch.sqrt(
-                (
-                    torch.square(mask_pred_sigmoid - mask_pred_sigmoid_1)
-                    + torch.square(mask_pred_sigmoid - mask_pred_sigmoid_2)
-                    + torch.square(mask_pred_sigmoid - mask_pred_sigmoid_3)
-                    + torch.square(mask_pred_sigmoid - mask_pred_sigmoid_4)
-                    + torch.square(mask_pred_sigmoid - mask_pred_sigmoid_5)
-                    + torch.square(mask_pred_sigmoid - mask_pred_sigmoid_6)
-                    + torch.square(mask_pred_sigmoid - mask_pred_sigmoid_7)
-                    + torch.square(mask_pred_sigmoid - mask_pred_sigmoid_8)
-                    + torch.square(mask_pred_sigmoid - mask_pred_sigmoid_9)
-                    + torch.square(mask_pred_sigmoid - mask_pred_sigmoid_10)
-                )
-                / 10
-            )
+            mask_pred_sigmoid, uncertainty_map = ensemble_segment(nets, imgs)
 
             n_image = mask_pred_sigmoid.shape[0]
 
             for i in range(n_image):
-                n_img_name = img_name[i]
-                n_ori_width = ori_width[i]
-                n_ori_height = ori_height[i]
-
-                save_image(
-                    torch.unsqueeze(uncertainty_map[i, ...], 0),
-                    seg_uncertainty_small_path + n_img_name + ".png",
-                )
-                uncertainty_img = (
-                    Image.open(seg_uncertainty_small_path + n_img_name + ".png")
-                    .resize((n_ori_width, n_ori_height))
-                    .convert("L")
-                )
-                uncertainty_tensor = torchvision.transforms.ToTensor()(uncertainty_img)
-                save_image(
-                    uncertainty_tensor, seg_uncertainty_raw_path + n_img_name + ".png"
-                )
-
-                save_image(
-                    torch.unsqueeze(mask_pred_sigmoid[i, ...], 0),
-                    seg_results_small_path + n_img_name + ".png",
-                )
-                mask_pred_resize_bin = torch.zeros(
-                    torch.unsqueeze(mask_pred_sigmoid[i, ...], 0).shape
-                )
-                mask_pred_resize_bin[
-                    torch.unsqueeze(mask_pred_sigmoid[i, ...], 0) >= 0.5
-                ] = 1
-                save_image(
-                    mask_pred_resize_bin,
-                    seg_results_small_binary_path + n_img_name + ".png",
-                )
-
-                mask_pred_img = (
-                    Image.open(seg_results_small_path + n_img_name + ".png")
-                    .resize((n_ori_width, n_ori_height))
-                    .convert("L")
-                )
-                mask_pred_tensor = torchvision.transforms.ToTensor()(mask_pred_img)
-
-                mask_pred_numpy_bin = torch.zeros(mask_pred_tensor.shape)
-                mask_pred_numpy_bin[mask_pred_tensor >= 0.5] = 1
-
-                save_image(mask_pred_tensor, seg_results_raw_path + n_img_name + ".png")
-                save_image(
-                    mask_pred_numpy_bin,
-                    seg_results_raw_binary_path + n_img_name + ".png",
+                save_segmentation(
+                    data_path,
+                    img_name[i],
+                    mask_pred_sigmoid[i, ...],
+                    uncertainty_map[i, ...],
+                    ori_width[i],
+                    ori_height[i],
                 )
 
             pbar.update(1)
@@ -274,171 +279,11 @@ def test_net(
         drop_last=False,
     )
 
-    dir_checkpoint_1 = (
-        "./M2_Vessel_seg/Saved_model/train_on_{}/{}_savebest_randomseed_{}/".format(
-            dataset_train, job_name, 24
-        )
-    )
-    dir_checkpoint_2 = (
-        "./M2_Vessel_seg/Saved_model/train_on_{}/{}_savebest_randomseed_{}/".format(
-            dataset_train, job_name, 26
-        )
-    )
-    dir_checkpoint_3 = (
-        "./M2_Vessel_seg/Saved_model/train_on_{}/{}_savebest_randomseed_{}/".format(
-            dataset_train, job_name, 28
-        )
-    )
-    dir_checkpoint_4 = (
-        "./M2_Vessel_seg/Saved_model/train_on_{}/{}_savebest_randomseed_{}/".format(
-            dataset_train, job_name, 30
-        )
-    )
-    dir_checkpoint_5 = (
-        "./M2_Vessel_seg/Saved_model/train_on_{}/{}_savebest_randomseed_{}/".format(
-            dataset_train, job_name, 32
-        )
-    )
-    dir_checkpoint_6 = (
-        "./M2_Vessel_seg/Saved_model/train_on_{}/{}_savebest_randomseed_{}/".format(
-            dataset_train, job_name, 34
-        )
-    )
-    dir_checkpoint_7 = (
-        "./M2_Vessel_seg/Saved_model/train_on_{}/{}_savebest_randomseed_{}/".format(
-            dataset_train, job_name, 36
-        )
-    )
-    dir_checkpoint_8 = (
-        "./M2_Vessel_seg/Saved_model/train_on_{}/{}_savebest_randomseed_{}/".format(
-            dataset_train, job_name, 38
-        )
-    )
-    dir_checkpoint_9 = (
-        "./M2_Vessel_seg/Saved_model/train_on_{}/{}_savebest_randomseed_{}/".format(
-            dataset_train, job_name, 40
-        )
-    )
-    dir_checkpoint_10 = (
-        "./M2_Vessel_seg/Saved_model/train_on_{}/{}_savebest_randomseed_{}/".format(
-            dataset_train, job_name, 42
-        )
-    )
-
-    net_1 = Segmenter(input_channels=3, n_filters=32, n_classes=1, bilinear=False)
-    net_2 = Segmenter(input_channels=3, n_filters=32, n_classes=1, bilinear=False)
-    net_3 = Segmenter(input_channels=3, n_filters=32, n_classes=1, bilinear=False)
-    net_4 = Segmenter(input_channels=3, n_filters=32, n_classes=1, bilinear=False)
-    net_5 = Segmenter(input_channels=3, n_filters=32, n_classes=1, bilinear=False)
-    net_6 = Segmenter(input_channels=3, n_filters=32, n_classes=1, bilinear=False)
-    net_7 = Segmenter(input_channels=3, n_filters=32, n_classes=1, bilinear=False)
-    net_8 = Segmenter(input_channels=3, n_filters=32, n_classes=1, bilinear=False)
-    net_9 = Segmenter(input_channels=3, n_filters=32, n_classes=1, bilinear=False)
-    net_10 = Segmenter(input_channels=3, n_filters=32, n_classes=1, bilinear=False)
-
-    net_1.load_state_dict(
-        torch.load(
-            dir_checkpoint_1 + "G_best_F1_epoch.pth",
-            map_location=device,
-            weights_only=True,
-        )
-    )
-    net_1.eval()
-    net_1.to(device=device)
-    net_2.load_state_dict(
-        torch.load(
-            dir_checkpoint_2 + "G_best_F1_epoch.pth",
-            map_location=device,
-            weights_only=True,
-        )
-    )
-    net_2.eval()
-    net_2.to(device=device)
-    net_3.load_state_dict(
-        torch.load(
-            dir_checkpoint_3 + "G_best_F1_epoch.pth",
-            map_location=device,
-            weights_only=True,
-        )
-    )
-    net_3.eval()
-    net_3.to(device=device)
-    net_4.load_state_dict(
-        torch.load(
-            dir_checkpoint_4 + "G_best_F1_epoch.pth",
-            map_location=device,
-            weights_only=True,
-        )
-    )
-    net_4.eval()
-    net_4.to(device=device)
-    net_5.load_state_dict(
-        torch.load(
-            dir_checkpoint_5 + "G_best_F1_epoch.pth",
-            map_location=device,
-            weights_only=True,
-        )
-    )
-    net_5.eval()
-    net_5.to(device=device)
-    net_6.load_state_dict(
-        torch.load(
-            dir_checkpoint_6 + "G_best_F1_epoch.pth",
-            map_location=device,
-            weights_only=True,
-        )
-    )
-    net_6.eval()
-    net_6.to(device=device)
-    net_7.load_state_dict(
-        torch.load(
-            dir_checkpoint_7 + "G_best_F1_epoch.pth",
-            map_location=device,
-            weights_only=True,
-        )
-    )
-    net_7.eval()
-    net_7.to(device=device)
-    net_8.load_state_dict(
-        torch.load(
-            dir_checkpoint_8 + "G_best_F1_epoch.pth",
-            map_location=device,
-            weights_only=True,
-        )
-    )
-    net_8.eval()
-    net_8.to(device=device)
-    net_9.load_state_dict(
-        torch.load(
-            dir_checkpoint_9 + "G_best_F1_epoch.pth",
-            map_location=device,
-            weights_only=True,
-        )
-    )
-    net_9.eval()
-    net_9.to(device=device)
-    net_10.load_state_dict(
-        torch.load(
-            dir_checkpoint_10 + "G_best_F1_epoch.pth",
-            map_location=device,
-            weights_only=True,
-        )
-    )
-    net_10.eval()
-    net_10.to(device=device)
+    nets = load_segmenters(dataset_train, job_name, device)
 
     segment_fundus(
         data_path,
-        net_1,
-        net_2,
-        net_3,
-        net_4,
-        net_5,
-        net_6,
-        net_7,
-        net_8,
-        net_9,
-        net_10,
+        nets,
         test_loader,
         device,
         dataset_train,
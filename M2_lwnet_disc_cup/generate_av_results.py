@@ -6,10 +6,8 @@ import cv2
 import numpy as np
 import shutil
 from PIL import Image
-from torchvision.utils import save_image
 import torch
 import torch.nn.functional as F
-import torchvision
 from models.get_model import get_arch
 from utils.get_loaders import get_test_dataset
 from utils.model_saving_loading import load_model
@@ -80,12 +78,19 @@ def intersection(mask, vessel_, it_x, it_y):
     return mask, active_neighbours
 
 
-def optic_disc_centre(result_path, binary_vessel_path, artery_vein_path):
+def optic_disc_centre(
+    result_path, binary_vessel_path, artery_vein_path, write=cv2.imwrite
+):
+    """
+    Centre the vessel maps on the disc or the macula and cut zones B and C out
+    of them, written with write, cv2.imwrite or the write of an automorph
+    ImageWriter
+    """
     if os.path.exists(result_path + ".ipynb_checkpoints"):
         shutil.rmtree(result_path + ".ipynb_checkpoints")
 
-    optic_binary_result_path = f"{AUTOMORPH_DATA}/Results/M3/Disc_centred/"
-    macular_binary_result_path = f"{AUTOMORPH_DATA}/Results/M3/Macular_centred/"
+    optic_binary_result_path = result_path.split("M2")[0] + "M3/Disc_centred/"
+    macular_binary_result_path = result_path.split("M2")[0] + "M3/Macular_centred/"
 
     # 2023/08/24
     disc_process_binary_vessel_path = (
@@ -467,27 +472,19 @@ def optic_disc_centre(result_path, binary_vessel_path, artery_vein_path):
 
                 if (distance_ / disc_cup_912.shape[1]) < 0.1:
                     optic_centre_list.append(i)
-                    cv2.imwrite(
-                        B_optic_process_binary_vessel_path + i, binary_process_B
-                    )
-                    cv2.imwrite(B_optic_process_artery_path + i, artery_process_B)
-                    cv2.imwrite(B_optic_process_vein_path + i, vein_process_B)
-                    cv2.imwrite(
-                        B_optic_skeleton_binary_vessel_path + i, binary_skeleton_B
-                    )
-                    cv2.imwrite(B_optic_skeleton_artery_path + i, artery_skeleton_B)
-                    cv2.imwrite(B_optic_skeleton_vein_path + i, vein_skeleton_B)
-
-                    cv2.imwrite(
-                        C_optic_process_binary_vessel_path + i, binary_process_C
-                    )
-                    cv2.imwrite(C_optic_process_artery_path + i, artery_process_C)
-                    cv2.imwrite(C_optic_process_vein_path + i, vein_process_C)
-                    cv2.imwrite(
-                        C_optic_skeleton_binary_vessel_path + i, binary_skeleton_C
-                    )
-                    cv2.imwrite(C_optic_skeleton_artery_path + i, artery_skeleton_C)
-                    cv2.imwrite(C_optic_skeleton_vein_path + i, vein_skeleton_C)
+                    write(B_optic_process_binary_vessel_path + i, binary_process_B)
+                    write(B_optic_process_artery_path + i, artery_process_B)
+                    write(B_optic_process_vein_path + i, vein_process_B)
+                    write(B_optic_skeleton_binary_vessel_path + i, binary_skeleton_B)
+                    write(B_optic_skeleton_artery_path + i, artery_skeleton_B)
+                    write(B_optic_skeleton_vein_path + i, vein_skeleton_B)
+
+                    write(C_optic_process_binary_vessel_path + i, binary_process_C)
+                    write(C_optic_process_artery_path + i, artery_process_C)
+                    write(C_optic_process_vein_path + i, vein_process_C)
+                    write(C_optic_skeleton_binary_vessel_path + i, binary_skeleton_C)
+                    write(C_optic_skeleton_artery_path + i, artery_skeleton_C)
+                    write(C_optic_skeleton_vein_path + i, vein_skeleton_C)
 
                     # 2023/08/24
                     shutil.copy(
@@ -532,37 +529,29 @@ def optic_disc_centre(result_path, binary_vessel_path, artery_vein_path):
 
                 else:
                     macular_centre_list.append(i)
-                    cv2.imwrite(
+                    write(
                         zone_b_macular_process_binary_vessel_path + i, binary_process_B
                     )
-                    cv2.imwrite(
-                        zone_b_macular_process_artery_path + i, artery_process_B
-                    )
-                    cv2.imwrite(zone_b_macular_process_vein_path + i, vein_process_B)
-                    cv2.imwrite(
+                    write(zone_b_macular_process_artery_path + i, artery_process_B)
+                    write(zone_b_macular_process_vein_path + i, vein_process_B)
+                    write(
                         zone_b_macular_skeleton_binary_vessel_path + i,
                         binary_skeleton_B,
                     )
-                    cv2.imwrite(
-                        zone_b_macular_skeleton_artery_path + i, artery_skeleton_B
-                    )
-                    cv2.imwrite(zone_b_macular_skeleton_vein_path + i, vein_skeleton_B)
+                    write(zone_b_macular_skeleton_artery_path + i, artery_skeleton_B)
+                    write(zone_b_macular_skeleton_vein_path + i, vein_skeleton_B)
 
-                    cv2.imwrite(
+                    write(
                         zone_c_macular_process_binary_vessel_path + i, binary_process_C
                     )
-                    cv2.imwrite(
-                        zone_c_macular_process_artery_path + i, artery_process_C
-                    )
-                    cv2.imwrite(zone_c_macular_process_vein_path + i, vein_process_C)
-                    cv2.imwrite(
+                    write(zone_c_macular_process_artery_path + i, artery_process_C)
+                    write(zone_c_macular_process_vein_path + i, vein_process_C)
+                    write(
                         zone_c_macular_skeleton_binary_vessel_path + i,
                         binary_skeleton_C,
                     )
-                    cv2.imwrite(
-                        zone_c_macular_skeleton_artery_path + i, artery_skeleton_C
-                    )
-                    cv2.imwrite(zone_c_macular_skeleton_vein_path + i, vein_skeleton_C)
+                    write(zone_c_macular_skeleton_artery_path + i, artery_skeleton_C)
+                    write(zone_c_macular_skeleton_vein_path + i, vein_skeleton_C)
 
                     shutil.copy(
                         binary_vessel_path + "binary_process/" + i,
@@ -713,219 +702,189 @@ def optic_disc_centre(result_path, binary_vessel_path, artery_vein_path):
     )
 
 
-def prediction_eval(
-    model_1, model_2, model_3, model_4, model_5, model_6, model_7, model_8, test_loader
-):
-    n_val = len(test_loader)
+ENSEMBLE_SEEDS = (28, 30, 32, 34, 36, 38, 40, 42)
 
-    seg_results_small_path = f"{AUTOMORPH_DATA}/Results/M2/optic_disc_cup/resized/"
-    seg_results_raw_path = f"{AUTOMORPH_DATA}/Results/M2/optic_disc_cup/raw/"
 
-    if not os.path.isdir(seg_results_small_path):
-        os.makedirs(seg_results_small_path)
+def ensemble_experiments(root="."):
+    """Experiment directory of every ensemble seed"""
+    return [
+        "{}/M2_lwnet_disc_cup/experiments/wnet_All_three_1024_disc_cup/{}/".format(
+            root, seed
+        )
+        for seed in ENSEMBLE_SEEDS
+    ]
+
+
+def load_disc_cup_ensemble(model_name, device, root="."):
+    """Build the disc/cup models and load the checkpoint of every ensemble seed"""
+    models = []
+    for experiment_path in ensemble_experiments(root):
+        model = get_arch(model_name, n_classes=3).to(device)
+        model, stats = load_model(model, experiment_path, device)
+        model.eval()
+        models.append(model)
+    return models
+
+
+def ensemble_disc_cup(models, imgs, device):
+    """Return the decoded disc/cup classes and the uncertainty map of a batch"""
+    mask_pred_tensor_small_list = []
+    mask_pred_tensor_small_all = 0
+    with torch.no_grad():
+        for model in models:
+            _, mask_pred = model(imgs)
+            mask_pred_tensor_small = mask_pred.clone().detach()
+            mask_pred_tensor_small_n = F.softmax(mask_pred_tensor_small, dim=1)
+            mask_pred_tensor_small_all += mask_pred_tensor_small_n.type(
+                torch.FloatTensor
+            )
+            mask_pred_tensor_small_list.append(mask_pred_tensor_small_n)
 
-    if not os.path.isdir(seg_results_raw_path):
-        os.makedirs(seg_results_raw_path)
+        mask_pred_tensor_small_all = (mask_pred_tensor_small_all / len(models)).to(
+            device=device
+        )
 
-    seg_uncertainty_small_path = (
-        f"{AUTOMORPH_DATA}/Results/M2/optic_disc_cup/resize_uncertainty/"
-    )
-    if not os.path.isdir(seg_uncertainty_small_path):
-        os.makedirs(seg_uncertainty_small_path)
+        uncertainty_map = torch.sqrt(
+            sum(
+                torch.square(mask_pred_tensor_small_all - mask_pred_tensor_small_n)
+                for mask_pred_tensor_small_n in mask_pred_tensor_small_list
+            )
+            / len(models)
+        )
 
-    seg_uncertainty_raw_path = (
-        f"{AUTOMORPH_DATA}/Results/M2/optic_disc_cup/raw_uncertainty/"
-    )
+        _, prediction_decode = torch.max(mask_pred_tensor_small_all, 1)
+        prediction_decode = prediction_decode.type(torch.FloatTensor)
 
-    if not os.path.isdir(seg_uncertainty_raw_path):
-        os.makedirs(seg_uncertainty_raw_path)
+    return prediction_decode, uncertainty_map
 
-    with tqdm(total=n_val, desc="Validation round", unit="batch", leave=False) as pbar:
-        for batch in test_loader:
-            imgs = batch["image"]
-            img_name = batch["name"]
-            ori_width = batch["original_sz"][0]
-            ori_height = batch["original_sz"][1]
-            mask_pred_tensor_small_all = 0
 
-            imgs = imgs.to(device=device, dtype=torch.float32)
+def decode_disc_cup(prediction_decode):
+    """Turn a decoded class map into the BGR disc/cup image written to disk"""
+    img_r = np.zeros((prediction_decode.shape[0], prediction_decode.shape[1]))
+    img_g = np.zeros((prediction_decode.shape[0], prediction_decode.shape[1]))
+    img_b = np.zeros((prediction_decode.shape[0], prediction_decode.shape[1]))
 
-            with torch.no_grad():
-                _, mask_pred = model_1(imgs)
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_1 = F.softmax(mask_pred_tensor_small, dim=1)
-                mask_pred_tensor_small_all += mask_pred_tensor_small_1.type(
-                    torch.FloatTensor
-                )
+    img_r[prediction_decode == 1] = 255
+    img_b[prediction_decode == 2] = 255
 
-                _, mask_pred = model_2(imgs)
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_2 = F.softmax(mask_pred_tensor_small, dim=1)
-                mask_pred_tensor_small_all += mask_pred_tensor_small_2.type(
-                    torch.FloatTensor
-                )
+    img_b = remove_small_objects(img_b > 0, 50)
+    img_r = remove_small_objects(img_r > 0, 100)
 
-                _, mask_pred = model_3(imgs)
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_3 = F.softmax(mask_pred_tensor_small, dim=1)
-                mask_pred_tensor_small_all += mask_pred_tensor_small_3.type(
-                    torch.FloatTensor
-                )
+    return np.concatenate(
+        (
+            img_b[..., np.newaxis],
+            img_g[..., np.newaxis],
+            img_r[..., np.newaxis],
+        ),
+        axis=2,
+    )
 
-                _, mask_pred = model_4(imgs)
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_4 = F.softmax(mask_pred_tensor_small, dim=1)
-                mask_pred_tensor_small_all += mask_pred_tensor_small_4.type(
-                    torch.FloatTensor
-                )
 
-                _, mask_pred = model_5(imgs)
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_5 = F.softmax(mask_pred_tensor_small, dim=1)
-                mask_pred_tensor_small_all += mask_pred_tensor_small_5.type(
-                    torch.FloatTensor
-                )
+def to_image(tensor):
+    """The uint8 RGB(A) array torchvision's save_image writes for one image tensor"""
+    if tensor.dim() == 2:
+        tensor = tensor.unsqueeze(0)
+    if tensor.size(0) == 1:
+        tensor = torch.cat((tensor, tensor, tensor), 0)
+    return (
+        tensor.mul(255).add_(0.5).clamp_(0, 255).permute(1, 2, 0).to("cpu", torch.uint8)
+    ).numpy()
 
-                _, mask_pred = model_6(imgs)
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_6 = F.softmax(mask_pred_tensor_small, dim=1)
-                mask_pred_tensor_small_all += mask_pred_tensor_small_6.type(
-                    torch.FloatTensor
-                )
 
-                _, mask_pred = model_7(imgs)
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_7 = F.softmax(mask_pred_tensor_small, dim=1)
-                mask_pred_tensor_small_all += mask_pred_tensor_small_7.type(
-                    torch.FloatTensor
-                )
+def write_rgb(write, path, image):
+    """Write an RGB(A) array with write, which takes cv2's BGR(A) order"""
+    write(path, image[..., [2, 1, 0, 3][: image.shape[2]]])
 
-                _, mask_pred = model_8(imgs)
-                mask_pred_tensor_small = mask_pred.clone().detach()
-                mask_pred_tensor_small_8 = F.softmax(mask_pred_tensor_small, dim=1)
-                mask_pred_tensor_small_all += mask_pred_tensor_small_8.type(
-                    torch.FloatTensor
-                )
 
-                mask_pred_tensor_small_all = (mask_pred_tensor_small_all / 8).to(
-                    device=device
-                )
+def save_disc_cup(
+    data_path,
+    name,
+    prediction_decode,
+    uncertainty_map,
+    ori_width,
+    ori_height,
+    write=cv2.imwrite,
+):
+    """
+    Write the disc/cup map and its uncertainty, resized and at raw size, with
+    write, cv2.imwrite or the write of an automorph ImageWriter
+    """
+    seg_results_small_path = data_path + "resized/"
+    seg_results_raw_path = data_path + "raw/"
+    seg_uncertainty_small_path = data_path + "resize_uncertainty/"
+    seg_uncertainty_raw_path = data_path + "raw_uncertainty/"
 
-                uncertainty_map = torch.sqrt(
-                    (
-                        torch.square(
-                            mask_pred_tensor_small_all - mask_pred_tensor_small_1
-                        )
-                        + torch.square(
-                            mask_pred_tensor_small_all - mask_pred_tensor_small_2
-                        )
-                        + torch.square(
-                            mask_pred_tensor_small_all - mask_pred_tensor_small_3
-                        )
-                        + torch.square(
-                            mask_pred_tensor_small_all - mask_pred_tensor_small_4
-                        )
-                        + torch.square(
-                            mask_pred_tensor_small_all - mask_pred_tensor_small_5
-                        )
-                        + torch.square(
-                            mask_pred_tensor_small_all - mask_pred_tensor_small_6
-                        )
-                        + torch.square(
-                            mask_pred_tensor_small_all - mask_pred_tensor_small_7
-                        )
-                        + torch.square(
-                            mask_pred_tensor_small_all - mask_pred_tensor_small_8
-                        )
-                    )
-                    / 8
-                )
+    uncertainty_small = to_image(uncertainty_map * 255)
+    write_rgb(write, seg_uncertainty_small_path + name + ".png", uncertainty_small)
+    write_rgb(
+        write,
+        seg_uncertainty_small_path + name + "_disc.png",
+        to_image(uncertainty_map[1, ...] * 255),
+    )
+    write_rgb(
+        write,
+        seg_uncertainty_small_path + name + "_cup.png",
+        to_image(uncertainty_map[2, ...] * 255),
+    )
 
-                _, prediction_decode = torch.max(mask_pred_tensor_small_all, 1)
-                prediction_decode = prediction_decode.type(torch.FloatTensor)
+    uncertainty_raw = np.asarray(
+        Image.fromarray(uncertainty_small).resize((int(ori_width), int(ori_height)))
+    )
+    write_rgb(write, seg_uncertainty_raw_path + name + ".png", uncertainty_raw)
 
-                n_img = prediction_decode.shape[0]
+    img_ = decode_disc_cup(prediction_decode)
 
-                if len(prediction_decode.size()) == 3:
-                    torch.unsqueeze(prediction_decode, 0)
-                if len(uncertainty_map.size()) == 3:
-                    torch.unsqueeze(uncertainty_map, 0)
+    write(
+        seg_results_small_path + name + ".png",
+        np.float32(img_) * 255,
+    )
 
-                for i in range(n_img):
-                    save_image(
-                        uncertainty_map[i, ...] * 255,
-                        seg_uncertainty_small_path + img_name[i] + ".png",
-                    )
-                    save_image(
-                        uncertainty_map[i, 1, ...] * 255,
-                        seg_uncertainty_small_path + img_name[i] + "_disc.png",
-                    )
-                    save_image(
-                        uncertainty_map[i, 2, ...] * 255,
-                        seg_uncertainty_small_path + img_name[i] + "_cup.png",
-                    )
+    img_ww = cv2.resize(
+        np.float32(img_) * 255,
+        (int(ori_width), int(ori_height)),
+        interpolation=cv2.INTER_NEAREST,
+    )
+    write(seg_results_raw_path + name + ".png", img_ww)
 
-                    uncertainty_img = Image.open(
-                        seg_uncertainty_small_path + img_name[i] + ".png"
-                    )
-                    uncertainty_img = uncertainty_img.resize(
-                        (int(ori_width[i]), int(ori_height[i]))
-                    )
-                    uncertainty_tensor = torchvision.transforms.ToTensor()(
-                        uncertainty_img
-                    )
-                    save_image(
-                        uncertainty_tensor,
-                        seg_uncertainty_raw_path + img_name[i] + ".png",
-                    )
 
-                    img_r = np.zeros(
-                        (
-                            prediction_decode[i, ...].shape[0],
-                            prediction_decode[i, ...].shape[1],
-                        )
-                    )
-                    img_g = np.zeros(
-                        (
-                            prediction_decode[i, ...].shape[0],
-                            prediction_decode[i, ...].shape[1],
-                        )
-                    )
-                    img_b = np.zeros(
-                        (
-                            prediction_decode[i, ...].shape[0],
-                            prediction_decode[i, ...].shape[1],
-                        )
-                    )
+def make_output_dirs(data_path):
+    for sub_dir in ("resized/", "raw/", "resize_uncertainty/", "raw_uncertainty/"):
+        if not os.path.isdir(data_path + sub_dir):
+            os.makedirs(data_path + sub_dir)
 
-                    img_r[prediction_decode[i, ...] == 1] = 255
-                    img_b[prediction_decode[i, ...] == 2] = 255
 
-                    img_b = remove_small_objects(img_b > 0, 50)
-                    img_r = remove_small_objects(img_r > 0, 100)
+def prediction_eval(models, test_loader, device):
+    n_val = len(test_loader)
 
-                    img_ = np.concatenate(
-                        (
-                            img_b[..., np.newaxis],
-                            img_g[..., np.newaxis],
-                            img_r[..., np.newaxis],
-                        ),
-                        axis=2,
-                    )
+    data_path = f"{AUTOMORPH_DATA}/Results/M2/optic_disc_cup/"
+    make_output_dirs(data_path)
 
-                    cv2.imwrite(
-                        seg_results_small_path + img_name[i] + ".png",
-                        np.float32(img_) * 255,
-                    )
+    with tqdm(total=n_val, desc="Validation round", unit="batch", leave=False) as pbar:
+        for batch in test_loader:
+            imgs = batch["image"]
+            img_name = batch["name"]
+            ori_width = batch["original_sz"][0]
+            ori_height = batch["original_sz"][1]
 
-                    img_ww = cv2.resize(
-                        np.float32(img_) * 255,
-                        (int(ori_width[i]), int(ori_height[i])),
-                        interpolation=cv2.INTER_NEAREST,
-                    )
-                    cv2.imwrite(seg_results_raw_path + img_name[i] + ".png", img_ww)
+            imgs = imgs.to(device=device, dtype=torch.float32)
 
-                pbar.update(1)
+            prediction_decode, uncertainty_map = ensemble_disc_cup(
+                models, imgs, device
+            )
+
+            n_img = prediction_decode.shape[0]
+
+            for i in range(n_img):
+                save_disc_cup(
+                    data_path,
+                    img_name[i],
+                    prediction_decode[i, ...],
+                    uncertainty_map[i, ...],
+                    ori_width[i],
+                    ori_height[i],
+                )
+
+            pbar.update(1)
 
 
 if __name__ == "__main__":
@@ -971,75 +930,9 @@ if __name__ == "__main__":
     csv_path = "test_all.csv"
     test_loader = get_test_dataset(data_path, csv_path=csv_path, tg_size=tg_size)
 
-    model_1 = get_arch(model_name, n_classes=3).to(device)
-    model_2 = get_arch(model_name, n_classes=3).to(device)
-    model_3 = get_arch(model_name, n_classes=3).to(device)
-    model_4 = get_arch(model_name, n_classes=3).to(device)
-    model_5 = get_arch(model_name, n_classes=3).to(device)
-    model_6 = get_arch(model_name, n_classes=3).to(device)
-    model_7 = get_arch(model_name, n_classes=3).to(device)
-    model_8 = get_arch(model_name, n_classes=3).to(device)
-
-    experiment_path_1 = (
-        "./M2_lwnet_disc_cup/experiments/wnet_All_three_1024_disc_cup/28/"
-    )
-    experiment_path_2 = (
-        "./M2_lwnet_disc_cup/experiments/wnet_All_three_1024_disc_cup/30/"
-    )
-    experiment_path_3 = (
-        "./M2_lwnet_disc_cup/experiments/wnet_All_three_1024_disc_cup/32/"
-    )
-    experiment_path_4 = (
-        "./M2_lwnet_disc_cup/experiments/wnet_All_three_1024_disc_cup/34/"
-    )
-    experiment_path_5 = (
-        "./M2_lwnet_disc_cup/experiments/wnet_All_three_1024_disc_cup/36/"
-    )
-    experiment_path_6 = (
-        "./M2_lwnet_disc_cup/experiments/wnet_All_three_1024_disc_cup/38/"
-    )
-    experiment_path_7 = (
-        "./M2_lwnet_disc_cup/experiments/wnet_All_three_1024_disc_cup/40/"
-    )
-    experiment_path_8 = (
-        "./M2_lwnet_disc_cup/experiments/wnet_All_three_1024_disc_cup/42/"
-    )
-
-    model_1, stats = load_model(model_1, experiment_path_1, device)
-    model_1.eval()
-
-    model_2, stats = load_model(model_2, experiment_path_2, device)
-    model_2.eval()
-
-    model_3, stats = load_model(model_3, experiment_path_3, device)
-    model_3.eval()
-
-    model_4, stats = load_model(model_4, experiment_path_4, device)
-    model_4.eval()
+    models = load_disc_cup_ensemble(model_name, device)
 
-    model_5, stats = load_model(model_5, experiment_path_5, device)
-    model_5.eval()
-
-    model_6, stats = load_model(model_6, experiment_path_6, device)
-    model_6.eval()
-
-    model_7, stats = load_model(model_7, experiment_path_7, device)
-    model_7.eval()
-
-    model_8, stats = load_model(model_8, experiment_path_8, device)
-    model_8.eval()
-
-    prediction_eval(
-        model_1,
-        model_2,
-        model_3,
-        model_4,
-        model_5,
-        model_6,
-        model_7,
-        model_8,
-        test_loader,
-    )
+    prediction_eval(models, test_loader, device)
 
     result_path = f"{AUTOMORPH_DATA}/Results/M2/optic_disc_cup/resized/"
     binary_vessel_path = f"{AUTOMORPH_DATA}/Results/M2/binary_vessel/"
@@ -12,6 +12,15 @@ from skimage.measure import regionprops
 import torch
 import logging
 from glob import glob
+import importlib.util
+
+# the reader of the M0 cache is shared by every stage, loaded from its file as
+# M0_Preprocess is not a package
+_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+_spec = importlib.util.spec_from_file_location(
+    'fundus_cache', os.path.join(_root, 'M0_Preprocess', 'fundus_cache.py'))
+fundus_cache = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(fundus_cache)
 
 class TrainDataset(Dataset):
     def __init__(self, csv_path, transforms=None, label_values=None):
@@ -77,6 +86,7 @@ class TrainDataset(Dataset):
     def __len__(self):
         return len(self.ids)
 
+
 class TestDataset(Dataset):
     def __init__(self, csv_path, tg_size):
         
@@ -93,6 +103,7 @@ class TestDataset(Dataset):
         
         #self.mask_list = df.mask_paths
         self.tg_size = tg_size
+        self.cache = fundus_cache.load_m0_cache(self.im_list, f'{tg_size[1]}x{tg_size[0]}_bilinear')
 
     def crop_to_fov(self, img, mask):
         mask = np.array(mask).astype(int)
@@ -104,12 +115,18 @@ class TestDataset(Dataset):
         # # load image and mask
         idx = self.ids[index]
 
-        img_file = glob(self.im_list + idx + '.*')  
-        img = Image.open(img_file[0])
+        if idx in self.cache:
+            # already resized, the Resize below keeps it as it is
+            cached, width, height = self.cache[idx]
+            img = Image.fromarray(cached)
+            original_sz = width, height
+        else:
+            img_file = glob(self.im_list + idx + '.*')  
+            img = Image.open(img_file[0])
         
-        #mask = Image.open(self.mask_list[index]).convert('L')
-        #img, coords_crop = self.crop_to_fov(img, mask)
-        original_sz = img.size[0], img.size[1]  # in numpy convention
+            #mask = Image.open(self.mask_list[index]).convert('L')
+            #img, coords_crop = self.crop_to_fov(img, mask)
+            original_sz = img.size[0], img.size[1]  # in numpy convention
 
         # # load image and mask
         # img = Image.open(self.im_list[index])
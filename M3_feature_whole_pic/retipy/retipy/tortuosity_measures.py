@@ -26,6 +26,14 @@ from PIL import Image
 import time
 import cv2
 
+try:
+    from automorph.trace import tracer
+except ImportError:  # retipy run without the automorph runner
+    tracer = None
+
+# numpy 2 renamed trapz to trapezoid and numpy 2.4 removed trapz
+trapezoid = getattr(np, "trapezoid", None) or np.trapz
+
 def fractal_dimension(Z):
 
     assert(len(Z.shape) == 2)
@@ -330,7 +338,7 @@ def squared_curvature_tortuosity(x, y):
         y_1 = m.derivative1_centered_h1(i, y)
         y_2 = m.derivative2_centered_h1(i, y)
         curvatures.append((x_1*y_2 - x_2*y_1)/(y_1**2 + x_1**2)**1.5)
-    return abs(np.trapz(curvatures, x_values))
+    return abs(trapezoid(curvatures, x_values))
 
 
 def smooth_tortuosity_cubic(x, y):
@@ -431,6 +439,9 @@ def evaluate_window(window: Window, min_pixels_per_vessel=10, sampling_size=6, r
     pixel_total_count = 0
     FD_binary,VD_binary,Average_width = 0,0,0
 
+    # seconds spent in every step, reported to the runner trace
+    steps = dict.fromkeys(("retina", "global_cal", "vessel_tracing", "distance_tortuosity", "squared_curvature", "tortuosity_density"), 0.0)
+
     for i in range(0, window.shape[0], 1):
         
         bw_window = window.windows[i, 0, :, :]
@@ -438,12 +449,18 @@ def evaluate_window(window: Window, min_pixels_per_vessel=10, sampling_size=6, r
         vessel_total_count = np.sum(bw_window==1)
         pixel_total_count = bw_window.shape[0]*bw_window.shape[1]
         
+        s_retina = time.time()
         retina = Retina(bw_window, "window{}" + window.filename,store_path=store_path+window.filename)
         vessel_map = retina.vessel_image
         
+        s_global = time.time()
         FD_binary,VD_binary,Average_width = global_cal(retina)
         
+        s_tracing = time.time()
         vessels = detect_vessel_border(retina)
+        steps["retina"] += s_global - s_retina
+        steps["global_cal"] += s_tracing - s_global
+        steps["vessel_tracing"] += time.time() - s_tracing
         vessel_count = 0
         vessel_count_1 = 0
         bifurcation_t = 0
@@ -475,10 +492,17 @@ def evaluate_window(window: Window, min_pixels_per_vessel=10, sampling_size=6, r
                 vessel_count_list.append(vessel_count)
                 #tfi += fractal_tortuosity_curve(vessel[0], vessel[1])
                 s7=time.time()
+                steps["distance_tortuosity"] += s4 - s2
+                steps["squared_curvature"] += s5 - s4
+                steps["tortuosity_density"] += s6 - s5
         
         if vessel_count > 0:
             t2 = t2/vessel_count
             t4 = t4/vessel_count
             td = td/vessel_count
     
+    if tracer is not None:
+        for step, seconds in steps.items():
+            tracer.add("M3/evaluate_window/" + step, seconds)
+
     return FD_binary,VD_binary,Average_width, t2, t4, td
@@ -0,0 +1,25 @@
+"""
+Run the AutoMorph stages from one Python process.
+
+    export AUTOMORPH_DATA=/path/to/data
+    python -m automorph run
+
+or from Python, with the models kept loaded between calls:
+
+    features = automorph.Pipeline().run(images)
+"""
+__all__ = ["Pipeline", "Runner"]
+
+
+def __getattr__(name):
+    # imported on first use, so that the helper modules (stages, synthetic,
+    # writer, ...) can be imported without torch and the models
+    if name == "Pipeline":
+        from .pipeline import Pipeline
+
+        return Pipeline
+    if name == "Runner":
+        from .runner import Runner
+
+        return Runner
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
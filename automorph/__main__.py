@@ -0,0 +1,499 @@
+import argparse
+import json
+import logging
+import os
+
+from .benchmark import STEPS, Benchmark, compare, save_report
+from .ledger import Ledger
+from .runner import (
+    QUALITY_IMAGE_SIZE,
+    QUALITY_LOAD,
+    QUALITY_MODEL,
+    QUALITY_TASK,
+    Runner,
+)
+from .shards import merge_shards, parse_shard, shard_path
+from .stages import ROOT, load_module
+from .synthetic import write_dataset
+from .watch import Watcher
+from .writer import CODECS
+
+
+def add_runner_arguments(parser):
+    parser.add_argument(
+        "--batch-size", type=int, default=8, help="Batch size", dest="batchsize"
+    )
+    parser.add_argument(
+        "--pixel-resolution",
+        type=float,
+        default=0.008,
+        help="pixel resolution used when resolution_information.csv is missing",
+        dest="pixel_resolution",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="M0 crop processes running ahead of inference, 0 crops in the main process",
+        dest="workers",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=None,
+        help="max cropped images waiting for inference, 4 batches when not given",
+        dest="prefetch",
+    )
+    parser.add_argument(
+        "--device",
+        type=str,
+        default=None,
+        help="torch device, detected when not given",
+        dest="device",
+    )
+    parser.add_argument(
+        "--no-features",
+        action="store_false",
+        help="stop after M2 and skip the M3 feature measurement",
+        dest="features",
+    )
+    parser.add_argument(
+        "--no-csv",
+        action="store_false",
+        help="only keep the tables in the Parquet store Results/store, "
+        "without exporting them to csv after every run",
+        dest="csv",
+    )
+    parser.add_argument(
+        "--reduced-decode",
+        action="store_true",
+        help="decode JPEGs much larger than the 912 px the models use at 1/2, "
+        "1/4 or 1/8 size. crop_info stays in full resolution pixels, but its "
+        "centre is only accurate to one factor step and its radius and Scale "
+        "to half a step (decode_factor records the factor). Images where that "
+        "is over 0.25%% of the radius are decoded in full",
+        dest="reduced_decode",
+    )
+    parser.add_argument(
+        "--image-codec",
+        choices=CODECS,
+        default="png",
+        help="codec of the M2 images no later stage reads: png, lossless webp "
+        "or raw npy arrays",
+        dest="image_codec",
+    )
+    parser.add_argument(
+        "--png-level",
+        type=int,
+        choices=range(10),
+        default=None,
+        metavar="0-9",
+        help="zlib level of the png images, the fast defaults of cv2.imwrite "
+        "when not given",
+        dest="png_level",
+    )
+    parser.add_argument(
+        "--writer-threads",
+        type=int,
+        default=4,
+        help="threads encoding and writing the M2 images",
+        dest="writer_threads",
+    )
+    parser.add_argument(
+        "--duplicates",
+        choices=("none", "exact", "near"),
+        default="exact",
+        help="run identical images (exact) or also re-exports of the same "
+        "picture (near) once and give the others their results",
+        dest="duplicates",
+    )
+    parser.add_argument(
+        "--quality-backend",
+        choices=("torch", "onnxruntime", "onnxruntime-int8"),
+        default="torch",
+        help="run the M1 ensemble with PyTorch or with ONNX Runtime on CPU, "
+        "in float (export it first with export-onnx) or INT8 (quantize)",
+        dest="quality_backend",
+    )
+    parser.add_argument(
+        "--intra-op-threads",
+        type=int,
+        default=0,
+        help="ONNX Runtime threads per operator, 0 for its default",
+        dest="intra_op_threads",
+    )
+    parser.add_argument(
+        "--inter-op-threads",
+        type=int,
+        default=0,
+        help="ONNX Runtime operators run at once, 0 for its default",
+        dest="inter_op_threads",
+    )
+    parser.add_argument(
+        "--adaptive-quality",
+        action="store_true",
+        help="run the M1 members in order and stop on an image once its "
+        "good/bad quality is settled, the members used go to the members "
+        "column of results_ensemble (torch backend only)",
+        dest="adaptive_quality",
+    )
+    parser.add_argument(
+        "--adaptive-z",
+        type=float,
+        default=3.0,
+        help="standard errors the mean softmax must lie from the quality "
+        "thresholds for --adaptive-quality to stop",
+        dest="adaptive_z",
+    )
+    parser.add_argument(
+        "--min-members",
+        type=int,
+        default=3,
+        help="M1 members every image runs through with --adaptive-quality",
+        dest="min_members",
+    )
+    parser.add_argument(
+        "--stacked-quality",
+        action="store_true",
+        help="run the M1 members as one vmapped model (torch backend only), "
+        "faster on some GPUs, see the M1/ensemble/stacked benchmark",
+        dest="stacked_quality",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=None,
+        help="i/N: only run the images of shard i out of N, "
+        "with Results written to $AUTOMORPH_DATA/shards/i_of_N",
+        dest="shard",
+    )
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        help="write the time, images/s, memory and I/O of every step "
+        "to Results/trace/summary.json and a Chrome trace to Results/trace/trace.json",
+        dest="trace",
+    )
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        prog="python -m automorph",
+        description="Run AutoMorph on $AUTOMORPH_DATA/images",
+        epilog="run and watch read a directory of image files only. Tar and "
+        "zip archives named by AUTOMORPH_IMAGES are read by the M0 scripts of "
+        "script_1.sh alone, extract them into $AUTOMORPH_DATA/images first",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser(
+        "run",
+        help="run M0 to M3 in one process with every model kept loaded, "
+        "on the image files of $AUTOMORPH_DATA/images (no archives)",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    add_runner_arguments(run)
+
+    watch = subparsers.add_parser(
+        "watch",
+        help="keep the models loaded and run new images as they arrive",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    add_runner_arguments(watch)
+    watch.add_argument(
+        "--interval",
+        type=float,
+        default=10.0,
+        help="seconds between two looks at the images directory",
+        dest="interval",
+    )
+    watch.add_argument(
+        "--settle",
+        type=float,
+        default=30.0,
+        help="seconds a new image must stay unchanged before it is processed",
+        dest="settle",
+    )
+
+    failed = subparsers.add_parser(
+        "failed",
+        help="list the images whose last run failed or left -1 measurements",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    failed.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=None,
+        help="i/N: read the ledger of shard i out of N",
+        dest="shard",
+    )
+
+    subparsers.add_parser(
+        "merge",
+        help="combine the results of every shard in $AUTOMORPH_DATA/Results",
+    )
+
+    subparsers.add_parser(
+        "consolidate",
+        help="write the M1 ensemble checkpoints to a single file, loaded in one read",
+    )
+
+    export_onnx = subparsers.add_parser(
+        "export-onnx",
+        help="write the M1 ensemble to ONNX for --quality-backend onnxruntime",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    export_onnx.add_argument(
+        "--opset", type=int, default=17, help="ONNX opset version", dest="opset"
+    )
+
+    quantize = subparsers.add_parser(
+        "quantize",
+        help="write an INT8 copy of the exported M1 ensemble for "
+        "--quality-backend onnxruntime-int8, calibrated on M0 crops, and "
+        "report how often its decisions differ",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    quantize.add_argument(
+        "--crops",
+        type=str,
+        default=None,
+        help="directory of M0 crops, $AUTOMORPH_DATA/Results/M0/images "
+        "when not given",
+        dest="crops",
+    )
+    quantize.add_argument(
+        "--calibration-images",
+        type=int,
+        default=32,
+        help="crops the activation ranges of the convolutions are calibrated on",
+        dest="calibration_images",
+    )
+    quantize.add_argument(
+        "--evaluation-images",
+        type=int,
+        default=200,
+        help="other crops the decisions of both ensembles are compared on",
+        dest="evaluation_images",
+    )
+
+    benchmark = subparsers.add_parser(
+        "benchmark",
+        help="time the costly steps of every stage on synthetic fundus images",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    benchmark.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 2000, 4000],
+        help="side in pixels of the synthetic images M0 is timed on",
+        dest="sizes",
+    )
+    benchmark.add_argument(
+        "--steps",
+        nargs="+",
+        choices=STEPS,
+        default=list(STEPS),
+        help="steps to time",
+        dest="steps",
+    )
+    benchmark.add_argument(
+        "--repeat", type=int, default=3, help="timed calls per step", dest="repeat"
+    )
+    benchmark.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help="images per ensemble forward pass",
+        dest="batchsize",
+    )
+    benchmark.add_argument(
+        "--device", type=str, default="cpu", help="torch device", dest="device"
+    )
+    benchmark.add_argument(
+        "--output",
+        type=str,
+        default="benchmark.json",
+        help="JSON report to write",
+        dest="output",
+    )
+    benchmark.add_argument(
+        "--compare",
+        type=str,
+        default=None,
+        help="JSON report of an earlier run to print the speedups against",
+        dest="compare",
+    )
+
+    synthetic = subparsers.add_parser(
+        "synthetic",
+        help="write synthetic fundus images to $AUTOMORPH_DATA/images",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    synthetic.add_argument(
+        "--count", type=int, default=10, help="number of images", dest="count"
+    )
+    synthetic.add_argument(
+        "--size", type=int, default=2000, help="side in pixels", dest="size"
+    )
+    synthetic.add_argument(
+        "--seed", type=int, default=0, help="seed of the first image", dest="seed"
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+    args = get_args()
+
+    # the stage scripts read AUTOMORPH_DATA when they are imported
+    AUTOMORPH_DATA = os.path.abspath(os.getenv("AUTOMORPH_DATA", "."))
+    os.environ["AUTOMORPH_DATA"] = AUTOMORPH_DATA
+
+    if args.command in ("run", "watch"):
+        runner = Runner(
+            AUTOMORPH_DATA,
+            device=args.device,
+            batch_size=args.batchsize,
+            pixel_resolution=args.pixel_resolution,
+            num_workers=args.workers,
+            prefetch=args.prefetch,
+            shard=args.shard,
+            trace=args.trace,
+            csv=args.csv,
+            reduced_decode=args.reduced_decode,
+            image_codec=args.image_codec,
+            png_level=args.png_level,
+            writer_threads=args.writer_threads,
+            duplicates=args.duplicates,
+            quality_backend=args.quality_backend,
+            intra_op_threads=args.intra_op_threads,
+            inter_op_threads=args.inter_op_threads,
+            adaptive_z=args.adaptive_z if args.adaptive_quality else None,
+            min_members=args.min_members,
+            stacked_quality=args.stacked_quality,
+        )
+        if args.command == "run":
+            runner.run(features=args.features)
+        else:
+            Watcher(
+                runner,
+                interval=args.interval,
+                settle=args.settle,
+                features=args.features,
+            ).watch()
+    elif args.command == "failed":
+        ledger_path = f"{shard_path(AUTOMORPH_DATA, args.shard)}/Results/ledger.sqlite"
+        if not os.path.exists(ledger_path):
+            raise SystemExit(f"No ledger at {ledger_path}, run the pipeline first")
+        ledger = Ledger(ledger_path)
+        print(ledger.summary().to_string(index=False))
+        failures = ledger.failures()
+        if failures.empty:
+            print("\nNo failed images")
+        else:
+            print()
+            print(failures.to_string(index=False))
+        ledger.close()
+    elif args.command == "merge":
+        merge_shards(AUTOMORPH_DATA)
+    elif args.command == "consolidate":
+        quality = load_module("M1_Retinal_Image_quality_EyePACS", "test_outside")
+        for checkpoint_path in quality.ensemble_checkpoints(
+            QUALITY_MODEL, QUALITY_TASK, QUALITY_LOAD, root=ROOT
+        ):
+            if not os.path.exists(checkpoint_path):
+                raise SystemExit(f"No M1 checkpoint at {checkpoint_path}")
+        path = quality.consolidate_ensemble(
+            QUALITY_MODEL, QUALITY_TASK, QUALITY_LOAD, root=ROOT
+        )
+        print(f"M1 ensemble checkpoint written to {path}")
+    elif args.command == "export-onnx":
+        quality = load_module("M1_Retinal_Image_quality_EyePACS", "test_outside")
+        for checkpoint_path in quality.checkpoint_files(
+            QUALITY_MODEL, QUALITY_TASK, QUALITY_LOAD, root=ROOT
+        ):
+            if not os.path.exists(checkpoint_path):
+                raise SystemExit(f"No M1 checkpoint at {checkpoint_path}")
+        models = quality.load_ensemble(
+            QUALITY_MODEL, QUALITY_TASK, QUALITY_LOAD, "cpu", root=ROOT
+        )
+        path = quality.export_onnx(
+            models,
+            quality.onnx_path(QUALITY_MODEL, QUALITY_TASK, QUALITY_LOAD, ROOT),
+            QUALITY_IMAGE_SIZE,
+            opset=args.opset,
+        )
+        print(f"M1 ensemble written to {path}")
+    elif args.command == "quantize":
+        quality = load_module("M1_Retinal_Image_quality_EyePACS", "test_outside")
+        path = quality.onnx_path(QUALITY_MODEL, QUALITY_TASK, QUALITY_LOAD, ROOT)
+        if not os.path.exists(path):
+            raise SystemExit(
+                f"No ONNX ensemble at {path}, write it with export-onnx first"
+            )
+        crops_dir = args.crops or f"{AUTOMORPH_DATA}/Results/M0/images"
+        if not os.path.isdir(crops_dir):
+            raise SystemExit(f"No M0 crops in {crops_dir}, run the pipeline first")
+        dataset = quality.BasicDataset_OUT(
+            os.path.join(crops_dir, ""), QUALITY_IMAGE_SIZE, 3, train_or=False
+        )
+        if not len(dataset):
+            raise SystemExit(f"No M0 crops in {crops_dir}, run the pipeline first")
+        calibration, evaluation = quality.calibration_split(
+            len(dataset), args.calibration_images, args.evaluation_images
+        )
+        if not evaluation:
+            logging.warning(
+                "Every crop is used for calibration, "
+                "the decisions are compared on the calibration crops"
+            )
+            evaluation = calibration
+        quantized_path = quality.quantize_onnx(
+            path,
+            quality.quantized_onnx_path(
+                QUALITY_MODEL, QUALITY_TASK, QUALITY_LOAD, ROOT
+            ),
+            (
+                imgs.numpy()
+                for _, imgs in quality.crop_batches(dataset, calibration)
+            ),
+        )
+        print(f"M1 INT8 ensemble written to {quantized_path}")
+        decisions = quality.compare_decisions(
+            quality.OnnxEnsemble(path),
+            quality.OnnxEnsemble(quantized_path),
+            quality.crop_batches(dataset, evaluation, batch_size=8),
+        )
+        prediction_changed = (
+            decisions["Prediction"] != decisions["Prediction_candidate"]
+        )
+        quality_changed = decisions["quality"] != decisions["quality_candidate"]
+        print(f"Compared on {len(decisions)} crops:")
+        print(
+            f"  good/usable/bad Prediction differs for {prediction_changed.mean():.2%}"
+        )
+        print(f"  good/bad quality differs for {quality_changed.mean():.2%}")
+        print(f"  largest softmax drift {decisions['softmax_drift'].max():.4f}")
+        if quality_changed.any():
+            print()
+            print(decisions[quality_changed].to_string(index=False))
+    elif args.command == "benchmark":
+        report = Benchmark(
+            sizes=args.sizes,
+            repeat=args.repeat,
+            device=args.device,
+            batch_size=args.batchsize,
+        ).run(steps=args.steps)
+        save_report(report, args.output)
+        print(f"Benchmark written to {args.output}")
+        if args.compare:
+            with open(args.compare) as f:
+                baseline = json.load(f)
+            print(compare(baseline, report).to_string(index=False))
+    elif args.command == "synthetic":
+        write_dataset(AUTOMORPH_DATA, args.count, args.size, seed=args.seed)
+        print(f"{args.count} images written to {AUTOMORPH_DATA}/images")
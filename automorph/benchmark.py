@@ -0,0 +1,598 @@
+"""
+Benchmark the costly steps of the pipeline on synthetic fundus images.
+
+Each step runs once to warm up and then ``repeat`` times on the same input,
+and its best, median and mean wall time go to a JSON file with the git commit
+and library versions, so that two files written on the same machine at two
+commits can be compared with ``--compare``.
+
+M0 (full and reduced decode, process_without_gb and crop_fov) runs at every
+image size. M1 and the M2 segmenters resize their input to a fixed size, so
+their forward passes are timed once at that size, as are the M2
+post-processing (filter_frag, optic_disc_centre) and the M3 evaluate_window
+that work on 912 x 912 masks. The vessel maps of a batch are written with
+cv2.imwrite and with the ImageWriter of every codec. An ensemble whose
+checkpoints are not found is timed with randomly initialised members of the
+same architecture and marked ``"weights": "random"``; the forward pass costs
+the same.
+"""
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import pandas as pd
+import torch
+from PIL import Image
+
+from .runner import (
+    AV_DATASET,
+    AV_IMAGE_SIZE,
+    AV_JOB_NAME,
+    DISC_CUP_IMAGE_SIZE,
+    DISC_CUP_MODEL,
+    QUALITY_IMAGE_SIZE,
+    QUALITY_LOAD,
+    QUALITY_MODEL,
+    QUALITY_TASK,
+    VESSEL_DATASET,
+    VESSEL_IMAGE_SIZE,
+    VESSEL_JOB_NAME,
+    VESSEL_THRESHOLD,
+    to_batch,
+)
+from .stages import ROOT, load_module
+from .synthetic import av_image, disc_cup_image, synthetic_fundus
+from .writer import CODECS, ImageWriter
+
+STEPS = (
+    "M0",
+    "M1",
+    "vessel",
+    "artery_vein",
+    "disc_cup",
+    "write",
+    "filter_frag",
+    "optic_disc_centre",
+    "evaluate_window",
+)
+# size of the masks M2 post-processing and M3 work on
+MASK_SIZE = 912
+NAME = "synthetic.png"
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment(device):
+    return {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "torch": torch.__version__,
+        "torch_threads": torch.get_num_threads(),
+        "opencv_threads": cv2.getNumThreads(),
+        "device": str(device),
+    }
+
+
+def measure(function, repeat, warmup=1):
+    """Best, median and mean seconds of ``repeat`` calls after ``warmup`` calls"""
+    for _ in range(warmup):
+        function()
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    return {
+        "best": min(seconds),
+        "median": statistics.median(seconds),
+        "mean": statistics.mean(seconds),
+        "repeat": repeat,
+    }
+
+
+def repeat_member(member, count):
+    """Stand-in ensemble of ``count`` members sharing one set of random weights"""
+    return [member] * count
+
+
+class Benchmark:
+    def __init__(
+        self,
+        sizes=(1000, 2000, 4000),
+        repeat=3,
+        device="cpu",
+        batch_size=1,
+        root=ROOT,
+        seed=0,
+    ):
+        self.sizes = sizes
+        self.repeat = repeat
+        self.device = torch.device(device)
+        self.batch_size = batch_size
+        self.root = root
+        self.seed = seed
+        self.results = {}
+        self.prep = load_module("M0_Preprocess", "fundus_prep")
+
+    def time(self, name, function, **info):
+        self.results[name] = {**measure(function, self.repeat), **info}
+        logging.info(f"{name}: {self.results[name]['best']:.4f}s")
+
+    def skip(self, name, reason):
+        self.results[name] = {"skipped": reason}
+        logging.warning(f"{name} skipped: {reason}")
+
+    def crop(self, size):
+        """Synthetic image of ``size``, its M0 crop, the cropped masks and the radius"""
+        image, masks = synthetic_fundus(size, seed=self.seed)
+        labels = np.dstack([masks[key] for key in ("vessel", "artery", "vein")])
+        labels = np.dstack([labels, masks["disc"], masks["cup"]])
+        r_img, _, _, labels, radius_list, _, _ = self.prep.process_without_gb(
+            image.copy(), labels, [], [], []
+        )
+        cropped = {
+            key: labels[..., i]
+            for i, key in enumerate(("vessel", "artery", "vein", "disc", "cup"))
+        }
+        return image, r_img, cropped, radius_list[0]
+
+    def bench_m0(self, workdir):
+        for size in self.sizes:
+            image, _ = synthetic_fundus(size, seed=self.seed)
+            image_path = f"{workdir}/synthetic_{size}.jpg"
+            self.prep.imwrite(image_path, image)
+            self.time(
+                f"M0/imread/{size}",
+                lambda: self.prep.imread(image_path),
+                pixels=size * size,
+            )
+            self.time(
+                f"M0/imread_reduced/{size}",
+                lambda: self.prep.imread_reduced(image_path),
+                pixels=size * size,
+            )
+            labels = np.zeros(image.shape[:2], np.uint8)
+            self.time(
+                f"M0/process_without_gb/{size}",
+                lambda: self.prep.process_without_gb(
+                    image.copy(), labels, [], [], []
+                ),
+                pixels=size * size,
+            )
+            self.time(
+                f"M0/crop_fov/{size}",
+                lambda: self.prep.crop_fov(image),
+                pixels=size * size,
+            )
+
+    def quality_ensemble(self, quality):
+        checkpoints = quality.checkpoint_files(
+            QUALITY_MODEL, QUALITY_TASK, QUALITY_LOAD, self.root
+        )
+        if all(os.path.exists(path) for path in checkpoints):
+            models = quality.load_ensemble(
+                QUALITY_MODEL, QUALITY_TASK, QUALITY_LOAD, self.device, root=self.root
+            )
+            return models, "checkpoints"
+        # distinct members, ONNX Runtime would run identical ones only once
+        models = [
+            quality.Efficientnet_fl(pretrained=False).to(self.device).eval()
+            for _ in quality.ENSEMBLE_CHECKPOINTS
+        ]
+        return models, "random"
+
+    def bench_stacked(self, quality, models, imgs, weights, info):
+        with torch.no_grad():
+            reference = torch.stack([model_fl(imgs) for model_fl in models])
+        try:
+            stacked = quality.ensemble_executor(models, stacked=True)
+        except Exception as e:
+            self.skip("M1/ensemble/stacked", f"cannot stack the members: {e}")
+            return
+
+        def forward():
+            with torch.no_grad():
+                quality.ensemble_predict(stacked, imgs)
+
+        self.time("M1/ensemble/stacked", forward, weights=weights, **info)
+        with torch.no_grad():
+            difference = (stacked(imgs) - reference).abs().max().item()
+        self.results["M1/ensemble/stacked"]["max_logit_difference"] = difference
+        self.results["M1/ensemble/stacked"]["speedup"] = (
+            self.results["M1/ensemble"]["best"]
+            / self.results["M1/ensemble/stacked"]["best"]
+        )
+
+    def bench_adaptive(self, quality, models, imgs, weights, info):
+        members = []
+
+        def forward():
+            with torch.no_grad():
+                members[:] = quality.adaptive_predict(models, imgs)[3]
+
+        self.time("M1/ensemble/adaptive", forward, weights=weights, **info)
+        self.results["M1/ensemble/adaptive"]["members_used"] = float(np.mean(members))
+        self.results["M1/ensemble/adaptive"]["speedup"] = (
+            self.results["M1/ensemble"]["best"]
+            / self.results["M1/ensemble/adaptive"]["best"]
+        )
+
+    def bench_onnx(self, quality, models, imgs, weights, workdir, info):
+        try:
+            path = quality.export_onnx(
+                models, f"{workdir}/quality.onnx", QUALITY_IMAGE_SIZE
+            )
+            sessions = {"onnxruntime": quality.OnnxEnsemble(path)}
+            # calibrated on the benchmark batch itself
+            sessions["onnxruntime-int8"] = quality.OnnxEnsemble(
+                quality.quantize_onnx(
+                    path, f"{workdir}/quality_int8.onnx", [imgs.cpu().numpy()]
+                )
+            )
+        except ImportError as e:
+            self.skip("M1/ensemble/onnxruntime", f"onnxruntime is missing: {e}")
+            return
+
+        for backend, session in sessions.items():
+            name = f"M1/ensemble/{backend}"
+            self.time(
+                name,
+                lambda: quality.ensemble_predict(session, imgs),
+                members=len(session),
+                weights=weights,
+                **info,
+            )
+            self.results[name]["speedup"] = (
+                self.results["M1/ensemble"]["best"] / self.results[name]["best"]
+            )
+
+    def vessel_ensemble(self, vessel):
+        checkpoints = vessel.ensemble_checkpoints(
+            VESSEL_DATASET, VESSEL_JOB_NAME, self.root
+        )
+        if all(os.path.exists(path) for path in checkpoints):
+            nets = vessel.load_segmenters(
+                VESSEL_DATASET, VESSEL_JOB_NAME, self.device, root=self.root
+            )
+            return nets, "checkpoints"
+        member = vessel.Segmenter(
+            input_channels=3, n_filters=32, n_classes=1, bilinear=False
+        )
+        return repeat_member(member.to(self.device).eval(), len(checkpoints)), "random"
+
+    def artery_vein_ensemble(self, artery_vein):
+        checkpoint_dirs = artery_vein.ensemble_checkpoints(AV_JOB_NAME, self.root)
+        if all(
+            os.path.exists(path + name)
+            for path in checkpoint_dirs
+            for name in artery_vein.CHECKPOINT_NAMES
+        ):
+            nets = artery_vein.load_av_ensemble(
+                AV_JOB_NAME, self.device, root=self.root
+            )
+            return nets, "checkpoints"
+        member = tuple(
+            net(input_channels=3, n_filters=32, n_classes=4, bilinear=False)
+            .to(self.device)
+            .eval()
+            for net in (
+                artery_vein.Generator_main,
+                artery_vein.Generator_branch,
+                artery_vein.Generator_branch,
+            )
+        )
+        return repeat_member(member, len(checkpoint_dirs)), "random"
+
+    def disc_cup_ensemble(self, disc_cup):
+        experiments = disc_cup.ensemble_experiments(self.root)
+        if all(os.path.isdir(path) for path in experiments):
+            models = disc_cup.load_disc_cup_ensemble(
+                DISC_CUP_MODEL, self.device, root=self.root
+            )
+            return models, "checkpoints"
+        member = disc_cup.get_arch(DISC_CUP_MODEL, n_classes=3)
+        return repeat_member(member.to(self.device).eval(), len(experiments)), "random"
+
+    def bench_ensembles(self, crop, steps, workdir):
+        """
+        Forward pass of every ensemble on a batch of the synthetic crop, and of
+        the M1 ensemble run adaptively and exported to ONNX Runtime, in float
+        and INT8
+        """
+        crops = [Image.fromarray(crop)] * self.batch_size
+        info = {"batch_size": self.batch_size}
+
+        if "M1" in steps:
+            quality = load_module("M1_Retinal_Image_quality_EyePACS", "test_outside")
+            try:
+                models, weights = self.quality_ensemble(quality)
+            except Exception as e:
+                self.skip("M1/ensemble", f"cannot build the ensemble: {e}")
+            else:
+                imgs = to_batch(
+                    [
+                        quality.BasicDataset_OUT.preprocess(
+                            c, QUALITY_IMAGE_SIZE, False, 0
+                        )
+                        for c in crops
+                    ],
+                    self.device,
+                )
+
+                def forward():
+                    with torch.no_grad():
+                        quality.ensemble_predict(models, imgs)
+
+                self.time(
+                    "M1/ensemble",
+                    forward,
+                    members=len(models),
+                    weights=weights,
+                    **info,
+                )
+                self.bench_stacked(quality, models, imgs, weights, info)
+                self.bench_adaptive(quality, models, imgs, weights, info)
+                self.bench_onnx(quality, models, imgs, weights, workdir, info)
+
+        if "vessel" in steps:
+            vessel = load_module("M2_Vessel_seg", "test_outside_integrated")
+            nets, weights = self.vessel_ensemble(vessel)
+            imgs = to_batch(
+                [
+                    vessel.SEDataset_out.preprocess(
+                        c.resize(VESSEL_IMAGE_SIZE),
+                        VESSEL_DATASET,
+                        VESSEL_IMAGE_SIZE,
+                        False,
+                        VESSEL_THRESHOLD,
+                    )
+                    for c in crops
+                ],
+                self.device,
+            )
+            self.time(
+                "vessel/ensemble",
+                lambda: vessel.ensemble_segment(nets, imgs),
+                members=len(nets),
+                weights=weights,
+                **info,
+            )
+
+        if "artery_vein" in steps:
+            artery_vein = load_module("M2_Artery_vein", "test_outside")
+            nets, weights = self.artery_vein_ensemble(artery_vein)
+            imgs = to_batch(
+                [
+                    artery_vein.LearningAVSegData_OOD.preprocess(
+                        c.resize(AV_IMAGE_SIZE), AV_DATASET, AV_IMAGE_SIZE, False
+                    )
+                    for c in crops
+                ],
+                self.device,
+            )
+            self.time(
+                "artery_vein/ensemble",
+                lambda: artery_vein.ensemble_av(nets, imgs, self.device),
+                members=len(nets),
+                weights=weights,
+                **info,
+            )
+
+        if "disc_cup" in steps:
+            disc_cup, p_tr = load_module(
+                "M2_lwnet_disc_cup",
+                "generate_av_results",
+                "utils.paired_transforms_tv04",
+            )
+            models, weights = self.disc_cup_ensemble(disc_cup)
+            tr = p_tr.Compose([p_tr.Resize(DISC_CUP_IMAGE_SIZE), p_tr.ToTensor()])
+            imgs = torch.stack([tr(c) for c in crops]).to(
+                device=self.device, dtype=torch.float32
+            )
+            self.time(
+                "disc_cup/ensemble",
+                lambda: disc_cup.ensemble_disc_cup(models, imgs, self.device),
+                members=len(models),
+                weights=weights,
+                **info,
+            )
+
+    def bench_write(self, crop, masks, workdir):
+        """save_segmentation of a batch, with cv2.imwrite and the ImageWriter"""
+        vessel = load_module("M2_Vessel_seg", "test_outside_integrated")
+        data_path = f"{workdir}/write/"
+        vessel.make_output_dirs(data_path)
+        vessel_map = cv2.resize(np.float32(masks["vessel"] > 0), VESSEL_IMAGE_SIZE)
+        probability = torch.from_numpy(cv2.GaussianBlur(vessel_map, (5, 5), 0))[None]
+        uncertainty = probability * (1 - probability)
+        info = {"batch_size": self.batch_size}
+
+        def save(write):
+            for i in range(self.batch_size):
+                vessel.save_segmentation(
+                    data_path,
+                    f"{i}",
+                    probability,
+                    uncertainty,
+                    crop.shape[1],
+                    crop.shape[0],
+                    write=write,
+                )
+
+        self.time("vessel/write/imwrite", lambda: save(cv2.imwrite), **info)
+        for codec in CODECS:
+            with ImageWriter(codec) as writer:
+
+                def written():
+                    save(writer.write)
+                    writer.wait()
+
+                self.time(f"vessel/write/{codec}", written, **info)
+
+    def write_masks(self, results_path, masks, radius):
+        """Results tree holding the synthetic masks where the M2 stages write theirs"""
+        m2_path = f"{results_path}/M2"
+        resized = {
+            key: cv2.resize(
+                mask, (MASK_SIZE, MASK_SIZE), interpolation=cv2.INTER_NEAREST
+            )
+            for key, mask in masks.items()
+        }
+        for directory, image in (
+            ("binary_vessel/resize_binary", resized["vessel"]),
+            ("artery_vein/resized", av_image(resized)),
+            ("optic_disc_cup/resized", disc_cup_image(resized)),
+        ):
+            os.makedirs(f"{m2_path}/{directory}", exist_ok=True)
+            self.prep.imwrite(f"{m2_path}/{directory}/{NAME}", image)
+
+        os.makedirs(f"{results_path}/M0", exist_ok=True)
+        scale = radius * 2 / 912
+        pd.DataFrame(
+            [
+                {
+                    "Name": NAME,
+                    "centre_w": 0,
+                    "centre_h": 0,
+                    "radius": radius,
+                    "Scale": scale,
+                    "Scale_resolution": 0.008 * scale * 1000,
+                }
+            ]
+        ).to_csv(f"{results_path}/M0/crop_info.csv", index=False)
+        return m2_path
+
+    def bench_postprocess(self, masks, radius, workdir, steps):
+        """filter_frag, optic_disc_centre and evaluate_window on 912 x 912 masks"""
+        results_path = f"{workdir}/Results"
+        m2_path = self.write_masks(results_path, masks, radius)
+        vessel_path = f"{m2_path}/binary_vessel/"
+        artery_vein_path = f"{m2_path}/artery_vein/"
+        disc_cup_path = f"{m2_path}/optic_disc_cup/resized/"
+
+        vessel = load_module("M2_Vessel_seg", "test_outside_integrated")
+        artery_vein = load_module("M2_Artery_vein", "test_outside")
+
+        def vessel_filter():
+            vessel.filter_frag(vessel_path, [NAME])
+
+        def artery_vein_filter():
+            artery_vein.filter_frag(artery_vein_path, [NAME])
+
+        if "filter_frag" in steps:
+            self.time("vessel/filter_frag", vessel_filter)
+            self.time("artery_vein/filter_frag", artery_vein_filter)
+        else:
+            # the later steps read its outputs
+            vessel_filter()
+            artery_vein_filter()
+
+        if "optic_disc_centre" in steps:
+            disc_cup = load_module("M2_lwnet_disc_cup", "generate_av_results")
+            self.time(
+                "disc_cup/optic_disc_centre",
+                lambda: disc_cup.optic_disc_centre(
+                    disc_cup_path, vessel_path, artery_vein_path
+                ),
+            )
+
+        if "evaluate_window" in steps:
+            for directory in ("M3_feature_zone", "M3_feature_whole_pic"):
+                configuration, retina, tortuosity_measures = load_module(
+                    f"{directory}/retipy",
+                    "retipy.configuration",
+                    "retipy.retina",
+                    "retipy.tortuosity_measures",
+                )
+                config = configuration.Configuration(
+                    f"{ROOT}/{directory}/retipy/resources/retipy.config"
+                )
+
+                def evaluate():
+                    segmented = retina.Retina(
+                        None,
+                        f"{vessel_path}binary_skeleton/{NAME}",
+                        store_path=f"{vessel_path}binary_process",
+                    )
+                    window = retina.Window(
+                        segmented, MASK_SIZE, min_pixels=config.pixels_per_window
+                    )
+                    tortuosity_measures.evaluate_window(
+                        window,
+                        config.pixels_per_window,
+                        config.sampling_size,
+                        config.r_2_threshold,
+                        store_path=f"{vessel_path}binary_process/",
+                    )
+
+                self.time(f"{directory}/evaluate_window", evaluate)
+
+    def run(self, steps=STEPS):
+        """Time ``steps`` and return the report"""
+        with tempfile.TemporaryDirectory() as workdir:
+            if "M0" in steps:
+                self.bench_m0(workdir)
+            _, crop, masks, radius = self.crop(1000)
+            self.bench_ensembles(crop, steps, workdir)
+            if "write" in steps:
+                self.bench_write(crop, masks, workdir)
+            if {"filter_frag", "optic_disc_centre", "evaluate_window"} & set(steps):
+                self.bench_postprocess(masks, radius, workdir, steps)
+        return {
+            "environment": environment(self.device),
+            "settings": {
+                "sizes": list(self.sizes),
+                "repeat": self.repeat,
+                "batch_size": self.batch_size,
+                "seed": self.seed,
+            },
+            "results": self.results,
+        }
+
+
+def save_report(report, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def compare(baseline, report):
+    """Table of the best times of two reports, with the speedup of ``report``"""
+    rows = []
+    for name, result in report["results"].items():
+        before = baseline["results"].get(name, {})
+        if "best" not in result or "best" not in before:
+            continue
+        rows.append(
+            {
+                "step": name,
+                "baseline_s": before["best"],
+                "current_s": result["best"],
+                "speedup": before["best"] / result["best"],
+            }
+        )
+    return pd.DataFrame(rows, columns=["step", "baseline_s", "current_s", "speedup"])
@@ -0,0 +1,86 @@
+"""
+Content-addressed keys of the stages.
+
+A stage key is the sha256 of the upstream key (the image digest for M0), the
+stage source files, its configuration and its checkpoints. An image is only
+run through a stage again when the key recorded in the ledger differs.
+File digests are cached by size and mtime in manifest.json so unchanged
+images and checkpoints are hashed once.
+"""
+import glob
+import hashlib
+import json
+import os
+
+from .stages import ROOT
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sha256_text(*parts):
+    return hashlib.sha256("\0".join(parts).encode("utf8")).hexdigest()
+
+
+def source_files(*patterns):
+    """Files of the repository matching the glob patterns, sorted"""
+    return sorted(
+        path
+        for pattern in patterns
+        for path in glob.glob(os.path.join(ROOT, pattern), recursive=True)
+    )
+
+
+class Manifest:
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+        else:
+            data = {}
+        self.files = data.get("files", {})
+
+    def digest(self, path):
+        """sha256 of a file, reused while its size and mtime do not change"""
+        stat = os.stat(path)
+        cached = self.files.get(path)
+        if (
+            cached is not None
+            and cached["size"] == stat.st_size
+            and cached["mtime"] == stat.st_mtime_ns
+        ):
+            return cached["sha256"]
+        digest = sha256_file(path)
+        self.files[path] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "sha256": digest,
+        }
+        return digest
+
+    def cached(self, path, field, compute):
+        """compute(path), kept with the digest and reused while the file is unchanged"""
+        self.digest(path)
+        entry = self.files[path]
+        if field not in entry:
+            entry[field] = compute(path)
+        return entry[field]
+
+    def version(self, paths, config=()):
+        """Digest of a stage: its source files or checkpoints and its configuration"""
+        return sha256_text(
+            *(os.path.relpath(path, ROOT) + ":" + self.digest(path) for path in paths),
+            *(repr(item) for item in config),
+        )
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"files": self.files}, f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,109 @@
+"""
+Duplicate images of a cohort, run through the pipeline once.
+
+Images whose bytes are identical (the sha256 the stage keys start from) are
+duplicates. With ``near``, so are re-exports and re-uploads of the same
+picture under another name or format: images of the same size whose 64 bit
+difference hash of a 9 x 8 grey thumbnail is within HASH_DISTANCE bits and
+whose 64 x 64 grey thumbnails differ by less than THUMBNAIL_TOLERANCE grey
+levels on average. The hash alone matches too many fundus photographs of the
+same camera, the thumbnail comparison only runs on the images it matches.
+Images of different pixel resolutions are never duplicates, their features
+are not the same.
+
+The runner processes the first image of every group and gives the others its
+results (see Runner.share_results).
+"""
+import cv2
+import numpy as np
+from PIL import Image
+
+THUMBNAIL_SIZE = 64
+HASH_DISTANCE = 3
+THUMBNAIL_TOLERANCE = 2.0
+# the hash is split in HASH_DISTANCE + 1 bands, two hashes within
+# HASH_DISTANCE bits have at least one band in common
+BAND_BITS = 64 // (HASH_DISTANCE + 1)
+
+
+def thumbnail(path):
+    """Size of an image and its grey THUMBNAIL_SIZE square thumbnail"""
+    with Image.open(path) as image:
+        size = image.size
+        # JPEGs are decoded at 1/2 to 1/8 of their size
+        image.draft("L", (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        grey = image.convert("L").resize((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.BOX)
+    return size, np.asarray(grey, dtype=np.float32)
+
+
+def perceptual_hash(path):
+    """Width, height and difference hash of the thumbnail of an image, for json"""
+    size, grey = thumbnail(path)
+    small = cv2.resize(grey, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = np.packbits(small[:, 1:] > small[:, :-1])
+    return [size[0], size[1], int.from_bytes(bits.tobytes(), "big")]
+
+
+def hash_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+def find_duplicates(manifest, image_dir, image_list, resolution_dict, near=False):
+    """
+    Map every duplicate in ``image_list`` to the first image of its group, the
+    one that is processed. Digests and hashes are cached in ``manifest``.
+    """
+    duplicates = {}
+    originals = {}
+    for image_path in image_list:
+        digest = manifest.digest(f"{image_dir}/{image_path}")
+        key = (digest, resolution_dict[image_path])
+        if key in originals:
+            duplicates[image_path] = originals[key]
+        else:
+            originals[key] = image_path
+    if not near:
+        return duplicates
+
+    bands = {}
+    thumbnails = {}
+
+    def same_picture(image_path, original):
+        for path in (image_path, original):
+            if path not in thumbnails:
+                thumbnails[path] = thumbnail(f"{image_dir}/{path}")[1]
+        difference = cv2.absdiff(thumbnails[image_path], thumbnails[original])
+        return difference.mean() < THUMBNAIL_TOLERANCE
+
+    for image_path in image_list:
+        if image_path in duplicates:
+            continue
+        try:
+            width, height, image_hash = manifest.cached(
+                f"{image_dir}/{image_path}", "perceptual_hash", perceptual_hash
+            )
+        except Exception:
+            # M0 reports the images it cannot read
+            continue
+        group = (width, height, resolution_dict[image_path])
+        image_bands = [
+            (group, band, image_hash >> (band * BAND_BITS) & ((1 << BAND_BITS) - 1))
+            for band in range(HASH_DISTANCE + 1)
+        ]
+        original = next(
+            (
+                candidate
+                for band in image_bands
+                for candidate, candidate_hash in bands.get(band, ())
+                if hash_distance(image_hash, candidate_hash) <= HASH_DISTANCE
+                and same_picture(image_path, candidate)
+            ),
+            None,
+        )
+        if original is not None:
+            duplicates[image_path] = original
+            thumbnails.pop(image_path, None)
+            continue
+        for band in image_bands:
+            bands.setdefault(band, []).append((image_path, image_hash))
+    return duplicates
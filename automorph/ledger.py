@@ -0,0 +1,109 @@
+"""
+Per-image, per-stage job ledger of the runner, in Results/ledger.sqlite.
+
+Every batch is committed as soon as it is finished, so a run that is killed
+resumes from the last finished batch. A row records the stage key of the image
+(see cache.py), its status, the time spent on it and the error when the stage
+failed. The result tables themselves are in the store (see store.py).
+
+status is one of
+    done        the stage outputs are up to date
+    incomplete  done, but some M3 measurements failed and were written as -1
+    failed      the stage raised, the image is tried again on the next run
+"""
+import sqlite3
+import time
+
+import pandas as pd
+
+DONE = "done"
+INCOMPLETE = "incomplete"
+FAILED = "failed"
+
+
+class Ledger:
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                stage TEXT NOT NULL,
+                name TEXT NOT NULL,
+                status TEXT NOT NULL,
+                key TEXT,
+                seconds REAL,
+                finished REAL,
+                error TEXT,
+                PRIMARY KEY (stage, name)
+            )
+            """
+        )
+        self.connection.commit()
+
+    def key(self, stage, name):
+        """Key the image was last processed with, None if it never succeeded"""
+        found = self.connection.execute(
+            "SELECT key FROM jobs WHERE stage = ? AND name = ? AND status != ?",
+            (stage, name, FAILED),
+        ).fetchone()
+        return found[0] if found else None
+
+    def job(self, stage, name):
+        """(status, key, error) of the last run of the stage on the image, or None"""
+        return self.connection.execute(
+            "SELECT status, key, error FROM jobs WHERE stage = ? AND name = ?",
+            (stage, name),
+        ).fetchone()
+
+    def record(self, stage, name, status, key=None, seconds=None, error=None):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO jobs"
+            " (stage, name, status, key, seconds, finished, error)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (stage, name, status, key, seconds, time.time(), error),
+        )
+
+    def commit(self):
+        self.connection.commit()
+
+    def forget(self, names):
+        """Drop the jobs of images that are no longer in the cohort"""
+        names = set(names)
+        stale = [
+            (stage, name)
+            for stage, name in self.connection.execute("SELECT stage, name FROM jobs")
+            if name not in names
+        ]
+        self.connection.executemany(
+            "DELETE FROM jobs WHERE stage = ? AND name = ?", stale
+        )
+        self.connection.commit()
+
+    def drop(self, names):
+        """Drop the jobs of ``names``, images removed from the cohort"""
+        self.connection.executemany(
+            "DELETE FROM jobs WHERE name = ?", [(name,) for name in names]
+        )
+        self.connection.commit()
+
+    def failures(self):
+        """Images whose last run of a stage failed or left -1 measurements"""
+        return pd.read_sql_query(
+            "SELECT name AS Name, stage, status, error, finished FROM jobs"
+            " WHERE status != ? ORDER BY name, stage",
+            self.connection,
+            params=(DONE,),
+        )
+
+    def summary(self):
+        """Number of images and seconds spent per stage and status"""
+        return pd.read_sql_query(
+            "SELECT stage, status, COUNT(*) AS images, SUM(seconds) AS seconds"
+            " FROM jobs GROUP BY stage, status ORDER BY stage, status",
+            self.connection,
+        )
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,197 @@
+"""
+AutoMorph as a library: keep the models loaded and get the features of images
+as a DataFrame.
+
+    pipeline = automorph.Pipeline(device="cuda:0")
+    features = pipeline.run([rgb_array, "/path/to/fundus.jpg"])
+
+Images are cropped and graded in memory, nothing is read from or written to
+$AUTOMORPH_DATA. The vessel, artery/vein and disc/cup maps of the images still
+go through the M2 post-processing and the M3 retipy scripts, which work on
+image files: they are written to a private scratch directory, in /dev/shm when
+it is available so that they stay in memory, and are removed after each call.
+"""
+import os
+import shutil
+import tempfile
+import weakref
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from .runner import Runner
+from .stages import load_module
+from .store import CENTRED
+
+
+def scratch_root():
+    """Memory backed directory for the scratch files when there is one"""
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return None
+
+
+class Pipeline:
+    def __init__(
+        self,
+        device=None,
+        batch_size=8,
+        pixel_resolution=0.008,
+        features=True,
+    ):
+        self.batch_size = batch_size
+        self.pixel_resolution = pixel_resolution
+        self.features = features
+        self.scratch = tempfile.mkdtemp(prefix="automorph-", dir=scratch_root())
+        self._cleanup = weakref.finalize(self, shutil.rmtree, self.scratch, True)
+        self.runner = Runner(
+            self.scratch, device=device, batch_size=batch_size, num_workers=0, csv=False
+        )
+        self.crop = load_module("M0_Preprocess", "EyeQ_process_multiprocess")
+
+    def close(self):
+        """Remove the scratch directory, the pipeline cannot run afterwards"""
+        self.runner.writer.close()
+        self._cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read(self, image):
+        """
+        RGB array of a path, a PIL image or a uint8 RGB array (copied, M0 masks
+        it). Other dtypes are refused rather than cast, which would wrap floats
+        in [0, 1] and uint16 values to meaningless bytes
+        """
+        if isinstance(image, (str, os.PathLike)):
+            return self.crop.prep.imread(os.fspath(image))
+        if isinstance(image, Image.Image):
+            return np.array(image.convert("RGB"))
+        image = np.array(image)
+        if image.dtype != np.uint8:
+            raise ValueError(
+                f"expected a uint8 RGB image, got an array of {image.dtype}, "
+                "scale it to 0-255 first"
+            )
+        if image.ndim != 3 or image.shape[2] != 3:
+            raise ValueError(f"expected an RGB image, got an array of {image.shape}")
+        return image
+
+    @staticmethod
+    def image_names(images, names):
+        if names is None:
+            names = [
+                os.path.splitext(os.path.basename(os.fspath(image)))[0]
+                if isinstance(image, (str, os.PathLike))
+                else f"image_{index:05d}"
+                for index, image in enumerate(images)
+            ]
+        names = [str(name) for name in names]
+        if len(names) != len(images):
+            raise ValueError(f"{len(names)} names for {len(images)} images")
+        if len(set(names)) != len(names):
+            raise ValueError("image names must be unique")
+        return names
+
+    def run(self, images, names=None, pixel_resolution=None):
+        """
+        Crop info, M1 quality and, with ``features``, the Disc or Macular
+        centred M3 features of every image, one row per image in input order.
+
+        ``images`` are uint8 RGB arrays, PIL images or image paths, named after
+        their file or ``image_00000``, ... unless ``names`` are given. ``error``
+        holds the error of the images that could not be processed.
+        """
+        images = list(images)
+        names = self.image_names(images, names)
+        if pixel_resolution is None:
+            pixel_resolution = self.pixel_resolution
+
+        runner = self.runner
+        shutil.rmtree(f"{self.scratch}/Results", ignore_errors=True)
+        try:
+            return self.process(images, names, pixel_resolution)
+        finally:
+            shutil.rmtree(f"{self.scratch}/Results", ignore_errors=True)
+            shutil.rmtree(runner.staging_path, ignore_errors=True)
+
+    def process(self, images, names, pixel_resolution):
+        """The body of run, in a fresh scratch Results tree"""
+        runner = self.runner
+        runner.make_output_dirs()
+
+        errors = {}
+        crop_rows = []
+        quality = []
+        measured = []
+        for start in range(0, len(images), self.batch_size):
+            batch_names = []
+            crops = []
+            for image, name in zip(
+                images[start : start + self.batch_size],
+                names[start : start + self.batch_size],
+            ):
+                try:
+                    r_img, info = self.crop.crop_fundus(
+                        self.read(image), pixel_resolution
+                    )
+                except Exception as e:
+                    errors[name] = repr(e)
+                    continue
+                crop_rows.append({"Name": name + ".png", **info})
+                batch_names.append(name)
+                crops.append(Image.fromarray(r_img))
+            if not crops:
+                continue
+
+            try:
+                quality.append(runner.assess_quality(batch_names, crops))
+            except Exception as e:
+                for name in batch_names:
+                    errors[name] = repr(e)
+                continue
+            if not self.features:
+                continue
+            try:
+                runner.segment_vessels(batch_names, crops)
+                runner.segment_artery_vein(batch_names, crops)
+                runner.segment_disc_cup(batch_names, crops)
+                runner.writer.wait()
+                png_names = [name + ".png" for name in batch_names]
+                runner.vessel.filter_frag(runner.vessel_path, png_names)
+                runner.artery_vein.filter_frag(runner.artery_vein_path, png_names)
+            except Exception as e:
+                for name in batch_names:
+                    errors[name] = repr(e)
+                continue
+            measured.extend(png_names)
+
+        result = pd.DataFrame({"Name": [name + ".png" for name in names]})
+        if crop_rows:
+            result = result.merge(pd.DataFrame(crop_rows), how="left", on="Name")
+        if quality:
+            result = result.merge(
+                pd.concat(quality, ignore_index=True), how="left", on="Name"
+            )
+        if measured:
+            try:
+                runner.store.write("crop_info", pd.DataFrame(crop_rows))
+                runner.measure_features(measured)
+            except Exception as e:
+                for png_name in measured:
+                    errors[png_name[: -len(".png")]] = repr(e)
+            else:
+                features = pd.concat(
+                    [
+                        runner.store.features(centred).assign(centred=centred)
+                        for centred in CENTRED
+                    ],
+                    ignore_index=True,
+                )
+                result = result.merge(features, how="left", on="Name")
+        result["error"] = [errors.get(name) for name in names]
+        return result
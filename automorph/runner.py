@@ -0,0 +1,1108 @@
+"""
+Resident single-process runner for the whole AutoMorph pipeline.
+
+All ensembles are loaded once and kept on the device. Images are cropped by
+a pool of M0 workers while the ensembles run, and the crops are handed to M1
+and the three M2 segmenters as arrays, so nothing is re-read from
+Results/M0/images. The M2 post-processing and the M3 feature scripts still
+work on the files written under ``$AUTOMORPH_DATA/Results``, as in
+script_1.sh, while the result tables go to the Parquet store in Results/store
+(see store.py) and are exported to the usual csv files at the end of a run.
+
+Results/ledger.sqlite records the key and status of every image for every
+stage (see cache.py and ledger.py) as soon as its batch is done. Only new,
+changed or failed images are run again, so a killed run resumes where it
+stopped. The disc centring and M3 run on chunks of images in a scratch tree
+whose images are moved into Results and measurements into the store afterwards.
+"""
+import collections
+import itertools
+import logging
+import os
+import shutil
+import time
+from multiprocessing import Pool, cpu_count
+
+import pandas as pd
+import torch
+from PIL import Image
+from tqdm import tqdm
+
+from .cache import Manifest, sha256_text, source_files
+from .duplicates import find_duplicates
+from .ledger import DONE, FAILED, INCOMPLETE, Ledger
+from .shards import select_shard, shard_path
+from .stages import ROOT, get_device, load_module, run_script
+from .store import CENTRED, ResultStore, measurement_tables
+from .trace import trace_forward, tracer
+from .writer import CODECS, ImageWriter
+
+QUALITY_MODEL = "efficientnet"
+QUALITY_TASK = "Retinal_quality"
+QUALITY_LOAD = "EyePACS_quality"
+QUALITY_IMAGE_SIZE = (512, 512)
+
+VESSEL_DATASET = "ALL-SIX"
+VESSEL_JOB_NAME = "20210630_uniform_thres40_ALL-SIX"
+VESSEL_IMAGE_SIZE = (912, 912)
+VESSEL_THRESHOLD = 40.0
+
+AV_DATASET = "ALL-AV"
+AV_JOB_NAME = "20210724_ALL-AV_randomseed"
+AV_IMAGE_SIZE = (720, 720)
+
+DISC_CUP_MODEL = "wnet"
+DISC_CUP_IMAGE_SIZE = (512, 512)
+
+STAGES = ("M0", "M1", "vessel", "artery_vein", "disc_cup", "features")
+INFERENCE_STAGES = STAGES[:-1]
+
+STAGE_SOURCES = {
+    "M0": ("M0_Preprocess/*.py",),
+    "M1": ("M1_Retinal_Image_quality_EyePACS/*.py",),
+    "vessel": ("M2_Vessel_seg/*.py",),
+    "artery_vein": ("M2_Artery_vein/*.py", "M2_Artery_vein/scripts/*.py"),
+    "disc_cup": (
+        "M2_lwnet_disc_cup/*.py",
+        "M2_lwnet_disc_cup/models/*.py",
+        "M2_lwnet_disc_cup/utils/*.py",
+    ),
+    "features": (
+        "M3_feature_zone/retipy/**/*.py",
+        "M3_feature_zone/retipy/resources/retipy.config",
+        "M3_feature_whole_pic/retipy/**/*.py",
+        "M3_feature_whole_pic/retipy/resources/retipy.config",
+    ),
+}
+
+# M2 outputs read by optic_disc_centre, linked into the scratch tree
+FEATURE_INPUTS = (
+    ("disc_cup_path", "resized/"),
+    ("vessel_path", "binary_process/"),
+    ("vessel_path", "binary_skeleton/"),
+    ("artery_vein_path", "artery_binary_process/"),
+    ("artery_vein_path", "vein_binary_process/"),
+    ("artery_vein_path", "artery_binary_skeleton/"),
+    ("artery_vein_path", "vein_binary_skeleton/"),
+)
+# images measured per M3 run, the unit of resume for the features
+FEATURE_CHUNK = 100
+# after the image name in the M0 and M2 file names, the uncertainty of a class
+OUTPUT_SUFFIXES = ("", "_artery", "_vein", "_disc", "_cup")
+
+M3_SCRIPTS = (
+    "M3_feature_zone/retipy/create_datasets_disc_centred_B.py",
+    "M3_feature_zone/retipy/create_datasets_disc_centred_C.py",
+    "M3_feature_zone/retipy/create_datasets_macular_centred_B.py",
+    "M3_feature_zone/retipy/create_datasets_macular_centred_C.py",
+    "M3_feature_whole_pic/retipy/create_datasets_macular_centred.py",
+    "M3_feature_whole_pic/retipy/create_datasets_disc_centred.py",
+)
+
+
+def init_crop_worker(trace=None, num_workers=None):
+    global crop_module
+    crop_module = load_module("M0_Preprocess", "EyeQ_process_multiprocess")
+    if num_workers:
+        crop_module.init_worker(num_workers)
+    if trace is not None:
+        # in a worker: forked ones start with a copy of the main process events
+        tracer.enabled = trace
+        tracer.drain()
+
+
+def crop_image(args):
+    """
+    M0 for one image: crop it, save the crop and return it with its crop_info row.
+    A crop that is still valid is read back from Results/M0/images instead.
+    When the image cannot be cropped the crop is None and the error message is
+    returned in place of the crop_info row.
+    """
+    image_path, data_path, save_path, resolution_, cached, reduced = args
+    name = image_path.split(".")[0]
+    if cached:
+        with tracer.span("M0/read_cached", 1):
+            r_img = crop_module.prep.imread(save_path + name + ".png")
+        return image_path, name, r_img, None
+
+    try:
+        with tracer.span("M0/decode", 1):
+            img, factor = crop_module.read_fundus(
+                f"{data_path}/images/" + image_path, reduced
+            )
+        with tracer.span("M0/crop", 1):
+            r_img, crop_info = crop_module.crop_fundus(img, resolution_, factor)
+        if not crop_module.prep.reduced_within_tolerance(factor, crop_info["radius"]):
+            # the reduced decode is too coarse for this FOV
+            with tracer.span("M0/decode", 1):
+                img, factor = crop_module.read_fundus(
+                    f"{data_path}/images/" + image_path, False
+                )
+            with tracer.span("M0/crop", 1):
+                r_img, crop_info = crop_module.crop_fundus(img, resolution_, factor)
+    except Exception as e:
+        print(f"\nError processing {image_path}: {str(e)}")
+        return image_path, name, None, str(e)
+
+    with tracer.span("M0/write", 1):
+        crop_module.prep.imwrite(save_path + name + ".png", r_img)
+    return image_path, name, r_img, {"Name": name + ".png", **crop_info}
+
+
+def traced_crop_image(args):
+    """crop_image in a worker, with the trace events it recorded"""
+    return crop_image(args), tracer.drain()
+
+
+def failed_measurements(measurement_path):
+    """Columns left at -1 by the M3 scripts, per image name"""
+    failed = {}
+    for csv_name in sorted(os.listdir(measurement_path)):
+        if not csv_name.endswith("Measurement.csv"):
+            continue
+        measurement = pd.read_csv(measurement_path + csv_name)
+        values = measurement.drop(columns="Name")
+        for name, row in zip(measurement["Name"], (values == -1).values):
+            if row.any():
+                columns = ", ".join(values.columns[row])
+                failed.setdefault(name, []).append(f"{csv_name}: {columns}")
+    return failed
+
+
+def to_batch(arrays, device):
+    return torch.stack(
+        [torch.from_numpy(array).type(torch.FloatTensor) for array in arrays]
+    ).to(device=device, dtype=torch.float32)
+
+
+class Runner:
+    """Keep every stage and its models loaded and push image batches through them"""
+
+    def __init__(
+        self,
+        data_path,
+        device=None,
+        batch_size=8,
+        pixel_resolution=0.008,
+        num_workers=None,
+        prefetch=None,
+        shard=None,
+        trace=False,
+        csv=True,
+        reduced_decode=False,
+        image_codec="png",
+        png_level=None,
+        writer_threads=4,
+        duplicates="exact",
+        quality_backend="torch",
+        intra_op_threads=0,
+        inter_op_threads=0,
+        adaptive_z=None,
+        min_members=3,
+        stacked_quality=False,
+    ):
+        self.data_path = data_path
+        # (i, N) to run only the images of shard i, with its own Results
+        self.shard = shard
+        self.output_path = shard_path(data_path, shard)
+        self.device = get_device(device)
+        self.batch_size = batch_size
+        self.pixel_resolution = pixel_resolution
+        # Use max 8 cores to avoid memory issues, 0 crops in the main process
+        self.num_workers = min(cpu_count(), 8) if num_workers is None else num_workers
+        # crops kept ready for the ensembles before the M0 workers have to wait
+        self.prefetch = 4 * batch_size if prefetch is None else prefetch
+        # export the store tables to csv after every run
+        self.csv = csv
+        # decode large JPEGs downscaled, the crops are smaller but crop_info is
+        # still in full resolution pixels, accurate to about the decode factor.
+        # Images where that exceeds fundus_prep.REDUCED_TOLERANCE are decoded in full
+        self.reduced_decode = reduced_decode
+        # "none", "exact" or "near": run duplicate images once (see duplicates.py)
+        self.duplicates = duplicates
+        # "torch", "onnxruntime" or "onnxruntime-int8" for the M1 ensemble
+        self.quality_backend = quality_backend
+        if adaptive_z is not None and (stacked_quality or quality_backend != "torch"):
+            raise ValueError("adaptive M1 runs the torch members one by one")
+        # with a z, stop the M1 members on an image once its quality is settled
+        self.adaptive_z = adaptive_z
+        self.min_members = min_members
+        self.store = ResultStore(f"{self.output_path}/Results/store")
+        tracer.enabled = trace
+        tracer.synchronize = self.device.type == "cuda"
+
+        self.quality, self.merge_quality = load_module(
+            "M1_Retinal_Image_quality_EyePACS",
+            "test_outside",
+            "merge_quality_assessment",
+        )
+        self.vessel = load_module("M2_Vessel_seg", "test_outside_integrated")
+        self.artery_vein = load_module("M2_Artery_vein", "test_outside")
+        self.disc_cup, self.disc_cup_transforms = load_module(
+            "M2_lwnet_disc_cup",
+            "generate_av_results",
+            "utils.paired_transforms_tv04",
+        )
+
+        logging.info(f"Loading models on {self.device}")
+        self.quality_models = self.quality.load_backend(
+            QUALITY_MODEL,
+            QUALITY_TASK,
+            QUALITY_LOAD,
+            self.device,
+            root=ROOT,
+            backend=quality_backend,
+            intra_op_threads=intra_op_threads,
+            inter_op_threads=inter_op_threads,
+            # one vmapped model, see ensemble_executor
+            stacked=stacked_quality,
+        )
+        self.vessel_nets = self.vessel.load_segmenters(
+            VESSEL_DATASET, VESSEL_JOB_NAME, self.device, root=ROOT
+        )
+        self.artery_vein_nets = self.artery_vein.load_av_ensemble(
+            AV_JOB_NAME, self.device, root=ROOT
+        )
+        self.disc_cup_models = self.disc_cup.load_disc_cup_ensemble(
+            DISC_CUP_MODEL, self.device, root=ROOT
+        )
+        if trace:
+            self.trace_members()
+
+        self.m0_path = f"{self.output_path}/Results/M0/images/"
+        self.vessel_path = f"{self.output_path}/Results/M2/binary_vessel/"
+        self.artery_vein_path = f"{self.output_path}/Results/M2/artery_vein/"
+        self.disc_cup_path = f"{self.output_path}/Results/M2/optic_disc_cup/"
+        self.staging_path = f"{self.output_path}/.automorph_staging"
+        # encodes the M2 images in threads while the ensembles run, the images
+        # read by filter_frag and the disc centring stay png
+        self.writer = ImageWriter(
+            image_codec,
+            png_level,
+            writer_threads,
+            keep_png=(
+                self.vessel_path + "resize_binary/",
+                self.artery_vein_path + "resized/",
+                self.disc_cup_path + "resized/",
+                self.staging_path,
+            ),
+        )
+
+    def trace_members(self):
+        """Trace the forward pass of every ensemble member"""
+        if isinstance(self.quality_models, self.quality.StackedEnsemble):
+            # the members are not called, the stacked forward is
+            trace_forward("M1/stacked", self.quality_models)
+        elif not isinstance(self.quality_models, self.quality.OnnxEnsemble):
+            for index, model in enumerate(self.quality_models):
+                trace_forward(f"M1/member_{index}", model)
+        for index, net in enumerate(self.vessel_nets):
+            trace_forward(f"vessel/member_{index}", net)
+        for index, nets in enumerate(self.artery_vein_nets):
+            for head, net in zip(("G", "G_A", "G_V"), nets):
+                trace_forward(f"artery_vein/member_{index}/{head}", net)
+        for index, model in enumerate(self.disc_cup_models):
+            trace_forward(f"disc_cup/member_{index}", model)
+
+    def resolutions(self, image_list):
+        """
+        Pixel resolution per image, from resolution_information.csv when it
+        exists. Images missing from the csv are added with the default resolution,
+        the csv is left alone by shards as the other nodes read it too.
+        """
+        resolution_csv = f"{self.data_path}/resolution_information.csv"
+        if os.path.exists(resolution_csv):
+            resolution_df = pd.read_csv(resolution_csv)
+        else:
+            resolution_df = pd.DataFrame(columns=["fundus", "res"])
+        missing = [
+            image_path
+            for image_path in image_list
+            if image_path not in set(resolution_df["fundus"])
+        ]
+        if missing:
+            resolution_df = pd.concat(
+                [
+                    resolution_df,
+                    pd.DataFrame(
+                        {
+                            "fundus": missing,
+                            "res": [self.pixel_resolution] * len(missing),
+                        }
+                    ),
+                ],
+                ignore_index=True,
+            )
+            if self.shard is None:
+                resolution_df.to_csv(resolution_csv, index=None, encoding="utf8")
+        return dict(zip(resolution_df["fundus"], resolution_df["res"]))
+
+    def preprocess(self, image_list, resolution_dict, cached):
+        """
+        M0: yield ``(image_path, name, crop, crop_info)`` for every image,
+        ``crop_info`` is None for crops in ``cached`` (see crop_image).
+
+        With workers the crops are produced in the background while the caller
+        runs inference, at most ``prefetch`` images ahead of it.
+        """
+        args_list = [
+            (
+                image_path,
+                self.data_path,
+                self.m0_path,
+                resolution_dict[image_path],
+                image_path in cached,
+                self.reduced_decode,
+            )
+            for image_path in image_list
+        ]
+
+        if self.num_workers == 0:
+            init_crop_worker()
+            for result in map(crop_image, args_list):
+                yield result
+            return
+
+        # submitted from here rather than fed to imap by a generator, so that
+        # nothing blocks in the pool's threads when it is terminated early
+        tasks = iter(args_list)
+        with Pool(
+            processes=self.num_workers,
+            initializer=init_crop_worker,
+            initargs=(tracer.enabled, self.num_workers),
+        ) as pool:
+            pending = collections.deque(
+                pool.apply_async(traced_crop_image, (args,))
+                for args in itertools.islice(tasks, max(1, self.prefetch))
+            )
+            while pending:
+                result, events = pending.popleft().get()
+                args = next(tasks, None)
+                if args is not None:
+                    pending.append(pool.apply_async(traced_crop_image, (args,)))
+                tracer.merge(events)
+                yield result
+
+    def batches(self, image_list, resolution_dict, cached):
+        """
+        Group the M0 crops into inference batches as soon as they are ready.
+
+        Yields the number of input images consumed for the batch, the list of
+        ``(image_path, name, crop, crop_info)`` of the batch and the list of
+        ``(image_path, error)`` of the images that could not be cropped.
+        """
+        consumed = 0
+        batch = []
+        failed = []
+        for image_path, name, r_img, info in self.preprocess(
+            image_list, resolution_dict, cached
+        ):
+            consumed += 1
+            if r_img is None:
+                failed.append((image_path, info))
+            else:
+                batch.append((image_path, name, Image.fromarray(r_img), info))
+            if len(batch) == self.batch_size:
+                yield consumed, batch, failed
+                consumed = 0
+                batch = []
+                failed = []
+        if consumed:
+            yield consumed, batch, failed
+
+    def stage_versions(self, manifest):
+        """Digest of the code, configuration and checkpoints of every stage"""
+        checkpoints = {
+            "M1": self.quality.backend_files(
+                QUALITY_MODEL,
+                QUALITY_TASK,
+                QUALITY_LOAD,
+                root=ROOT,
+                backend=self.quality_backend,
+            ),
+            "vessel": self.vessel.ensemble_checkpoints(
+                VESSEL_DATASET, VESSEL_JOB_NAME, root=ROOT
+            ),
+            "artery_vein": [
+                checkpoint_saved + checkpoint_name
+                for checkpoint_saved in self.artery_vein.ensemble_checkpoints(
+                    AV_JOB_NAME, root=ROOT
+                )
+                for checkpoint_name in self.artery_vein.CHECKPOINT_NAMES
+            ],
+            "disc_cup": [
+                experiment_path + "model_checkpoint.pth"
+                for experiment_path in self.disc_cup.ensemble_experiments(root=ROOT)
+            ],
+        }
+        config = {
+            # crop_info of a reduced decode is approximate
+            "M0": ("reduced_decode",) if self.reduced_decode else (),
+            "M1": (QUALITY_MODEL, QUALITY_TASK, QUALITY_LOAD, QUALITY_IMAGE_SIZE)
+            + (() if self.quality_backend == "torch" else (self.quality_backend,))
+            + (
+                ()
+                if self.adaptive_z is None
+                else ("adaptive", self.adaptive_z, self.min_members)
+            ),
+            "vessel": (
+                VESSEL_DATASET,
+                VESSEL_JOB_NAME,
+                VESSEL_IMAGE_SIZE,
+                VESSEL_THRESHOLD,
+            ),
+            "artery_vein": (AV_DATASET, AV_JOB_NAME, AV_IMAGE_SIZE),
+            "disc_cup": (DISC_CUP_MODEL, DISC_CUP_IMAGE_SIZE),
+            "features": M3_SCRIPTS,
+        }
+        return {
+            stage: manifest.version(
+                source_files(*STAGE_SOURCES[stage]) + checkpoints.get(stage, []),
+                config[stage],
+            )
+            for stage in STAGES
+        }
+
+    def stage_keys(self, manifest, image_list, resolution_dict):
+        """Key of every image for every stage, chained from the image digest"""
+        versions = self.stage_versions(manifest)
+        keys = {stage: {} for stage in STAGES}
+        for image_path in tqdm(image_list, desc="Hashing images", unit="img"):
+            m0_key = sha256_text(
+                manifest.digest(f"{self.data_path}/images/" + image_path),
+                versions["M0"],
+                repr(resolution_dict[image_path]),
+            )
+            keys["M0"][image_path] = m0_key
+            for stage in INFERENCE_STAGES[1:]:
+                keys[stage][image_path] = sha256_text(m0_key, versions[stage])
+            keys["features"][image_path] = sha256_text(
+                *(
+                    keys[stage][image_path]
+                    for stage in INFERENCE_STAGES
+                    if stage != "M1"
+                ),
+                versions["features"],
+            )
+        return keys
+
+    def outputs(self, stage):
+        """Image names whose ``stage`` outputs are still on disk or in the store"""
+        if stage == "M1":
+            return self.store.names("results_ensemble")
+        if stage == "features":
+            return set().union(
+                *(
+                    self.store.names(measurement_tables(centred)[0])
+                    for centred in CENTRED
+                )
+            )
+        output_dir = {
+            "M0": self.m0_path,
+            "vessel": self.vessel_path + "binary_skeleton/",
+            "artery_vein": self.artery_vein_path + "vein_binary_skeleton/",
+            "disc_cup": self.disc_cup_path + "resized/",
+        }[stage]
+        if not os.path.isdir(output_dir):
+            return set()
+        if stage == "M0":
+            return set(os.listdir(output_dir)) & self.store.names("crop_info")
+        return set(os.listdir(output_dir))
+
+    def assess_quality(self, names, crops):
+        """M1: ensemble softmax mean/sd, predicted grade and quality of every crop"""
+        with tracer.span("M1/preprocess", len(crops)):
+            imgs = to_batch(
+                [
+                    self.quality.BasicDataset_OUT.preprocess(
+                        crop, QUALITY_IMAGE_SIZE, False, 0
+                    )
+                    for crop in crops
+                ],
+                self.device,
+            )
+        members = None
+        with torch.no_grad(), tracer.span("M1/ensemble", len(crops)):
+            if self.adaptive_z is None:
+                mean, std, prediction_decode = self.quality.ensemble_predict(
+                    self.quality_models, imgs
+                )
+            else:
+                mean, std, prediction_decode, members = (
+                    self.quality.adaptive_predict(
+                        self.quality_models, imgs, self.adaptive_z, self.min_members
+                    )
+                )
+        result = pd.DataFrame(
+            {
+                "Name": [name + ".png" for name in names],
+                "softmax_good": mean[:, 0],
+                "softmax_usable": mean[:, 1],
+                "softmax_bad": mean[:, 2],
+                "good_sd": std[:, 0],
+                "usable_sd": std[:, 1],
+                "bad_sd": std[:, 2],
+                "Prediction": prediction_decode,
+            }
+        )
+        result["quality"] = [
+            self.merge_quality.quality_label(prediction, softmax_bad)
+            for prediction, softmax_bad in zip(
+                result["Prediction"], result["softmax_bad"]
+            )
+        ]
+        if members is not None:
+            # members the image ran through
+            result["members"] = members
+        return result
+
+    def segment_vessels(self, names, crops):
+        """M2: binary vessel probability and uncertainty maps"""
+        with tracer.span("vessel/preprocess", len(crops)):
+            imgs = to_batch(
+                [
+                    self.vessel.SEDataset_out.preprocess(
+                        crop.resize(VESSEL_IMAGE_SIZE),
+                        VESSEL_DATASET,
+                        VESSEL_IMAGE_SIZE,
+                        False,
+                        VESSEL_THRESHOLD,
+                    )
+                    for crop in crops
+                ],
+                self.device,
+            )
+        with tracer.span("vessel/ensemble", len(crops)):
+            mask_pred_sigmoid, uncertainty_map = self.vessel.ensemble_segment(
+                self.vessel_nets, imgs
+            )
+        with tracer.span("vessel/write", len(crops)):
+            for i, (name, crop) in enumerate(zip(names, crops)):
+                self.vessel.save_segmentation(
+                    self.vessel_path,
+                    name,
+                    mask_pred_sigmoid[i, ...],
+                    uncertainty_map[i, ...],
+                    crop.size[0],
+                    crop.size[1],
+                    write=self.writer.write,
+                )
+
+    def segment_artery_vein(self, names, crops):
+        """M2: artery/vein classes and uncertainty maps"""
+        with tracer.span("artery_vein/preprocess", len(crops)):
+            imgs = to_batch(
+                [
+                    self.artery_vein.LearningAVSegData_OOD.preprocess(
+                        crop.resize(AV_IMAGE_SIZE), AV_DATASET, AV_IMAGE_SIZE, False
+                    )
+                    for crop in crops
+                ],
+                self.device,
+            )
+        with tracer.span("artery_vein/ensemble", len(crops)):
+            prediction_decode, uncertainty_map = self.artery_vein.ensemble_av(
+                self.artery_vein_nets, imgs, self.device
+            )
+        with tracer.span("artery_vein/write", len(crops)):
+            for i, (name, crop) in enumerate(zip(names, crops)):
+                self.artery_vein.save_av(
+                    self.artery_vein_path,
+                    name,
+                    prediction_decode[i, ...],
+                    uncertainty_map[i, ...],
+                    crop.size[0],
+                    crop.size[1],
+                    write=self.writer.write,
+                )
+
+    def segment_disc_cup(self, names, crops):
+        """M2: optic disc/cup classes and uncertainty maps"""
+        p_tr = self.disc_cup_transforms
+        tr = p_tr.Compose([p_tr.Resize(DISC_CUP_IMAGE_SIZE), p_tr.ToTensor()])
+        with tracer.span("disc_cup/preprocess", len(crops)):
+            imgs = torch.stack([tr(crop) for crop in crops]).to(
+                device=self.device, dtype=torch.float32
+            )
+        with tracer.span("disc_cup/ensemble", len(crops)):
+            prediction_decode, uncertainty_map = self.disc_cup.ensemble_disc_cup(
+                self.disc_cup_models, imgs, self.device
+            )
+        with tracer.span("disc_cup/write", len(crops)):
+            for i, (name, crop) in enumerate(zip(names, crops)):
+                self.disc_cup.save_disc_cup(
+                    self.disc_cup_path,
+                    name,
+                    prediction_decode[i, ...],
+                    uncertainty_map[i, ...],
+                    crop.size[0],
+                    crop.size[1],
+                    write=self.writer.write,
+                )
+
+    def measure_features(self, names):
+        """
+        Disc centring and M3 for ``names`` in a scratch tree, then move the zone
+        images into Results/M2 and the measurements into the store.
+
+        Returns the measurements the M3 scripts left at -1, per image name.
+        """
+        staging = self.staging_path
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+        os.makedirs(f"{staging}/Results/M0")
+
+        self.store.read("crop_info", names=names).to_csv(
+            f"{staging}/Results/M0/crop_info.csv", index=None, encoding="utf8"
+        )
+        for path_attr, sub_dir in FEATURE_INPUTS:
+            main_dir = getattr(self, path_attr) + sub_dir
+            staged_dir = staging + main_dir[len(self.output_path) :]
+            os.makedirs(staged_dir, exist_ok=True)
+            for name in names:
+                os.symlink(main_dir + name, staged_dir + name)
+
+        staged = {
+            path_attr: staging + getattr(self, path_attr)[len(self.output_path) :]
+            for path_attr in ("disc_cup_path", "vessel_path", "artery_vein_path")
+        }
+        with tracer.span("features/optic_disc_centre", len(names)):
+            self.disc_cup.optic_disc_centre(
+                staged["disc_cup_path"] + "resized/",
+                staged["vessel_path"],
+                staged["artery_vein_path"],
+                write=self.writer.write,
+            )
+            self.writer.wait()
+
+        automorph_data = os.environ.get("AUTOMORPH_DATA")
+        os.environ["AUTOMORPH_DATA"] = staging
+        try:
+            for script in M3_SCRIPTS:
+                logging.info(f"Running {script}")
+                with tracer.span(
+                    "features/" + os.path.basename(script)[: -len(".py")], len(names)
+                ):
+                    run_script(script)
+        finally:
+            if automorph_data is None:
+                del os.environ["AUTOMORPH_DATA"]
+            else:
+                os.environ["AUTOMORPH_DATA"] = automorph_data
+
+        failed = {}
+        with tracer.span("features/store", len(names)):
+            for centred in CENTRED:
+                measurement_path = f"{staging}/Results/M3/{centred}_centred/"
+                for name, columns in failed_measurements(measurement_path).items():
+                    failed.setdefault(name, []).extend(columns)
+                # an image can move between disc and macular centred, replace
+                # the rows of every image of the chunk in all the tables
+                for table in measurement_tables(centred):
+                    csv_path = f"{measurement_path}{table}.csv"
+                    if os.path.exists(csv_path):
+                        measurement = pd.read_csv(csv_path)
+                    else:
+                        measurement = pd.DataFrame(columns=["Name"])
+                    self.store.write(table, measurement, names=names)
+
+        # an image can move between disc and macular centred, drop all old copies
+        for path_attr in ("vessel_path", "artery_vein_path"):
+            main_path, staged_path = getattr(self, path_attr), staged[path_attr]
+            for sub_dir in os.listdir(main_path):
+                if "centred" in sub_dir:
+                    for name in names:
+                        if os.path.exists(f"{main_path}{sub_dir}/{name}"):
+                            os.remove(f"{main_path}{sub_dir}/{name}")
+            for sub_dir in os.listdir(staged_path):
+                if "centred" in sub_dir:
+                    os.makedirs(main_path + sub_dir, exist_ok=True)
+                    for name in os.listdir(f"{staged_path}{sub_dir}"):
+                        os.replace(
+                            f"{staged_path}{sub_dir}/{name}",
+                            f"{main_path}{sub_dir}/{name}",
+                        )
+
+        shutil.rmtree(staging)
+        return failed
+
+    def share_results(self, ledger, keys, duplicates, stale, stages):
+        """
+        Give the out of date ``duplicates`` the ``stages`` results of the image
+        they duplicate: its store rows, files and ledger records, under their
+        own names. The duplicates of an image that failed fail with it.
+        """
+        for stage in stages:
+            shared = {}
+            jobs = []
+            for duplicate, original in duplicates.items():
+                job = ledger.job(stage, original)
+                if duplicate not in stale[stage] or job is None:
+                    continue
+                status, key, error = job
+                if status == FAILED:
+                    error = f"duplicate of {original}: {error}"
+                    jobs.append((duplicate, FAILED, None, error))
+                elif key == keys[stage][original]:
+                    shared[duplicate] = original
+                    jobs.append((duplicate, status, key, error))
+            if shared:
+                self.copy_results(stage, shared)
+            for duplicate, status, key, error in jobs:
+                ledger.record(stage, duplicate, status, key, 0.0, error)
+        ledger.commit()
+
+    def copy_results(self, stage, shared):
+        """Copy the ``stage`` store rows and files of the originals to the duplicates"""
+        names = {
+            image_path: image_path.split(".")[0]
+            for image_path in list(shared) + list(shared.values())
+        }
+        tables = {
+            "M0": ("crop_info",),
+            "M1": ("results_ensemble",),
+            "features": [
+                table for centred in CENTRED for table in measurement_tables(centred)
+            ],
+        }.get(stage, ())
+        for table in tables:
+            rows = self.store.read(
+                table, names={names[original] + ".png" for original in shared.values()}
+            )
+            copies = [
+                rows[rows["Name"] == names[original] + ".png"].assign(
+                    Name=names[duplicate] + ".png"
+                )
+                for duplicate, original in shared.items()
+            ]
+            self.store.write(
+                table,
+                pd.concat(copies, ignore_index=True),
+                names=[names[duplicate] + ".png" for duplicate in shared],
+            )
+
+        if stage == "M0":
+            directories = [self.m0_path]
+        elif stage == "features":
+            # an image can move between disc and macular centred
+            directories = [
+                path + sub_dir
+                for path in (self.vessel_path, self.artery_vein_path)
+                for sub_dir in os.listdir(path)
+                if "centred" in sub_dir
+            ]
+        elif stage == "M1":
+            directories = []
+        else:
+            path = getattr(self, stage + "_path")
+            directories = [
+                path + sub_dir
+                for sub_dir in os.listdir(path)
+                if "centred" not in sub_dir and os.path.isdir(path + sub_dir)
+            ]
+        for directory in directories:
+            directory = directory.rstrip("/") + "/"
+            for duplicate, original in shared.items():
+                for suffix in OUTPUT_SUFFIXES:
+                    for extension in CODECS:
+                        source = f"{directory}{names[original]}{suffix}.{extension}"
+                        target = f"{directory}{names[duplicate]}{suffix}.{extension}"
+                        if os.path.exists(target):
+                            os.remove(target)
+                        # copies, a link would be overwritten with the original
+                        if os.path.exists(source):
+                            shutil.copyfile(source, target)
+
+    def read_results(self, names=None):
+        """
+        crop_info and results_ensemble, with the quality column merge_quality
+        adds, and the numbers of good and bad images. Only ``names`` if given
+        """
+        crop_info_df = self.store.read("crop_info", names=names)
+        result_Eyepacs_ = self.store.read("results_ensemble", names=names)
+        Eye_good, Eye_bad = self.merge_quality.merge_quality(result_Eyepacs_)
+        return crop_info_df, result_Eyepacs_, Eye_good, Eye_bad
+
+    def export_csv(self, crop_info_df, result_Eyepacs_, features, names=None):
+        """
+        Export the store to crop_info.csv, results_ensemble.csv and the features.
+        Given ``names``, the tables only have the rows of these new images and
+        they are appended to the csv files, written in full when one is missing
+        or its columns changed
+        """
+        exports = {
+            f"{self.output_path}/Results/M0/crop_info.csv": crop_info_df,
+            f"{self.output_path}/Results/M1/results_ensemble.csv": (
+                result_Eyepacs_.assign(Name=self.m0_path + result_Eyepacs_["Name"])
+            ),
+        }
+        if features:
+            for centred in CENTRED:
+                exports[f"{self.output_path}/Results/M3/{centred}_Features.csv"] = (
+                    self.store.features(centred, names=names)
+                )
+        if names is not None and not all(
+            os.path.exists(path)
+            and list(pd.read_csv(path, nrows=0).columns) == list(frame.columns)
+            for path, frame in exports.items()
+        ):
+            crop_info_df, result_Eyepacs_, _, _ = self.read_results()
+            return self.export_csv(crop_info_df, result_Eyepacs_, features)
+        for path, frame in exports.items():
+            if names is None:
+                frame.to_csv(path, index=False, encoding="utf8")
+            else:
+                frame.to_csv(path, mode="a", header=False, index=False, encoding="utf8")
+
+    def make_output_dirs(self):
+        for path in (
+            self.m0_path,
+            f"{self.output_path}/Results/M1",
+            f"{self.output_path}/Results/M3",
+        ):
+            os.makedirs(path, exist_ok=True)
+        self.vessel.make_output_dirs(self.vessel_path)
+        self.artery_vein.make_output_dirs(self.artery_vein_path)
+        self.disc_cup.make_output_dirs(self.disc_cup_path)
+
+    def list_images(self):
+        """Images of $AUTOMORPH_DATA/images handled by this runner, sorted"""
+        images = os.getenv("AUTOMORPH_IMAGES")
+        if images and os.path.abspath(images) != os.path.abspath(
+            f"{self.data_path}/images"
+        ):
+            # the stage keys, duplicates and crop workers read image files by path
+            raise ValueError(
+                f"AUTOMORPH_IMAGES={images}: the runner only reads the directory "
+                f"{self.data_path}/images, archives are read by the M0 scripts "
+                "only (see M0_Preprocess/fundus_source.py)"
+            )
+        if not os.path.isdir(f"{self.data_path}/images"):
+            raise ValueError(f"No images directory at {self.data_path}/images")
+        if os.path.exists(f"{self.data_path}/images/.ipynb_checkpoints"):
+            shutil.rmtree(f"{self.data_path}/images/.ipynb_checkpoints")
+
+        image_list = [
+            file
+            for file in sorted(os.listdir(f"{self.data_path}/images/"))
+            if not file.startswith(".")
+        ]
+        return select_shard(image_list, self.shard)
+
+    def run(self, features=True, image_list=None, incremental=False):
+        """
+        Bring the Results up to date with ``image_list``, every image of
+        $AUTOMORPH_DATA/images by default. Results of images left out are dropped,
+        or kept with ``incremental``: then only the images of ``image_list`` are
+        looked at and their rows appended to the csv exports.
+        """
+        try:
+            with tracer.span("run"):
+                self.update(features, image_list, incremental)
+        finally:
+            if tracer.enabled:
+                tracer.save(f"{self.output_path}/Results/trace")
+                logging.info(f"Trace written to {self.output_path}/Results/trace")
+
+    def drop(self, image_list, features=True):
+        """Remove the Results of ``image_list``, as run does for the images left out"""
+        self.store.drop(image_path.split(".")[0] + ".png" for image_path in image_list)
+        ledger = Ledger(f"{self.output_path}/Results/ledger.sqlite")
+        try:
+            ledger.drop(image_list)
+        finally:
+            ledger.close()
+        if self.csv:
+            crop_info_df, result_Eyepacs_, _, _ = self.read_results()
+            self.export_csv(crop_info_df, result_Eyepacs_, features)
+
+    def update(self, features, image_list, incremental=False):
+        self.make_output_dirs()
+        ledger = Ledger(f"{self.output_path}/Results/ledger.sqlite")
+        try:
+            self.update_results(ledger, features, image_list, incremental)
+            self.write_failures(ledger)
+        finally:
+            ledger.close()
+
+    def write_failures(self, ledger):
+        failures = ledger.failures()
+        failures.to_csv(f"{self.output_path}/Results/failed_images.csv", index=False)
+        if not failures.empty:
+            print(
+                f"{failures['Name'].nunique()} images failed or are incomplete, "
+                f"see {self.output_path}/Results/failed_images.csv"
+            )
+
+    def update_results(self, ledger, features, image_list, incremental):
+        if image_list is None:
+            image_list = self.list_images()
+        resolution_dict = self.resolutions(image_list)
+
+        manifest = Manifest(f"{self.output_path}/Results/manifest.json")
+        with tracer.span("hash", len(image_list)):
+            keys = self.stage_keys(manifest, image_list, resolution_dict)
+            duplicates = {}
+            if self.duplicates != "none":
+                duplicates = find_duplicates(
+                    manifest,
+                    f"{self.data_path}/images",
+                    image_list,
+                    resolution_dict,
+                    near=self.duplicates == "near",
+                )
+        manifest.save()
+        # a duplicate is up to date while it has the results of its original
+        for duplicate, original in duplicates.items():
+            for stage in STAGES:
+                keys[stage][duplicate] = keys[stage][original]
+        names = None
+        if incremental:
+            names = [image_path.split(".")[0] + ".png" for image_path in image_list]
+            # rows of images run before would be in the csv exports twice
+            append = self.store.read("crop_info", columns=["Name"], names=names).empty
+        else:
+            ledger.forget(image_list)
+            self.store.retain(
+                image_path.split(".")[0] + ".png" for image_path in image_list
+            )
+
+        stale = {}
+        for stage in STAGES:
+            outputs = self.outputs(stage)
+            stale[stage] = {
+                image_path
+                for image_path in image_list
+                if ledger.key(stage, image_path) != keys[stage][image_path]
+                or (
+                    outputs is not None
+                    and image_path.split(".")[0] + ".png" not in outputs
+                )
+            }
+        todo = [
+            image_path
+            for image_path in image_list
+            if image_path not in duplicates
+            and any(image_path in stale[stage] for stage in INFERENCE_STAGES)
+        ]
+        up_to_date = len(image_list) - len(todo) - len(duplicates)
+        print(f"{up_to_date} images up to date, processing {len(todo)}")
+        if duplicates:
+            print(f"{len(duplicates)} duplicates take the results of their original")
+
+        cached = set(todo) - stale["M0"]
+        with tqdm(total=len(todo), desc="Processing images", unit="img") as pbar:
+            for consumed, batch, failed in self.batches(todo, resolution_dict, cached):
+                for image_path, error in failed:
+                    ledger.record("M0", image_path, FAILED, error=error)
+                crop_rows = [info for _, _, _, info in batch if info is not None]
+                if crop_rows:
+                    self.store.write("crop_info", pd.DataFrame(crop_rows))
+                for image_path, _, _, info in batch:
+                    if info is not None:
+                        ledger.record("M0", image_path, DONE, keys["M0"][image_path])
+                for stage, process in (
+                    ("M1", self.assess_quality),
+                    ("vessel", self.segment_vessels),
+                    ("artery_vein", self.segment_artery_vein),
+                    ("disc_cup", self.segment_disc_cup),
+                ):
+                    stage_batch = [item for item in batch if item[0] in stale[stage]]
+                    if not stage_batch:
+                        continue
+                    names = [name for _, name, _, _ in stage_batch]
+                    start = time.perf_counter()
+                    try:
+                        result = process(
+                            names, [crop for _, _, crop, _ in stage_batch]
+                        )
+                        if stage != "M1":
+                            # a failed write fails the stage of its image
+                            with tracer.span(f"{stage}/wait", len(names)):
+                                self.writer.wait()
+                        if stage in ("vessel", "artery_vein"):
+                            with tracer.span(f"{stage}/filter_frag", len(names)):
+                                getattr(self, stage).filter_frag(
+                                    getattr(self, stage + "_path"),
+                                    [name + ".png" for name in names],
+                                )
+                    except Exception as e:
+                        logging.exception(f"{stage} failed on {names}")
+                        for image_path, _, _, _ in stage_batch:
+                            ledger.record(stage, image_path, FAILED, error=repr(e))
+                        continue
+                    seconds = (time.perf_counter() - start) / len(stage_batch)
+                    if stage == "M1":
+                        self.store.write("results_ensemble", result)
+                    for image_path, _, _, _ in stage_batch:
+                        ledger.record(
+                            stage, image_path, DONE, keys[stage][image_path], seconds
+                        )
+                with tracer.span("ledger"):
+                    ledger.commit()
+                pbar.update(consumed)
+        with tracer.span("duplicates", len(duplicates)):
+            self.share_results(ledger, keys, duplicates, stale, INFERENCE_STAGES)
+
+        crop_info_df, result_Eyepacs_, Eye_good, Eye_bad = self.read_results(names)
+        if crop_info_df.empty:
+            print("\nNo images were successfully processed")
+            return
+
+        print("Gradable cases by EyePACS_QA is {} ".format(Eye_good))
+        print("Ungradable cases by EyePACS_QA is {} ".format(Eye_bad))
+
+        if features:
+            measure = [
+                image_path
+                for image_path in image_list
+                if image_path in stale["features"]
+                and image_path not in duplicates
+                and all(
+                    ledger.key(stage, image_path) == keys[stage][image_path]
+                    for stage in INFERENCE_STAGES
+                )
+            ]
+            for start in range(0, len(measure), FEATURE_CHUNK):
+                chunk = measure[start : start + FEATURE_CHUNK]
+                names = [image_path.split(".")[0] + ".png" for image_path in chunk]
+                started = time.perf_counter()
+                try:
+                    failed = self.measure_features(names)
+                except Exception as e:
+                    logging.exception("M3 failed")
+                    for image_path in chunk:
+                        ledger.record("features", image_path, FAILED, error=repr(e))
+                    ledger.commit()
+                    continue
+                seconds = (time.perf_counter() - started) / len(chunk)
+                for image_path, name in zip(chunk, names):
+                    if name in failed:
+                        ledger.record(
+                            "features",
+                            image_path,
+                            INCOMPLETE,
+                            keys["features"][image_path],
+                            seconds,
+                            error="-1 in " + "; ".join(failed[name]),
+                        )
+                    else:
+                        ledger.record(
+                            "features",
+                            image_path,
+                            DONE,
+                            keys["features"][image_path],
+                            seconds,
+                        )
+                ledger.commit()
+            with tracer.span("duplicates", len(duplicates)):
+                self.share_results(ledger, keys, duplicates, stale, ("features",))
+
+        if self.csv:
+            with tracer.span("csv"):
+                if incremental and append:
+                    self.export_csv(crop_info_df, result_Eyepacs_, features, names)
+                else:
+                    if incremental:
+                        crop_info_df, result_Eyepacs_, _, _ = self.read_results()
+                    self.export_csv(crop_info_df, result_Eyepacs_, features)
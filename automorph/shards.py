@@ -0,0 +1,108 @@
+"""
+Split a cohort over several nodes sharing $AUTOMORPH_DATA.
+
+``--shard i/N`` keeps the images whose name hashes to shard i and writes their
+Results to $AUTOMORPH_DATA/shards/i_of_N/Results. The shard of an image only
+depends on its file name, so every stage and every node agrees on it and new
+images do not move old ones to another shard. ``merge`` combines the stores
+and csv tables of all the shards in $AUTOMORPH_DATA/Results.
+"""
+import glob
+import hashlib
+import logging
+import os
+
+import pandas as pd
+
+from .store import ResultStore
+
+# tables combined by merge_shards, relative to Results. Disc_cup_results.csv
+# only lives in the runner's scratch tree, its columns reach the store through
+# the M3 measurement tables
+SHARD_TABLES = (
+    "M0/crop_info.csv",
+    "M1/results_ensemble.csv",
+    "M3/Disc_Features.csv",
+    "M3/Macular_Features.csv",
+    "failed_images.csv",
+)
+
+
+def parse_shard(text):
+    """``"i/N"`` to ``(i, N)`` with 1 <= i <= N"""
+    try:
+        index, count = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise ValueError(f"shard must look like i/N, got {text!r}")
+    if not 1 <= index <= count:
+        raise ValueError(f"shard index must be between 1 and {count}, got {index}")
+    return index, count
+
+
+def shard_of(image_path, count):
+    """Shard (1 to count) of an image, from the sha256 of its file name"""
+    digest = hashlib.sha256(image_path.encode("utf8")).hexdigest()
+    return int(digest[:16], 16) % count + 1
+
+
+def select_shard(image_list, shard):
+    if shard is None:
+        return image_list
+    index, count = shard
+    return [
+        image_path for image_path in image_list if shard_of(image_path, count) == index
+    ]
+
+
+def shard_path(data_path, shard):
+    """Directory holding the Results of a shard, data_path itself without shard"""
+    if shard is None:
+        return data_path
+    index, count = shard
+    return f"{data_path}/shards/{index}_of_{count}"
+
+
+def merge_shards(data_path):
+    """Concatenate the tables of every shard into data_path/Results"""
+    shard_dirs = sorted(glob.glob(f"{data_path}/shards/*_of_*"))
+    if not shard_dirs:
+        print(f"No shards found in {data_path}/shards")
+        return
+
+    counts = {os.path.basename(path).split("_of_")[1] for path in shard_dirs}
+    if len(counts) > 1:
+        raise ValueError(f"shards of different splits in {data_path}/shards: {counts}")
+    count = int(counts.pop())
+    if len(shard_dirs) < count:
+        logging.warning(f"Only {len(shard_dirs)} of {count} shards found")
+
+    # the shards hold different images, their rows are written side by side
+    store = ResultStore(f"{data_path}/Results/store")
+    tables = {
+        os.path.basename(table_dir)
+        for path in shard_dirs
+        for table_dir in glob.glob(f"{path}/Results/store/*")
+    }
+    for table in sorted(tables):
+        for path in shard_dirs:
+            store.write(table, ResultStore(f"{path}/Results/store").read(table))
+        print(f"store/{table}: {len(store.names(table))} images")
+
+    for table in SHARD_TABLES:
+        frames = [
+            pd.read_csv(f"{path}/Results/{table}")
+            for path in shard_dirs
+            if os.path.exists(f"{path}/Results/{table}")
+        ]
+        if not frames:
+            continue
+        if len(frames) < len(shard_dirs):
+            logging.warning(f"{table} missing in some shards")
+        merged = pd.concat(frames, ignore_index=True)
+        merged = merged.sort_values(
+            "Name", key=lambda col: col.map(os.path.basename)
+        ).reset_index(drop=True)
+
+        os.makedirs(os.path.dirname(f"{data_path}/Results/{table}"), exist_ok=True)
+        merged.to_csv(f"{data_path}/Results/{table}", index=False)
+        print(f"{table}: {len(merged)} rows from {len(frames)} shards")
@@ -0,0 +1,83 @@
+"""
+Helpers to import the stage scripts of the repository into one process.
+
+Every stage directory ships its own ``model``, ``dataset``, ``utils`` or
+``retipy`` module, so each stage is imported with its directory on
+``sys.path`` and the stage-local modules are dropped from ``sys.modules``
+afterwards. The imported stage keeps its own references and the next stage
+can import its namesakes.
+"""
+import contextlib
+import importlib
+import logging
+import os
+import runpy
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_device(name=None):
+    import torch  # the other helpers load stages that may not need it
+
+    if name is not None:
+        return torch.device(name)
+    # Check if CUDA is available
+    if torch.cuda.is_available():
+        logging.info("CUDA is available. Using CUDA...")
+        return torch.device("cuda:0")
+    elif torch.backends.mps.is_available():  # Check if MPS is available (for macOS)
+        logging.info("MPS is available. Using MPS...")
+        return torch.device("mps")
+    logging.info("Neither CUDA nor MPS is available. Using CPU...")
+    return torch.device("cpu")
+
+
+@contextlib.contextmanager
+def stage_path(directory):
+    """Put a stage directory first on sys.path and forget its modules on exit"""
+    directory = os.path.join(ROOT, directory)
+    sys.path.insert(0, directory)
+    try:
+        yield directory
+    finally:
+        sys.path.remove(directory)
+        for name, module in list(sys.modules.items()):
+            module_file = getattr(module, "__file__", None)
+            # namespace packages (no __init__.py) only have a __path__
+            paths = [module_file] if module_file else getattr(module, "__path__", [])
+            if any(
+                os.path.abspath(path).startswith(directory + os.sep) for path in paths
+            ):
+                del sys.modules[name]
+
+
+def load_module(directory, *names):
+    """Import one or more modules of a stage directory"""
+    with stage_path(directory):
+        modules = tuple(importlib.import_module(name) for name in names)
+    return modules[0] if len(modules) == 1 else modules
+
+
+@contextlib.contextmanager
+def working_directory(path):
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+
+def run_script(script):
+    """Run a module-level stage script in-process, as ``python <script>`` from the repository root"""
+    directory = os.path.dirname(script)
+    argv = sys.argv
+    sys.argv = [script]
+    try:
+        with working_directory(ROOT), (
+            stage_path(directory) if directory else contextlib.nullcontext()
+        ):
+            runpy.run_path(os.path.join(ROOT, script), run_name="__main__")
+    finally:
+        sys.argv = argv
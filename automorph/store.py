@@ -0,0 +1,195 @@
+"""
+Columnar store of the runner's result tables, in Results/store.
+
+Each table is a directory of BUCKETS Parquet files, the rows of an image going
+to the file its name hashes to. Writing the rows of some images only rewrites
+the few files they hash to, replacing the rows those images had, and every file
+is replaced atomically. Reading loads only the requested columns and, given
+``names``, only the matching rows. The columns of a table are also kept in its
+_common_metadata file, so that a table without rows still has them.
+
+Every table keys its rows by the png name of the crop in ``Name``:
+    crop_info                   M0 crop geometry and scale, and the factor
+                                the image was decoded downscaled by
+    results_ensemble            M1 softmax means and sds, prediction and quality
+    Disc_Measurement, Disc_Zone_B_Measurement, Disc_Zone_C_Measurement,
+    Macular_Measurement, Macular_Zone_B_Measurement, Macular_Zone_C_Measurement
+                                M3 measurements of the retipy scripts, -1 where
+                                a measurement failed
+
+The Disc and Macular feature tables are views: ``features`` joins the whole
+image and zone measurements on Name when it is read, as csv_merge.py does.
+"""
+import glob
+import os
+import zlib
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+BUCKETS = 64
+CENTRED = ("Disc", "Macular")
+ZONES = ("_zone_b", "_zone_c")
+# measured once per image and shared by the whole image and zone tables
+DISC_CUP_COLUMNS = (
+    "Disc_height",
+    "Disc_width",
+    "Cup_height",
+    "Cup_width",
+    "CDR_vertical",
+    "CDR_horizontal",
+)
+
+
+def bucket_of(name):
+    return zlib.crc32(name.encode("utf8")) % BUCKETS
+
+
+def measurement_tables(centred):
+    """Whole image, zone B and zone C measurement tables of Disc or Macular"""
+    return (
+        f"{centred}_Measurement",
+        f"{centred}_Zone_B_Measurement",
+        f"{centred}_Zone_C_Measurement",
+    )
+
+
+class ResultStore:
+    def __init__(self, path):
+        self.path = path
+
+    def files(self, table):
+        return sorted(glob.glob(f"{self.path}/{table}/*.parquet"))
+
+    def empty(self, table, columns=None):
+        """Table without rows, with the columns of ``table`` when it was written"""
+        schema_path = f"{self.path}/{table}/_common_metadata"
+        if os.path.exists(schema_path):
+            frame = pq.read_schema(schema_path).empty_table().to_pandas()
+        else:
+            frame = pd.DataFrame(columns=["Name"])
+        return frame if columns is None else frame.reindex(columns=columns)
+
+    def write(self, table, frame, names=None):
+        """
+        Replace the rows of ``names``, the images in ``frame`` by default, by the
+        rows of ``frame``. Images in ``names`` without a row in ``frame`` are
+        removed from the table.
+        """
+        names = set(frame["Name"]) | set(() if names is None else names)
+        buckets = {}
+        for name in names:
+            buckets.setdefault(bucket_of(name), set()).add(name)
+        frames = dict(tuple(frame.groupby(frame["Name"].map(bucket_of))))
+
+        os.makedirs(f"{self.path}/{table}", exist_ok=True)
+        if len(frame.columns) > 1:
+            schema = pa.Schema.from_pandas(frame, preserve_index=False)
+            pq.write_metadata(schema, f"{self.path}/{table}/_common_metadata")
+        for bucket, bucket_names in buckets.items():
+            path = f"{self.path}/{table}/{bucket:02d}.parquet"
+            rows = frames.get(bucket, frame.iloc[:0])
+            if os.path.exists(path):
+                kept = pq.read_table(path).to_pandas()
+                kept = kept[~kept["Name"].isin(bucket_names)]
+                rows = pd.concat([kept, rows], ignore_index=True)
+            if rows.empty:
+                if os.path.exists(path):
+                    os.remove(path)
+                continue
+            pq.write_table(
+                pa.Table.from_pandas(rows, preserve_index=False), path + ".tmp"
+            )
+            os.replace(path + ".tmp", path)
+
+    def read(self, table, columns=None, names=None):
+        """Rows of ``table`` sorted by Name, only ``columns`` and ``names`` if given"""
+        if columns is not None:
+            columns = ["Name"] + [column for column in columns if column != "Name"]
+        files = self.files(table)
+        if names is not None:
+            names = list(names)
+            files = files if names else []
+        filters = None if names is None else [("Name", "in", names)]
+        frames = [
+            pq.read_table(path, columns=columns, filters=filters).to_pandas()
+            for path in files
+        ]
+        frames = [frame for frame in frames if not frame.empty]
+        if not frames:
+            return self.empty(table, columns)
+        return (
+            pd.concat(frames, ignore_index=True)
+            .sort_values("Name", kind="stable")
+            .reset_index(drop=True)
+        )
+
+    def names(self, table):
+        return set(self.read(table, columns=["Name"])["Name"])
+
+    def retain(self, names):
+        """Drop the rows of the images that are no longer in ``names``"""
+        names = set(names)
+        for path in glob.glob(f"{self.path}/*/*.parquet"):
+            kept = pq.read_table(path, columns=["Name"]).to_pandas()["Name"]
+            if kept.isin(names).all():
+                continue
+            rows = pq.read_table(path).to_pandas()
+            rows = rows[rows["Name"].isin(names)]
+            if rows.empty:
+                os.remove(path)
+                continue
+            pq.write_table(
+                pa.Table.from_pandas(rows, preserve_index=False), path + ".tmp"
+            )
+            os.replace(path + ".tmp", path)
+
+    def drop(self, names):
+        """Drop the rows of ``names`` from every table"""
+        names = set(names)
+        if not os.path.isdir(self.path):
+            return
+        for table in sorted(os.listdir(self.path)):
+            self.write(table, pd.DataFrame(columns=["Name"]), names)
+
+    def features(self, centred, columns=None, names=None):
+        """
+        Disc or Macular feature table: the whole image measurements followed by
+        the zone B and zone C ones suffixed with _zone_b and _zone_c, with the
+        failed (-1) measurements empty. Only ``columns`` and ``names`` if given.
+        """
+        whole_table, *zone_tables = measurement_tables(centred)
+        whole_columns = None
+        if columns is not None:
+            whole_columns = [
+                column for column in columns if not column.endswith(ZONES)
+            ]
+        frame = self.read(whole_table, columns=whole_columns, names=names)
+
+        for zone_table, suffix in zip(zone_tables, ZONES):
+            zone_columns = None
+            if columns is not None:
+                zone_columns = [
+                    column[: -len(suffix)]
+                    for column in columns
+                    if column.endswith(suffix)
+                ]
+                if not zone_columns:
+                    continue
+            zone = self.read(zone_table, columns=zone_columns, names=names)
+            zone = zone.drop(columns=list(DISC_CUP_COLUMNS), errors="ignore")
+            zone = zone.rename(
+                columns={column: column + suffix for column in zone if column != "Name"}
+            )
+            frame = frame.merge(zone, how="outer", on="Name")
+
+        if columns is not None:
+            columns = dict.fromkeys(["Name", *columns])
+            frame = frame[[column for column in columns if column in frame]]
+        return (
+            frame.replace(-1, np.nan)
+            .sort_values("Name", kind="stable")
+            .reset_index(drop=True)
+        )
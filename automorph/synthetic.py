@@ -0,0 +1,171 @@
+"""
+Synthetic fundus-like images to benchmark and smoke test AutoMorph without
+patient data.
+
+An image has a dark background around a circular field of view, an optic
+disc with its cup, a darker macula and a branching artery/vein tree leaving
+the disc along the two arcades. The ground-truth masks come with it in the
+layouts the M2 stages write, so the M2 post-processing and M3 can run on them
+directly. Everything is drawn from a seeded generator: the same seed and size
+give the same image.
+"""
+import math
+import os
+
+import cv2
+import numpy as np
+
+ARTERY_COLOUR = (150, 30, 20)
+VEIN_COLOUR = (110, 15, 25)
+
+
+def grow_vessel(rng, masks, start, angle, length, width, depth, scale, bend=0.0):
+    """
+    Draw one vessel segment as a wavy polyline turning by ``bend`` radians per
+    step and branch from its end
+    """
+    points = [start]
+    x, y = start
+    steps = max(int(length / (8 * scale)), 2)
+    for _ in range(steps):
+        angle += bend + rng.normal(0, 0.06)
+        x += math.cos(angle) * length / steps
+        y += math.sin(angle) * length / steps
+        points.append((x, y))
+
+    polyline = np.round(np.array(points)).astype(np.int32).reshape(-1, 1, 2)
+    for mask in masks:
+        cv2.polylines(mask, [polyline], False, 255, max(int(round(width)), 1))
+
+    if depth == 0 or width < 1.5 * scale:
+        return
+    for side in (-1, 1):
+        grow_vessel(
+            rng,
+            masks,
+            points[-1],
+            angle + side * rng.uniform(0.3, 0.7),
+            length * rng.uniform(0.6, 0.8),
+            width * rng.uniform(0.65, 0.8),
+            depth - 1,
+            scale,
+        )
+
+
+def synthetic_fundus(size, seed=0, right_eye=True):
+    """
+    RGB uint8 image of ``size`` x ``size`` pixels and its masks
+    ("vessel", "artery", "vein", "disc", "cup", "fov"), uint8 0/255
+    """
+    rng = np.random.default_rng(seed)
+    scale = size / 1000
+    centre = np.array([size / 2, size / 2])
+    radius = 0.45 * size
+    side = 1 if right_eye else -1
+    disc_centre = centre + [side * 0.2 * size, rng.normal(0, 0.01) * size]
+    macula_centre = centre - [side * 0.05 * size, 0]
+    disc_radius = 0.07 * size
+
+    yy, xx = np.mgrid[0:size, 0:size].astype(np.float32)
+    distance = np.hypot(xx - centre[0], yy - centre[1]) / radius
+    fov = (distance <= 1).astype(np.uint8) * 255
+
+    # orange-red background, darker towards the rim, with some mottling
+    shade = np.clip(1 - 0.45 * distance**2, 0, 1)
+    noise = cv2.GaussianBlur(
+        rng.normal(0, 1, (size, size)).astype(np.float32), (0, 0), 12 * scale
+    )
+    shade = shade * (1 + 0.05 * noise / max(noise.std(), 1e-6))
+    image = np.stack([200 * shade, 85 * shade, 35 * shade], axis=-1)
+
+    macula = np.hypot(xx - macula_centre[0], yy - macula_centre[1]) / (0.09 * size)
+    image *= (1 - 0.35 * np.exp(-(macula**2)))[..., None]
+
+    disc = np.zeros((size, size), np.uint8)
+    cup = np.zeros((size, size), np.uint8)
+    disc_point = tuple(np.round(disc_centre).astype(int))
+    disc_axes = (int(disc_radius * 0.9), int(disc_radius))
+    cup_axes = (int(disc_axes[0] * 0.45), int(disc_axes[1] * 0.45))
+    cv2.ellipse(disc, disc_point, disc_axes, 0, 0, 360, 255, -1)
+    cv2.ellipse(cup, disc_point, cup_axes, 0, 0, 360, 255, -1)
+    image[disc > 0] = (235, 190, 110)
+    image[cup > 0] = (250, 225, 170)
+
+    vessel = np.zeros((size, size), np.uint8)
+    artery = np.zeros((size, size), np.uint8)
+    vein = np.zeros((size, size), np.uint8)
+    temporal = math.pi if right_eye else 0.0
+    for mask, width in ((artery, 9), (vein, 12)):
+        for arcade in (-1, 1):
+            # arcades leave the disc vertically and bend around the macula
+            angle = temporal - side * arcade * (math.pi / 2 - 0.35)
+            grow_vessel(
+                rng,
+                (mask, vessel),
+                tuple(disc_centre + [0, arcade * disc_radius * 0.3]),
+                angle + rng.normal(0, 0.1),
+                0.3 * size,
+                width * scale,
+                5,
+                scale,
+                bend=side * arcade * 0.025,
+            )
+        # nasal branches
+        for arcade in (-1, 1):
+            grow_vessel(
+                rng,
+                (mask, vessel),
+                tuple(disc_centre),
+                temporal + math.pi + arcade * 0.6 + rng.normal(0, 0.1),
+                0.12 * size,
+                width * 0.7 * scale,
+                3,
+                scale,
+            )
+
+    image[artery > 0] = ARTERY_COLOUR
+    image[vein > 0] = VEIN_COLOUR
+    image = cv2.GaussianBlur(image.astype(np.float32), (0, 0), max(scale, 0.5))
+    image[fov == 0] = 0
+
+    inside = fov > 0
+    masks = {
+        "vessel": vessel * inside,
+        "artery": artery * inside,
+        "vein": vein * inside,
+        "disc": disc,
+        "cup": cup,
+        "fov": fov,
+    }
+    return np.clip(image, 0, 255).astype(np.uint8), masks
+
+
+def av_image(masks):
+    """M2_Artery_vein layout of the masks: artery red, vein blue, crossing green"""
+    artery, vein = masks["artery"] > 0, masks["vein"] > 0
+    image = np.zeros(artery.shape + (3,), np.uint8)
+    image[artery & ~vein, 0] = 255
+    image[vein & ~artery, 2] = 255
+    image[artery & vein, 1] = 255
+    return image
+
+
+def disc_cup_image(masks):
+    """M2_lwnet_disc_cup layout of the masks: disc red, cup blue"""
+    image = np.zeros(masks["disc"].shape + (3,), np.uint8)
+    image[..., 0] = masks["disc"]
+    image[..., 2] = masks["cup"]
+    return image
+
+
+def write_dataset(data_path, count, size, seed=0):
+    """Write ``count`` synthetic fundus photographs to ``data_path``/images"""
+    os.makedirs(f"{data_path}/images", exist_ok=True)
+    for index in range(count):
+        image, _ = synthetic_fundus(
+            size, seed=seed + index, right_eye=index % 2 == 0
+        )
+        cv2.imwrite(
+            f"{data_path}/images/synthetic_{index:05d}.jpg",
+            cv2.cvtColor(image, cv2.COLOR_RGB2BGR),
+        )
@@ -0,0 +1,153 @@
+"""
+Wall time, images/s, peak RSS and I/O bytes of the stages and their sub-steps.
+
+The runner wraps its steps in ``tracer.span(name, images)``. Nothing is
+recorded until ``tracer.enabled`` is set (``--trace``); then ``tracer.save``
+writes a JSON summary per step and a Chrome trace (chrome://tracing or
+https://ui.perfetto.dev) with one event per span, M0 worker processes included.
+
+Code outside the runner that measures its own steps, like evaluate_window,
+reports them with ``tracer.add(name, seconds, calls)``: they get a summary
+entry but no trace event.
+"""
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+import torch
+
+
+def io_bytes():
+    """Bytes read and written by this process so far, None when not available"""
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["read_bytes"]), int(counters["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes"""
+    # kilobytes on Linux, bytes on macOS
+    scale = 1 if os.uname().sysname == "Darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.stats = {}
+        self.origin = time.time()
+        # cuda kernels run asynchronously, wait for them before reading the clock
+        self.synchronize = False
+
+    def clock(self):
+        if self.synchronize and torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return time.time()
+
+    @contextmanager
+    def span(self, name, images=0):
+        if not self.enabled:
+            yield
+            return
+        start, io_start = self.clock(), io_bytes()
+        try:
+            yield
+        finally:
+            end, io_end = self.clock(), io_bytes()
+            args = {"images": images, "peak_rss": peak_rss()}
+            if io_start is not None and io_end is not None:
+                args["read_bytes"] = io_end[0] - io_start[0]
+                args["write_bytes"] = io_end[1] - io_start[1]
+            self.record(
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": (start - self.origin) * 1e6,
+                    "dur": (end - start) * 1e6,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": args,
+                }
+            )
+
+    def record(self, event):
+        self.events.append(event)
+        args = event["args"]
+        stats = self.stats.setdefault(
+            event["name"],
+            {
+                "calls": 0,
+                "seconds": 0.0,
+                "images": 0,
+                "read_bytes": 0,
+                "write_bytes": 0,
+                "peak_rss": 0,
+            },
+        )
+        stats["calls"] += 1
+        stats["seconds"] += event["dur"] / 1e6
+        stats["images"] += args["images"]
+        stats["read_bytes"] += args.get("read_bytes", 0)
+        stats["write_bytes"] += args.get("write_bytes", 0)
+        stats["peak_rss"] = max(stats["peak_rss"], args["peak_rss"])
+
+    def add(self, name, seconds, calls=1):
+        """Time measured by the caller, summary only"""
+        if not self.enabled:
+            return
+        stats = self.stats.setdefault(name, {"calls": 0, "seconds": 0.0})
+        stats["calls"] += calls
+        stats["seconds"] += seconds
+
+    def drain(self):
+        """Events recorded so far, removed from this tracer (M0 workers)"""
+        events, self.events, self.stats = self.events, [], {}
+        return events
+
+    def merge(self, events):
+        for event in events:
+            self.record(event)
+
+    def summary(self):
+        summary = {}
+        for name, stats in sorted(self.stats.items()):
+            summary[name] = dict(stats)
+            if stats.get("images") and stats["seconds"] > 0:
+                summary[name]["images_per_s"] = stats["images"] / stats["seconds"]
+        return summary
+
+    def save(self, path):
+        """Write summary.json and trace.json to ``path`` and start over"""
+        os.makedirs(path, exist_ok=True)
+        with open(f"{path}/summary.json", "w") as f:
+            json.dump(self.summary(), f, indent=2)
+        with open(f"{path}/trace.json", "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+        self.events = []
+        self.stats = {}
+
+
+tracer = Tracer()
+
+
+def trace_forward(name, model):
+    """Record a span for every forward pass of ``model``"""
+    spans = []
+
+    def start(module, inputs):
+        span = tracer.span(name, len(inputs[0]))
+        span.__enter__()
+        spans.append(span)
+
+    def stop(module, inputs, output):
+        spans.pop().__exit__(None, None, None)
+
+    model.register_forward_pre_hook(start)
+    model.register_forward_hook(stop)
@@ -0,0 +1,111 @@
+"""
+Keep the runner loaded and process images as they arrive in $AUTOMORPH_DATA/images.
+
+The directory is only listed again when its mtime changes, so an idle watch
+costs one stat per interval. A new or rewritten image is picked up once its
+size and mtime have not changed for ``settle`` seconds, which keeps half
+uploaded files out of M0. The first run brings the Results up to date with
+every settled image. After that only the images settled (new or rewritten)
+since the last run go through M0 to M3, as one incremental micro-batch whose
+rows are added to the store and appended to the csv exports, and the images
+deleted since are dropped from the Results.
+"""
+import logging
+import os
+import time
+
+
+class Watcher:
+    def __init__(self, runner, interval=10.0, settle=30.0, features=True):
+        self.runner = runner
+        self.interval = interval
+        self.settle = settle
+        self.features = features
+        self.images_path = f"{runner.data_path}/images"
+
+        self.dir_mtime = None
+        # image -> (size, mtime) and the time that signature was first seen
+        self.seen = {}
+        # signatures of the images in the Results after the last run
+        self.processed = None
+
+    def scan(self):
+        """Refresh the signatures, only when the directory changed or files settle"""
+        dir_mtime = os.stat(self.images_path).st_mtime_ns
+        unsettled = any(
+            time.time() - first_seen < self.settle
+            for _, first_seen in self.seen.values()
+        )
+        if dir_mtime == self.dir_mtime and not unsettled:
+            return
+        self.dir_mtime = dir_mtime
+
+        now = time.time()
+        seen = {}
+        for image_path in self.runner.list_images():
+            try:
+                stat = os.stat(f"{self.images_path}/{image_path}")
+            except FileNotFoundError:
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            previous = self.seen.get(image_path)
+            if previous is not None and previous[0] == signature:
+                seen[image_path] = previous
+            else:
+                seen[image_path] = (signature, now)
+        self.seen = seen
+
+    def settled(self):
+        """Signatures of the images that stopped changing ``settle`` seconds ago"""
+        now = time.time()
+        return {
+            image_path: signature
+            for image_path, (signature, first_seen) in self.seen.items()
+            if now - first_seen >= self.settle
+        }
+
+    def step(self):
+        """Run the settled images if they differ from the last run, True if done"""
+        self.scan()
+        settled = self.settled()
+        if settled == self.processed or not (settled or self.processed):
+            return False
+
+        processed = self.processed or {}
+        changed = sorted(
+            image_path
+            for image_path, signature in settled.items()
+            if processed.get(image_path) != signature
+        )
+        removed = sorted(set(processed) - set(settled))
+        logging.info(
+            f"{len(changed)} new images, {len(removed)} removed, "
+            f"{len(settled)} in total"
+        )
+        start = time.perf_counter()
+        try:
+            if self.processed is None:
+                self.runner.run(features=self.features, image_list=sorted(settled))
+            else:
+                if removed:
+                    self.runner.drop(removed, features=self.features)
+                if changed:
+                    self.runner.run(
+                        features=self.features, image_list=changed, incremental=True
+                    )
+        except Exception:
+            # keep watching, the ledger resumes the unfinished images next time
+            logging.exception("Run failed")
+            return False
+        self.processed = settled
+        logging.info(f"Results up to date in {time.perf_counter() - start:.1f}s")
+        return True
+
+    def watch(self):
+        logging.info(f"Watching {self.images_path}")
+        try:
+            while True:
+                if not self.step():
+                    time.sleep(self.interval)
+        except KeyboardInterrupt:
+            logging.info("Stopped watching")
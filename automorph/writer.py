@@ -0,0 +1,133 @@
+"""
+Image writer with a thread pool, so that inference does not wait for the
+PNG encoder.
+
+``write(path, image)`` takes the arguments of ``cv2.imwrite``: a gray or BGR
+image of any depth cv2.imwrite accepts, converted to uint8 as cv2.imwrite
+does. The image is encoded and written by one of ``threads`` threads. The
+encoders release the GIL. At most ``max_pending`` images wait for a thread,
+after which ``write`` blocks, so memory stays bounded. ``wait`` blocks until
+everything submitted is on disk and raises the first error of a write.
+
+Images are written as
+    png     the given path, with zlib ``level`` 0-9 when it is given and the
+            fast defaults of cv2.imwrite otherwise (PIL and torchvision use 6)
+    webp    lossless WebP, the path with a .webp suffix
+    npy     the uint8 image in RGB(A) (or gray) order, the path with a .npy
+            suffix
+except under the ``keep_png`` directories, whose images are read back by a
+later stage and stay PNG. Lossless WebP drops the colour of transparent
+pixels, so images with an alpha channel stay PNG as well.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+CODECS = ("png", "webp", "npy")
+
+
+def to_uint8(image):
+    """``image`` as cv2.imwrite converts it to 8 bit, rounded and saturated"""
+    if image.dtype == np.uint8:
+        return image
+    return np.clip(np.rint(image), 0, 255).astype(np.uint8)
+
+
+class ImageWriter:
+    def __init__(
+        self, codec="png", level=None, threads=4, max_pending=None, keep_png=()
+    ):
+        if codec not in CODECS:
+            raise ValueError(
+                f"unknown image codec {codec!r}, expected one of {CODECS}"
+            )
+        self.codec = codec
+        self.level = level
+        self.png_params = [] if level is None else [cv2.IMWRITE_PNG_COMPRESSION, level]
+        self.keep_png = tuple(keep_png)
+        self.pool = ThreadPoolExecutor(
+            threads, thread_name_prefix="automorph-writer"
+        )
+        self.slots = threading.BoundedSemaphore(
+            4 * threads if max_pending is None else max_pending
+        )
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.error = None
+
+    def codec_of(self, path, image):
+        if path.startswith(self.keep_png):
+            return "png"
+        if self.codec == "webp" and image.ndim == 3 and image.shape[2] == 4:
+            return "png"
+        return self.codec
+
+    def encode(self, path, image):
+        """Write ``image`` to ``path`` (or its .webp/.npy sibling) in this thread"""
+        codec = self.codec_of(path, image)
+        if codec == "png":
+            ok, data = cv2.imencode(".png", image, self.png_params)
+        elif codec == "webp":
+            path = os.path.splitext(path)[0] + ".webp"
+            # quality above 100 is lossless
+            ok, data = cv2.imencode(
+                ".webp", to_uint8(image), [cv2.IMWRITE_WEBP_QUALITY, 101]
+            )
+        else:
+            path = os.path.splitext(path)[0] + ".npy"
+            image = to_uint8(image)
+            if image.ndim == 3:
+                image = cv2.cvtColor(
+                    image,
+                    cv2.COLOR_BGR2RGB if image.shape[2] == 3 else cv2.COLOR_BGRA2RGBA,
+                )
+            np.save(path, image)
+            return
+        if not ok:
+            raise IOError(f"Can not encode {path}")
+        data.tofile(path)
+
+    def write(self, path, image):
+        """Queue ``image`` for ``path``, blocking while the queue is full"""
+        self.raise_error()
+        self.slots.acquire()
+        future = self.pool.submit(self.encode, path, image)
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self.done)
+
+    def done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+            if future.exception() is not None and self.error is None:
+                self.error = future.exception()
+        self.slots.release()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def wait(self):
+        """Block until every queued image is written"""
+        while True:
+            with self.lock:
+                pending = list(self.pending)
+            if not pending:
+                break
+            for future in pending:
+                future.exception()
+        self.raise_error()
+
+    def close(self):
+        self.wait()
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -2,8 +2,11 @@ import pandas as pd
 import os
 import sys
 import shutil
+from M0_Preprocess.fundus_source import open_source
 
 AUTOMORPH_DATA = os.getenv('AUTOMORPH_DATA','.')
+# a directory, or a tar or zip archive read in place (see M0_Preprocess/fundus_source.py)
+AUTOMORPH_IMAGES = os.getenv('AUTOMORPH_IMAGES', f'{AUTOMORPH_DATA}/images')
 
 # read pixel_resolution from cli arg if defined, otherwise use default value 0.008
 pixel_resolution = float(sys.argv[1]) if len(sys.argv) > 1 else 0.008
@@ -11,7 +14,7 @@ pixel_resolution = float(sys.argv[1]) if len(sys.argv) > 1 else 0.008
 if os.path.exists(f'{AUTOMORPH_DATA}/images/.ipynb_checkpoints'):
     shutil.rmtree(f'{AUTOMORPH_DATA}/images/.ipynb_checkpoints')
 
-image_list = sorted(os.listdir(f'{AUTOMORPH_DATA}/images/'))
+image_list = open_source(AUTOMORPH_IMAGES).names()
 img_list = []
 # import image resolution here
 res_list = []
@@ -3,6 +3,9 @@ export PYTHONPATH=/home/xujia/miniconda3/envs/automorph/bin/python
 alias python=$PYTHONPATH
 export CUDA_VISIBLE_DEVICES=0
 
+# the steps below can also run in one process with every model kept loaded:
+# python -m automorph run
+
 echo "### Generate resolution ###"
 python generate_resolution.py
 echo "### Done ###"
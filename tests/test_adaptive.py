@@ -0,0 +1,75 @@
+"""Early stopping of the adaptive M1 ensemble, on hand-built member outputs"""
+import numpy as np
+import pytest
+
+from automorph.stages import load_module
+
+torch = pytest.importorskip("torch")
+
+adaptive, merge = load_module(
+    "M1_Retinal_Image_quality_EyePACS", "adaptive", "merge_quality_assessment"
+)
+
+MEMBERS = 8
+
+
+def softmax(*members):
+    """member x image x class, one image"""
+    return torch.tensor(members, dtype=torch.float32)[:, None, :]
+
+
+def test_settled_when_the_members_agree():
+    # three members clearly good: softmax_bad far below 0.25
+    agreeing = softmax([0.90, 0.06, 0.04], [0.88, 0.08, 0.04], [0.91, 0.05, 0.04])
+    assert adaptive.settled(agreeing, MEMBERS).tolist() == [True]
+    # and clearly bad
+    agreeing = softmax([0.05, 0.15, 0.80], [0.04, 0.18, 0.78], [0.06, 0.12, 0.82])
+    assert adaptive.settled(agreeing, MEMBERS).tolist() == [True]
+
+
+def test_not_settled_when_the_members_disagree():
+    # the mean softmax_bad (0.3) is within 3 standard errors of 0.25
+    disagreeing = softmax([0.5, 0.2, 0.3], [0.2, 0.4, 0.4], [0.3, 0.5, 0.2])
+    assert adaptive.settled(disagreeing, MEMBERS).tolist() == [False]
+    # but every member ran
+    assert adaptive.settled(disagreeing, 3).tolist() == [True]
+
+
+class Member:
+    """An ensemble member returning fixed logits, by image index (imgs[:, 0])"""
+
+    def __init__(self, logits):
+        self.logits = logits
+
+    def __call__(self, imgs):
+        return self.logits[imgs[:, 0].long()]
+
+
+def test_adaptive_predict_stops_settled_images_early():
+    rng = np.random.default_rng(0)
+    confident = np.log([0.9, 0.07, 0.03]) + rng.normal(0, 0.05, (MEMBERS, 8, 3))
+    # the members disagree in turn, as in test_not_settled_when_the_members_disagree
+    disagreeing = np.log([[0.5, 0.2, 0.3], [0.2, 0.4, 0.4], [0.3, 0.5, 0.2]])
+    ambiguous = np.broadcast_to(
+        disagreeing[np.arange(MEMBERS) % 3, None], (MEMBERS, 8, 3)
+    )
+    logits = torch.tensor(np.concatenate([confident, ambiguous], axis=1)).float()
+    members = [Member(member_logits) for member_logits in logits]
+    imgs = torch.arange(16, dtype=torch.float32)[:, None]
+
+    mean, std, prediction, used = adaptive.adaptive_predict(members, imgs)
+
+    assert used[:8].tolist() == [3] * 8
+    assert used[8:].tolist() == [MEMBERS] * 8
+    # the decisions of the images that stopped early are those of every member
+    full = torch.softmax(logits, dim=2).mean(dim=0).numpy()
+    for i in range(16):
+        assert merge.quality_label(prediction[i], mean[i, 2]) == merge.quality_label(
+            full[i].argmax(), full[i, 2]
+        )
+    np.testing.assert_allclose(mean[used == MEMBERS], full[used == MEMBERS], atol=1e-6)
+
+
+def test_adaptive_predict_needs_the_members():
+    with pytest.raises(ValueError):
+        adaptive.adaptive_predict(lambda imgs: imgs, torch.zeros(1, 1))
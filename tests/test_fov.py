@@ -0,0 +1,97 @@
+"""get_fov, crop_fov and _fit_circle_robust on synthetic fundus images"""
+import functools
+
+import numpy as np
+import pytest
+
+from automorph.stages import load_module
+from automorph.synthetic import synthetic_fundus
+
+prep = load_module("M0_Preprocess", "fundus_prep")
+
+
+@functools.lru_cache(maxsize=None)
+def synthetic_image(size):
+    img = synthetic_fundus(size, seed=size)[0]
+    img.flags.writeable = False
+    return img
+
+
+def fundus(size, shift=0, clip=0):
+    """Synthetic image with its true FOV centre (row, column) and radius"""
+    img = synthetic_image(size).copy()
+    if shift:
+        img = np.pad(img, ((0, 0), (shift, 0), (0, 0)))
+    if clip:
+        img = img[clip:-clip]
+    return img, (size / 2 - clip, size / 2 + shift), 0.45 * size
+
+
+# 800 px is searched at full resolution, 1800 and 2400 px downscaled and
+# refined in a band, with the FOV centred, off centre and clipped by the frame
+CASES = [
+    (800, 0, 0),
+    (800, 200, 0),
+    (800, 0, 80),
+    (1800, 0, 0),
+    (1800, 450, 0),
+    (2400, 0, 0),
+    (2400, 0, 240),
+]
+
+
+@pytest.mark.parametrize("size,shift,clip", CASES)
+def test_get_fov_finds_the_true_circle(size, shift, clip):
+    img, centre, radius = fundus(size, shift, clip)
+
+    bbox, fov_centre, fov_radius = prep.get_fov(img)
+
+    assert abs(fov_centre[0] - centre[0]) <= 1.5
+    assert abs(fov_centre[1] - centre[1]) <= 1.5
+    assert abs(fov_radius - radius) <= 1
+    assert bbox == prep._fov_bbox(*img.shape[:2], fov_centre, fov_radius)[0]
+
+
+@pytest.mark.parametrize("size,shift,clip", CASES[:6])
+def test_get_fov_matches_get_mask_native(size, shift, clip):
+    img, _, _ = fundus(size, shift, clip)
+
+    _, fov_centre, fov_radius = prep.get_fov(img)
+    _, _, native_centre, native_radius = prep.get_mask_native(img)
+
+    assert abs(fov_centre[0] - native_centre[0]) <= 2
+    assert abs(fov_centre[1] - native_centre[1]) <= 2
+    # the gradient histogram radius of get_mask_native runs a few pixels wide
+    assert abs(fov_radius - native_radius) <= 0.005 * native_radius + 1
+
+
+@pytest.mark.parametrize("size,shift,clip", [(800, 200, 0), (1800, 0, 180)])
+def test_crop_fov_matches_process_without_gb(size, shift, clip):
+    img, _, _ = fundus(size, shift, clip)
+    label = np.zeros(img.shape[:2], np.uint8)
+    # process_without_gb masks img in place
+    expected = prep.process_without_gb(img.copy(), label, [], [], [])[0]
+
+    out, fov = prep.crop_fov(img)
+    reused, _ = prep.crop_fov(img, fov=fov, out=np.full_like(out, 255))
+
+    assert np.array_equal(out, expected)
+    assert np.array_equal(reused, expected)
+
+
+def test_fit_circle_robust_drops_the_outliers():
+    rng = np.random.default_rng(0)
+    theta = np.linspace(0, 2 * np.pi, 400, endpoint=False)
+    y = 100 + 50 * np.sin(theta) + rng.normal(0, 0.3, theta.size)
+    x = 200 + 50 * np.cos(theta) + rng.normal(0, 0.3, theta.size)
+    # a tenth of the points on an inner circle, like a bright rim artefact
+    y[:40] = 100 + 20 * np.sin(theta[:40])
+    x[:40] = 200 + 20 * np.cos(theta[:40])
+
+    (cy, cx), radius = prep._fit_circle_robust(y, x)
+    (plain_y, plain_x), plain_radius = prep._fit_circle(y, x)
+
+    assert abs(cy - 100) < 0.1 and abs(cx - 200) < 0.1
+    assert abs(radius - 50) < 0.1
+    # the plain least squares fit is pulled off by them
+    assert abs(plain_radius - 50) > 1
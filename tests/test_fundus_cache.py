@@ -0,0 +1,52 @@
+"""M0 cache of the resized crops, written for some stages only"""
+import os
+
+import numpy as np
+import pytest
+
+from automorph.stages import load_module
+
+fundus_cache = load_module("M0_Preprocess", "fundus_cache")
+
+
+def test_cache_keys():
+    assert fundus_cache.cache_keys("0") == ()
+    assert fundus_cache.cache_keys("1") == tuple(fundus_cache.CACHE_SIZES)
+    assert fundus_cache.cache_keys("M1, disc_cup") == (
+        "512x512_bicubic",
+        "512x512_bilinear",
+    )
+    with pytest.raises(ValueError):
+        fundus_cache.cache_keys("M2")
+
+
+def test_rows_go_to_fixed_size_chunks_of_the_keys_asked_for(tmp_path, monkeypatch):
+    monkeypatch.setattr(fundus_cache, "CHUNK_ROWS", 2)
+    images_dir = tmp_path / "images"
+    cache_dir = tmp_path / "cache"
+    images_dir.mkdir()
+    keys = fundus_cache.cache_keys("M1")
+    rng = np.random.default_rng(0)
+
+    rows = []
+    slots = fundus_cache.chunk_slots(str(cache_dir), keys)
+    for index, (chunk, row) in zip(range(3), slots):
+        png_path = images_dir / f"{index}.png"
+        png_path.write_bytes(b"crop")
+        crop = rng.integers(0, 256, (40, 40, 3), dtype=np.uint8)
+        rows.append(
+            fundus_cache.write_row(str(cache_dir), chunk, row, str(png_path), crop)
+        )
+    fundus_cache.merge_index(str(cache_dir), rows)
+
+    assert set(rows[0]) == {"Name", "chunk", "row", "width", "height", "mtime"}
+    # three images, two chunks of two rows, of the M1 key only
+    assert sorted(os.listdir(cache_dir)) == ["512x512_bicubic", "index.csv"]
+    assert len(os.listdir(cache_dir / "512x512_bicubic")) == 2
+    assert rows[2]["row"] == 0 and rows[2]["chunk"] != rows[0]["chunk"]
+
+    cache = fundus_cache.load_m0_cache(str(images_dir), "512x512_bicubic")
+    assert sorted(cache) == ["0", "1", "2"]
+    assert cache["2"][0].shape == (512, 512, 3) and cache["2"][1:] == (40, 40)
+    # the other stages decode the png
+    assert fundus_cache.load_m0_cache(str(images_dir), "912x912_bicubic") == {}
@@ -0,0 +1,32 @@
+"""Pipeline.read takes uint8 RGB arrays and refuses other dtypes"""
+import types
+
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+from automorph.pipeline import Pipeline  # noqa: E402
+
+
+def read(image):
+    return Pipeline.read(types.SimpleNamespace(), image)
+
+
+def test_copies_a_uint8_image():
+    image = np.full((4, 4, 3), 200, dtype=np.uint8)
+    copy = read(image)
+
+    assert copy.dtype == np.uint8
+    assert np.array_equal(copy, image)
+    assert not np.shares_memory(copy, image)
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64, np.uint16, np.int64])
+def test_refuses_other_dtypes(dtype):
+    with pytest.raises(ValueError, match="uint8"):
+        read(np.ones((4, 4, 3), dtype=dtype))
+
+
+def test_refuses_a_grey_image():
+    with pytest.raises(ValueError, match="RGB"):
+        read(np.zeros((4, 4), dtype=np.uint8))
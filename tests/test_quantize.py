@@ -0,0 +1,100 @@
+"""INT8 quantization of an exported M1 graph, on a tiny model of the same shape"""
+import numpy as np
+import pytest
+
+from automorph.stages import load_module
+
+onnx = pytest.importorskip("onnx")
+onnxruntime = pytest.importorskip("onnxruntime")
+from onnx import TensorProto, helper, numpy_helper  # noqa: E402
+
+quantize = load_module("M1_Retinal_Image_quality_EyePACS", "quantize")
+
+
+def tiny_classifier(path, seed=0):
+    """imgs (batch x 3 x 32 x 32) -> two convolutions, pooling, 2-layer head -> logits"""
+    rng = np.random.default_rng(seed)
+
+    def weight(name, *shape):
+        scale = 1 / np.sqrt(np.prod(shape[1:]))
+        return numpy_helper.from_array(
+            rng.normal(0, scale, shape).astype(np.float32), name
+        )
+
+    initializers = [
+        weight("conv1_w", 8, 3, 3, 3),
+        weight("conv1_b", 8),
+        weight("conv2_w", 16, 8, 3, 3),
+        weight("conv2_b", 16),
+        weight("fc1_w", 32, 16),
+        weight("fc1_b", 32),
+        weight("fc2_w", 3, 32),
+        weight("fc2_b", 3),
+    ]
+    nodes = [
+        helper.make_node(
+            "Conv", ["imgs", "conv1_w", "conv1_b"], ["c1"], pads=[1, 1, 1, 1]
+        ),
+        helper.make_node("Relu", ["c1"], ["r1"]),
+        helper.make_node(
+            "Conv", ["r1", "conv2_w", "conv2_b"], ["c2"], pads=[1, 1, 1, 1]
+        ),
+        helper.make_node("Relu", ["c2"], ["r2"]),
+        helper.make_node("GlobalAveragePool", ["r2"], ["pool"]),
+        helper.make_node("Flatten", ["pool"], ["features"]),
+        helper.make_node("Gemm", ["features", "fc1_w", "fc1_b"], ["h"], transB=1),
+        helper.make_node("Relu", ["h"], ["hr"]),
+        helper.make_node("Gemm", ["hr", "fc2_w", "fc2_b"], ["logits"], transB=1),
+    ]
+    graph = helper.make_graph(
+        nodes,
+        "tiny_classifier",
+        [helper.make_tensor_value_info("imgs", TensorProto.FLOAT, ["batch", 3, 32, 32])],
+        [helper.make_tensor_value_info("logits", TensorProto.FLOAT, ["batch", 3])],
+        initializers,
+    )
+    # an IR version every onnxruntime reads, as torch.onnx.export writes
+    model = helper.make_model(
+        graph, opset_imports=[helper.make_opsetid("", 17)], ir_version=8
+    )
+    onnx.save(model, path)
+    return path
+
+
+def run(path, imgs):
+    session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+    return session.run(["logits"], {"imgs": imgs})[0]
+
+
+def softmax(logits):
+    exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+def test_quantized_outputs_close_to_float(tmp_path):
+    path = tiny_classifier(str(tmp_path / "float.onnx"))
+    rng = np.random.default_rng(1)
+    calibration = [rng.normal(size=(2, 3, 32, 32)).astype(np.float32) for _ in range(4)]
+    imgs = rng.normal(size=(16, 3, 32, 32)).astype(np.float32)
+
+    quantized = quantize.quantize_onnx(
+        path, str(tmp_path / "int8.onnx"), calibration
+    )
+
+    op_types = {node.op_type for node in onnx.load(quantized).graph.node}
+    # convolutions statically quantized (QDQ), the head dynamically
+    assert {"QuantizeLinear", "DequantizeLinear"} <= op_types
+    assert "DynamicQuantizeLinear" in op_types
+    assert not (tmp_path / "int8.onnx.tmp").exists()
+
+    reference, candidate = softmax(run(path, imgs)), softmax(run(quantized, imgs))
+    assert np.abs(reference - candidate).max() < 0.02
+    assert (reference.argmax(axis=1) == candidate.argmax(axis=1)).mean() >= 0.9
+
+
+def test_calibration_split():
+    calibration, evaluation = quantize.calibration_split(10, 3, 4)
+    assert calibration == [0, 4, 9]
+    assert evaluation == [1, 2, 3, 5]
+    calibration, evaluation = quantize.calibration_split(2, 5, 4)
+    assert calibration == [0, 1] and evaluation == []
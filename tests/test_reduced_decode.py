@@ -0,0 +1,42 @@
+"""M0 --reduced-decode refuses the images its geometry would be too coarse for"""
+import cv2
+import numpy as np
+import pytest
+
+from automorph.stages import load_module
+from automorph.synthetic import synthetic_fundus
+
+m0 = load_module("M0_Preprocess", "EyeQ_process_multiprocess")
+
+
+def write_jpeg(path, img):
+    cv2.imwrite(str(path), img[..., ::-1], [cv2.IMWRITE_JPEG_QUALITY, 95])
+    return str(path)
+
+
+def test_large_fov_keeps_the_reduced_decode(tmp_path):
+    img, _ = synthetic_fundus(3000, seed=0)
+    path = write_jpeg(tmp_path / "large.jpg", img)
+    full, full_info = m0.read_and_crop(path, 0.008, reduced=False)
+
+    r_img, crop_info = m0.read_and_crop(path, 0.008, reduced=True)
+
+    assert full_info["decode_factor"] == 1 and crop_info["decode_factor"] == 2
+    # within one decode_factor step of the full decode
+    step = crop_info["decode_factor"]
+    assert abs(crop_info["centre_w"] - full_info["centre_w"]) <= step
+    assert abs(crop_info["centre_h"] - full_info["centre_h"]) <= step
+    assert abs(crop_info["radius"] - full_info["radius"]) <= step / 2 + 0.5
+    assert r_img.shape[0] == pytest.approx(full.shape[0] / step, abs=2)
+
+
+def test_small_fov_is_decoded_in_full(tmp_path):
+    img, _ = synthetic_fundus(600, seed=0)
+    # a small FOV in a large frame: 2 pixels are 0.7% of its radius
+    img = np.pad(img, ((1200, 1200), (1200, 1200), (0, 0)))
+    path = write_jpeg(tmp_path / "small_fov.jpg", img)
+    assert m0.prep.decode_factor(path) == 2
+
+    _, crop_info = m0.read_and_crop(path, 0.008, reduced=True)
+
+    assert crop_info["decode_factor"] == 1
@@ -0,0 +1,36 @@
+"""Runner reads a directory of image files, archives are left to M0"""
+import types
+
+import pytest
+
+pytest.importorskip("torch")
+from automorph.runner import Runner  # noqa: E402
+
+
+def list_images(data_path):
+    return Runner.list_images(types.SimpleNamespace(data_path=data_path, shard=None))
+
+
+def test_lists_the_image_files(tmp_path, monkeypatch):
+    monkeypatch.delenv("AUTOMORPH_IMAGES", raising=False)
+    (tmp_path / "images").mkdir()
+    for name in ("b.jpg", "a.png", ".DS_Store"):
+        (tmp_path / "images" / name).write_bytes(b"fundus")
+
+    assert list_images(str(tmp_path)) == ["a.png", "b.jpg"]
+
+
+def test_refuses_an_archive(tmp_path, monkeypatch):
+    (tmp_path / "images").mkdir()
+    monkeypatch.setenv("AUTOMORPH_IMAGES", str(tmp_path / "images.zip"))
+
+    with pytest.raises(ValueError, match="archives are read by the M0 scripts"):
+        list_images(str(tmp_path))
+
+
+def test_accepts_the_images_directory_by_name(tmp_path, monkeypatch):
+    (tmp_path / "images").mkdir()
+    (tmp_path / "images" / "a.jpg").write_bytes(b"fundus")
+    monkeypatch.setenv("AUTOMORPH_IMAGES", str(tmp_path / "images") + "/")
+
+    assert list_images(str(tmp_path)) == ["a.jpg"]
@@ -0,0 +1,55 @@
+"""StackedEnsemble against the list of members it stacks"""
+import pytest
+
+from automorph.stages import load_module
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchvision")
+pytest.importorskip("efficientnet_pytorch")
+
+from automorph.trace import trace_forward, tracer  # noqa: E402
+
+quality = load_module("M1_Retinal_Image_quality_EyePACS", "test_outside")
+
+
+def members(count=3):
+    torch.manual_seed(0)
+    return [
+        torch.nn.Sequential(
+            torch.nn.Conv2d(3, 4, 3, padding=1),
+            torch.nn.BatchNorm2d(4),
+            torch.nn.ReLU(),
+            torch.nn.AdaptiveAvgPool2d(1),
+            torch.nn.Flatten(),
+            torch.nn.Linear(4, 3),
+        ).eval()
+        for _ in range(count)
+    ]
+
+
+def test_stacked_outputs_match_the_members():
+    models = members()
+    imgs = torch.randn(5, 3, 16, 16)
+    with torch.no_grad():
+        reference = torch.stack([model_fl(imgs) for model_fl in models])
+        stacked = quality.ensemble_executor(models, stacked=True)
+        torch.testing.assert_close(stacked(imgs), reference)
+        # the members still run on their own, on the stacked weights
+        torch.testing.assert_close(
+            torch.stack([model_fl(imgs) for model_fl in stacked]), reference
+        )
+    assert quality.ensemble_executor(models) is models
+
+
+def test_stacked_forward_is_one_span():
+    stacked = quality.StackedEnsemble(members())
+    trace_forward("M1/stacked", stacked)
+    tracer.enabled = True
+    try:
+        with torch.no_grad():
+            quality.ensemble_predict(stacked, torch.randn(2, 3, 16, 16))
+        assert tracer.summary()["M1/stacked"]["calls"] == 1
+        assert tracer.summary()["M1/stacked"]["images"] == 2
+    finally:
+        tracer.enabled = False
+        tracer.drain()
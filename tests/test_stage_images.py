@@ -0,0 +1,30 @@
+"""The image helpers each M2 stage keeps against torchvision's save_image"""
+import numpy as np
+import pytest
+from PIL import Image
+
+from automorph.stages import load_module
+
+torch = pytest.importorskip("torch")
+torchvision = pytest.importorskip("torchvision")
+
+STAGES = (
+    ("M2_Vessel_seg", "test_outside_integrated"),
+    ("M2_Artery_vein", "test_outside"),
+    ("M2_lwnet_disc_cup", "generate_av_results"),
+)
+
+
+@pytest.mark.parametrize("directory, name", STAGES)
+@pytest.mark.parametrize("shape", [(8, 9), (1, 8, 9), (3, 8, 9)])
+def test_to_image_is_what_save_image_writes(directory, name, shape, tmp_path):
+    stage = load_module(directory, name)
+    tensor = torch.rand(*shape) * 1.2 - 0.1
+    torchvision.utils.save_image(tensor, tmp_path / "expected.png")
+
+    written = {}
+    stage.write_rgb(written.__setitem__, "image.png", stage.to_image(tensor))
+
+    expected = np.asarray(Image.open(tmp_path / "expected.png").convert("RGB"))
+    # write takes cv2's BGR order
+    np.testing.assert_array_equal(written["image.png"][..., ::-1], expected)
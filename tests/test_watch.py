@@ -0,0 +1,67 @@
+"""Watcher runs only the images settled since its last run"""
+import os
+
+from automorph.watch import Watcher
+
+
+class RecordingRunner:
+    """Stands in for the Runner, recording what the watcher asks of it"""
+
+    def __init__(self, data_path):
+        self.data_path = data_path
+        self.calls = []
+
+    def list_images(self):
+        return sorted(os.listdir(f"{self.data_path}/images"))
+
+    def run(self, features=True, image_list=None, incremental=False):
+        self.calls.append(("run", list(image_list), incremental))
+
+    def drop(self, image_list, features=True):
+        self.calls.append(("drop", list(image_list)))
+
+
+def upload(tmp_path, name, content=b"fundus"):
+    with open(tmp_path / "images" / name, "wb") as f:
+        f.write(content)
+
+
+def test_step_passes_only_the_new_images(tmp_path):
+    (tmp_path / "images").mkdir()
+    upload(tmp_path, "a.jpg")
+    upload(tmp_path, "b.jpg")
+    runner = RecordingRunner(str(tmp_path))
+    watcher = Watcher(runner, settle=0.0)
+
+    assert watcher.step()
+    assert runner.calls == [("run", ["a.jpg", "b.jpg"], False)]
+    assert not watcher.step()
+
+    upload(tmp_path, "c.jpg")
+    # a rewritten image has a new signature
+    upload(tmp_path, "a.jpg", b"another fundus")
+    os.remove(tmp_path / "images" / "b.jpg")
+    assert watcher.step()
+    assert runner.calls[1:] == [
+        ("drop", ["b.jpg"]),
+        ("run", ["a.jpg", "c.jpg"], True),
+    ]
+    assert not watcher.step()
+
+
+def test_failed_run_is_retried(tmp_path):
+    (tmp_path / "images").mkdir()
+    upload(tmp_path, "a.jpg")
+    runner = RecordingRunner(str(tmp_path))
+    watcher = Watcher(runner, settle=0.0)
+    assert watcher.step()
+
+    def fail(**kwargs):
+        raise RuntimeError("M1 failed")
+
+    upload(tmp_path, "b.jpg")
+    runner.run = fail
+    assert not watcher.step()
+    del runner.run
+    assert watcher.step()
+    assert runner.calls[-1] == ("run", ["b.jpg"], True)